@@ -0,0 +1,371 @@
+# benchmarks/run.py -- runs the benchmarks and compares them to a baseline
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from copy import deepcopy
+from datetime import date
+from json import dump, load
+import gc
+import logging
+from os import path
+from subprocess import PIPE, Popen
+import sys
+from time import perf_counter
+import tracemalloc
+
+from benchmarks.stand_in import PayloadGenerator
+from cowin_cowboy.booking import Booker, BookingSession
+from cowin_cowboy.filters import (
+    SessionTable,
+    compile_filters,
+    filter_available_centers,
+)
+from cowin_cowboy.pub_checker import (
+    check_available_slots_for_weeks,
+    check_available_slots_sharded,
+    iter_location_results,
+    pub_api_session,
+    replay_traffic,
+)
+from cowin_cowboy.utils.api_utils import merge_center_dicts
+from cowin_cowboy.utils.center_store import CenterStore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASELINE = path.join(path.dirname(__file__), "baseline.json")
+
+FILTERS = {
+    "capacity": {"dose1": 1, "dose2": 0},
+    "age": 30,
+    "vaccine": ["covaxin", "covishield"],
+    "feeType": "Free",
+}
+
+# Whether a higher value of the metric is better, per metric suffix
+HIGHER_IS_BETTER = {"_per_s": True, "_s": False, "_bytes": False}
+
+
+def make_locations(args):
+    return {
+        "pincodes": [str(110000 + i) for i in range(args.pincodes)],
+        "district_ids": list(range(1, args.districts + 1)),
+    }
+
+
+def collect_responses(args):
+    """Returns the responses of every (location, week), in the order a
+    scan would merge them, generated without the server.
+    """
+    generator = PayloadGenerator(args.centers, args.sessions)
+    locations = make_locations(args)
+    responses = []
+    for week in range(args.weeks):
+        date_str = "{:02d}-06-2021".format(1 + 7 * week)
+        for key, param in (("pincodes", "pincode"), ("district_ids", "district_id")):
+            for location_id in locations[key]:
+                centers = generator.centers_for(param, location_id, date_str)
+                responses.append({center["center_id"]: center for center in centers})
+    return responses
+
+
+def best_time(func, repeat, setup=None):
+    """Returns the fastest of `repeat` runs of `func`, in seconds, with
+    the garbage collector disabled like `timeit` does. If given, `setup`
+    is run before every run, and its result is passed to `func`.
+    """
+    best = None
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        gc.collect()
+        gc.disable()
+        try:
+            start = perf_counter()
+            func(*args)
+            elapsed = perf_counter() - start
+        finally:
+            gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+@contextmanager
+def stand_in_process(args):
+    """Runs the stand-in server in a separate process, so that it does
+    not compete with the benchmarked code for the GIL, and yields its
+    base URL.
+    """
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.stand_in",
+        "--port",
+        "0",
+        "--centers",
+        str(args.centers),
+        "--sessions",
+        str(args.sessions),
+        "--latency",
+        str(args.latency),
+        "--rate-limit-rate",
+        str(args.rate_limit_rate),
+    ]
+    process = Popen(
+        command,
+        stdout=PIPE,
+        universal_newlines=True,
+        cwd=path.dirname(path.dirname(path.abspath(__file__))),
+    )
+    try:
+        line = process.stdout.readline()
+        if not line:
+            raise RuntimeError("stand-in server failed to start")
+        yield line.rsplit(" ", 1)[-1].strip()
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def bench_scan(args, results):
+    locations = make_locations(args)
+    with stand_in_process(args) as base_url:
+        old_base_url = pub_api_session.base_url
+        old_cache, old_limiter = pub_api_session.cache, pub_api_session.limiter
+        pub_api_session.base_url = base_url
+        pub_api_session.cache = pub_api_session.limiter = None
+        try:
+            for name, jobs in (("serial", 1), ("concurrent", args.jobs)):
+                results["scan_{}_s".format(name)] = best_time(
+                    lambda: check_available_slots_for_weeks(
+                        date(2021, 6, 1), args.weeks, locations, max_workers=jobs
+                    ),
+                    args.repeat,
+                )
+            results["scan_sharded_s"] = best_time(
+                lambda: check_available_slots_sharded(
+                    date(2021, 6, 1),
+                    args.weeks,
+                    locations,
+                    args.shards,
+                    max_workers=args.jobs,
+                ),
+                args.repeat,
+            )
+
+            tracemalloc.start()
+            check_available_slots_for_weeks(
+                date(2021, 6, 1), args.weeks, locations, max_workers=args.jobs
+            )
+            results["scan_peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            tracemalloc.start()
+            table = SessionTable()
+            for _, _, result in iter_location_results(
+                [date(2021, 6, 1)], locations, max_workers=args.jobs
+            ):
+                table.extend(result)
+            results["scan_columnar_peak_memory_bytes"] = (
+                tracemalloc.get_traced_memory()[1]
+            )
+            tracemalloc.stop()
+        finally:
+            pub_api_session.base_url = old_base_url
+            pub_api_session.cache, pub_api_session.limiter = old_cache, old_limiter
+
+
+def bench_merge(args, results):
+    responses = collect_responses(args)
+    sessions = sum(
+        len(center["sessions"])
+        for response in responses
+        for center in response.values()
+    )
+
+    def merge_dicts(responses):
+        merged = {}
+        for response in responses:
+            merge_center_dicts(merged, response)
+
+    def merge_store():
+        CenterStore().merge_many(responses)
+
+    # merge_center_dicts modifies the dicts it merges into
+    results["merge_center_dicts_sessions_per_s"] = sessions / best_time(
+        merge_dicts, args.repeat, lambda: deepcopy(responses)
+    )
+    results["center_store_sessions_per_s"] = sessions / best_time(
+        merge_store, args.repeat
+    )
+
+
+def bench_filter(args, results):
+    store = CenterStore()
+    store.merge_many(collect_responses(args))
+    centers = store.centers
+    sessions = sum(len(center["sessions"]) for center in centers.values())
+
+    results["filter_available_centers_sessions_per_s"] = sessions / best_time(
+        lambda: filter_available_centers(centers, FILTERS), args.repeat
+    )
+    table = SessionTable.from_centers(centers)
+    results["session_table_sessions_per_s"] = sessions / best_time(
+        lambda: table.filter_centers(FILTERS), args.repeat
+    )
+
+
+def bench_replay(args, results):
+    """Measures the throughput of replaying the log given with `--replay`
+    as fast as possible, from decoding every response to filtering the
+    centers of every recorded scan.
+    """
+    if args.replay is None:
+        return
+    sessions = sum(
+        len(center["sessions"])
+        for _, centers in replay_traffic(args.replay, 0, max_workers=args.jobs)
+        for center in centers.values()
+    )
+    filters = compile_filters(FILTERS)
+    results["replay_sessions_per_s"] = sessions / best_time(
+        lambda: list(replay_traffic(args.replay, 0, filters, args.jobs)),
+        args.repeat,
+    )
+
+
+def bench_booking(args, results):
+    """Measures the time to book one of the open sessions of a district,
+    from a cold session and from a warm one with the requests prepared.
+    """
+    centers = PayloadGenerator(args.centers, args.sessions).centers_for(
+        "district_id", 1, "01-06-2021"
+    )
+    candidates = [
+        (center, session)
+        for center in centers
+        for session in center["sessions"]
+        if session["available_capacity_dose1"] > 0
+    ]
+    with stand_in_process(args) as base_url:
+        for name, warm in (("cold", False), ("warm", True)):
+            best = None
+            for i in range(args.repeat):
+                booker = Booker(
+                    BookingSession("benchmark", base_url=base_url),
+                    ["{}-{}".format(name, i)],
+                )
+                try:
+                    if warm:
+                        booker.session.warm()
+                        for center, session in candidates:
+                            booker.prepare(center, session)
+                    start = perf_counter()
+                    if booker.book(candidates) is None:
+                        raise RuntimeError("stand-in booking failed")
+                    elapsed = perf_counter() - start
+                finally:
+                    booker.close()
+                if best is None or elapsed < best:
+                    best = elapsed
+            results["booking_{}_s".format(name)] = best
+
+
+def is_regression(name, value, baseline, tolerance):
+    for suffix, higher_is_better in HIGHER_IS_BETTER.items():
+        if name.endswith(suffix):
+            if higher_is_better:
+                return value < baseline * (1 - tolerance)
+            return value > baseline * (1 + tolerance)
+    return False
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        prog="python -m benchmarks.run",
+        description="Benchmarks cowin-cowboy against a local stand-in API",
+    )
+    parser.add_argument("--pincodes", type=int, default=30, help="PIN codes to scan")
+    parser.add_argument("--districts", type=int, default=10, help="districts to scan")
+    parser.add_argument("--weeks", type=int, default=4, help="weeks to scan")
+    parser.add_argument("--centers", type=int, default=50, help="centers per location")
+    parser.add_argument("--sessions", type=int, default=7, help="sessions per center")
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="seconds per stand-in response"
+    )
+    parser.add_argument(
+        "--rate-limit-rate",
+        type=float,
+        default=0.0,
+        help="fraction of stand-in responses which are 403",
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="concurrent requests")
+    parser.add_argument(
+        "--shards", type=int, default=4, help="processes of the sharded scan"
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="PATH",
+        help="also measure replaying the log recorded at PATH with --record",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark")
+    parser.add_argument(
+        "--baseline", default=DEFAULT_BASELINE, help="path of the baseline file"
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="save the results as the new baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative slowdown before reporting a regression",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    results = {}
+    bench_scan(args, results)
+    bench_merge(args, results)
+    bench_filter(args, results)
+    bench_replay(args, results)
+    bench_booking(args, results)
+
+    baseline = {}
+    if path.isfile(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as baseline_fp:
+            baseline = load(baseline_fp)
+
+    regressions = 0
+    for name in sorted(results):
+        value = results[name]
+        line = "{:45} {:>16.4f}".format(name, value)
+        if name in baseline:
+            change = (value - baseline[name]) / baseline[name] if baseline[name] else 0
+            line += "  {:+7.1%}".format(change)
+            if is_regression(name, value, baseline[name], args.tolerance):
+                line += "  REGRESSION"
+                regressions += 1
+        print(line)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_fp:
+            dump(results, baseline_fp, indent=2, sort_keys=True)
+        print("Saved baseline to '{}'".format(args.baseline))
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,425 @@
+# benchmarks/stand_in.py -- local stand-in for the Co-WIN public API
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["PayloadGenerator", "StandInServer"]
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from json import dumps, loads
+import logging
+from random import Random
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+VACCINES = ("COVISHIELD", "COVAXIN", "SPUTNIK V")
+FEE_TYPES = ("Free", "Paid")
+SLOTS = (
+    "09:00AM-11:00AM",
+    "11:00AM-01:00PM",
+    "01:00PM-03:00PM",
+    "03:00PM-06:00PM",
+)
+
+
+class PayloadGenerator:
+    """Generates synthetic `calendarBy*` payloads, shaped like the ones of
+    the Co-WIN public API. The payload of a location and date is the same
+    on every request, except for the capacities, which change on every
+    `tick`.
+    """
+
+    def __init__(self, centers=20, sessions=7, seed=0):
+        """
+        :param centers: number of centers per PIN code or district
+        :type centers: int
+        :param sessions: number of sessions per center, one per day
+        :type sessions: int
+        :param seed: seed of the generated payloads
+        :type seed: int
+        """
+        self.centers = centers
+        self.sessions = sessions
+        self.seed = seed
+        self.tick = 0
+
+    def capacity(self, center_id, day):
+        """Returns the dose 1 and dose 2 capacities of a session, at the
+        current tick.
+
+        :param center_id: ID of the center of the session
+        :type center_id: int
+        :param day: the date of the session, as returned by
+                `datetime.date.toordinal`
+        :type day: int
+        :rtype: tuple[int, int]
+        """
+        capacity_rng = Random("{}-{}-{}".format(center_id, day, self.tick))
+        dose1 = capacity_rng.choice((0, 0, 0, 1, 5, 10, 50))
+        dose2 = capacity_rng.choice((0, 0, 2, 20))
+        return dose1, dose2
+
+    def _center(self, rng, center_id, pincode, district_id, date_obj):
+        sessions = []
+        for offset in range(self.sessions):
+            session_date = date_obj + timedelta(days=offset)
+            # The same center and date make the same session, whichever week
+            # it was queried for
+            day = session_date.toordinal()
+            dose1, dose2 = self.capacity(center_id, day)
+            sessions.append(
+                {
+                    "session_id": "{:08x}-{:06x}".format(center_id, day),
+                    "date": session_date.strftime("%d-%m-%Y"),
+                    "available_capacity": dose1 + dose2,
+                    "available_capacity_dose1": dose1,
+                    "available_capacity_dose2": dose2,
+                    "min_age_limit": rng.choice((18, 45)),
+                    "vaccine": rng.choice(VACCINES),
+                    "slots": list(SLOTS),
+                }
+            )
+        return {
+            "center_id": center_id,
+            "name": "Stand-in center {}".format(center_id),
+            "address": "Stand-in address",
+            "state_name": "Stand-in state",
+            "district_name": "District {}".format(district_id),
+            "block_name": "Stand-in block",
+            "pincode": pincode,
+            "lat": 20 + rng.randint(0, 1000) / 100,
+            "long": 75 + rng.randint(0, 1000) / 100,
+            "from": "09:00:00",
+            "to": "18:00:00",
+            "fee_type": rng.choice(FEE_TYPES),
+            "sessions": sessions,
+        }
+
+    def centers_for(self, key, location_id, date_str):
+        """Returns the list of centers for a PIN code, district or center.
+
+        :param key: one of `pincode`, `district_id` and `center_id`
+        :type key: str
+        :param location_id: the queried ID
+        :type location_id: str
+        :param date_str: the queried date, in DD-MM-YYYY
+        :type date_str: str
+        :rtype: list[dict]
+        """
+        date_obj = datetime.strptime(date_str, "%d-%m-%Y").date()
+        location_num = int(location_id)
+        if key == "center_id":
+            rng = Random("{}-center-{}".format(self.seed, location_num))
+            return [self._center(rng, location_num, 100000, 0, date_obj)]
+
+        rng = Random("{}-{}-{}".format(self.seed, key, location_num))
+        centers = []
+        for i in range(self.centers):
+            if key == "pincode":
+                pincode = location_num
+                district_id = location_num % 1000
+                center_id = location_num * 100 + i
+            else:
+                district_id = location_num
+                pincode = 100000 + district_id * 10 + i % 10
+                center_id = district_id * 100000 + i
+            centers.append(self._center(rng, center_id, pincode, district_id, date_obj))
+        return centers
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _send(self, status, body=b"", headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        token = self.server.stand_in.token
+        authorization = self.headers.get("Authorization", "")
+        if not authorization.startswith("Bearer ") or (
+            token is not None and authorization[len("Bearer ") :] != token
+        ):
+            self._send(401, b"Unauthenticated access!")
+            return False
+        return True
+
+    def do_GET(self):
+        server = self.server.stand_in
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        endpoint = url.path.rstrip("/").rsplit("/", 1)[-1]
+        key = server.ENDPOINTS.get(endpoint)
+        server.count(endpoint)
+
+        if server.latency:
+            sleep(server.latency)
+        if endpoint == "beneficiaries":
+            if self._authorized():
+                body = dumps({"beneficiaries": server.beneficiaries()}).encode()
+                self._send(200, body, [("Content-Type", "application/json")])
+            return
+        if key is None or key not in params or "date" not in params:
+            self._send(400, b'{"errorCode":"APPOIN0018"}')
+            return
+        if server.rate_limited():
+            self._send(403, b"Forbidden")
+            return
+
+        body, etag = server.payload(key, params[key], params["date"])
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, headers=[("ETag", etag)])
+            return
+        self._send(200, body, [("Content-Type", "application/json"), ("ETag", etag)])
+
+    def do_POST(self):
+        server = self.server.stand_in
+        endpoint = urlsplit(self.path).path.rstrip("/").rsplit("/", 1)[-1]
+        server.count(endpoint)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if server.latency:
+            sleep(server.latency)
+        if endpoint != "schedule":
+            self._send(404, b"Not Found")
+            return
+        if not self._authorized():
+            return
+        try:
+            status, reply = server.schedule(loads(body))
+        except (ValueError, KeyError, TypeError):
+            status, reply = 400, {"errorCode": "APPOIN0044", "error": "Invalid request"}
+        self._send(
+            status, dumps(reply).encode(), [("Content-Type", "application/json")]
+        )
+
+
+class StandInServer:
+    """A local HTTP server emulating the `calendarByPin`,
+    `calendarByDistrict` and `calendarByCenter` endpoints, serving
+    payloads from a `PayloadGenerator`, and the authenticated
+    `beneficiaries` and `schedule` endpoints used for booking. Can be
+    used as a context manager, which starts the server in a background
+    thread.
+
+    Bookings are checked against the capacities of the generator, and
+    every beneficiary can only be booked once per dose.
+    """
+
+    ENDPOINTS = {
+        "calendarByPin": "pincode",
+        "calendarByDistrict": "district_id",
+        "calendarByCenter": "center_id",
+    }
+
+    def __init__(
+        self,
+        generator=None,
+        latency=0.0,
+        rate_limit_rate=0.0,
+        host="127.0.0.1",
+        port=0,
+        seed=0,
+        token=None,
+    ):
+        """
+        :param generator: generator of the payloads
+        :type generator: Optional[PayloadGenerator]
+        :param latency: seconds to wait before answering every request
+        :type latency: float
+        :param rate_limit_rate: fraction of requests answered with 403
+        :type rate_limit_rate: float
+        :param host: address to listen on
+        :type host: str
+        :param port: port to listen on, 0 picks a free port
+        :type port: int
+        :param seed: seed of the rate limiting
+        :type seed: int
+        :param token: bearer token accepted by the booking endpoints,
+                any token is accepted if `None`
+        :type token: Optional[str]
+        """
+        self.generator = generator or PayloadGenerator()
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.token = token
+        self.requests = {}
+        self.appointments = {}
+        self._booked = {}
+        self._payloads = {}
+        self._rng = Random(seed)
+        self._lock = Lock()
+        self._httpd = _ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.stand_in = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        """Base URL to use in place of `API_URL`."""
+        host, port = self._httpd.server_address[:2]
+        return "http://{}:{}/api/".format(host, port)
+
+    def payload(self, key, location_id, date_str):
+        """Returns the body and ETag of the response for a location and
+        date, generating it only once per tick of the generator.
+        """
+        cache_key = (key, location_id, date_str, self.generator.tick)
+        with self._lock:
+            cached = self._payloads.get(cache_key)
+        if cached is not None:
+            return cached
+        centers = self.generator.centers_for(key, location_id, date_str)
+        if key == "center_id":
+            body = dumps({"centers": centers[0]}).encode()
+        else:
+            body = dumps({"centers": centers}).encode()
+        cached = body, '"{}"'.format(md5(body).hexdigest())
+        with self._lock:
+            self._payloads[cache_key] = cached
+        return cached
+
+    def beneficiaries(self):
+        """Returns the beneficiaries of the login, with their
+        appointments.
+        """
+        with self._lock:
+            booked = {}
+            for (beneficiary, dose), appointment in self.appointments.items():
+                booked.setdefault(beneficiary, []).append(
+                    {"dose": dose, "appointment_id": appointment}
+                )
+        return [
+            {"beneficiary_reference_id": beneficiary, "appointments": appointments}
+            for beneficiary, appointments in sorted(booked.items())
+        ]
+
+    def schedule(self, request):
+        """Books the session of a booking request, if it has enough
+        capacity left and none of its beneficiaries has an appointment
+        for the dose yet.
+
+        :param request: the decoded body of the booking request
+        :type request: dict
+        :raises ValueError: if the request is invalid
+        :return: the status code and body of the response
+        :rtype: tuple[int, dict]
+        """
+        beneficiaries = request["beneficiaries"]
+        dose = request["dose"]
+        if not beneficiaries or dose not in (1, 2) or not request["slot"]:
+            raise ValueError("invalid booking request")
+        center_hex, day_hex = request["session_id"].split("-")
+        session_key = (int(center_hex, 16), int(day_hex, 16))
+        capacity = self.generator.capacity(*session_key)[dose - 1]
+        with self._lock:
+            if any((b, dose) in self.appointments for b in beneficiaries):
+                return 409, {
+                    "errorCode": "APPOIN0040",
+                    "error": "Beneficiary already has an appointment",
+                }
+            booked = self._booked.get(session_key, 0)
+            if booked + len(beneficiaries) > capacity:
+                return 409, {
+                    "errorCode": "APPOIN0045",
+                    "error": "This vaccination center is completely booked",
+                }
+            self._booked[session_key] = booked + len(beneficiaries)
+            confirmation = "{:012d}".format(len(self.appointments) + 1)
+            for beneficiary in beneficiaries:
+                self.appointments[beneficiary, dose] = confirmation
+        return 200, {"appointment_confirmation_no": confirmation}
+
+    def count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def rate_limited(self):
+        with self._lock:
+            return self._rng.random() < self.rate_limit_rate
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def start(self):
+        self._thread = Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        prog="python -m benchmarks.stand_in",
+        description="Serves a local stand-in for the Co-WIN public API",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument(
+        "--port", type=int, default=8000, help="port to listen on, 0 picks one"
+    )
+    parser.add_argument("--centers", type=int, default=20, help="centers per location")
+    parser.add_argument("--sessions", type=int, default=7, help="sessions per center")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds to delay every response"
+    )
+    parser.add_argument(
+        "--rate-limit-rate",
+        type=float,
+        default=0.0,
+        help="fraction of requests answered with 403",
+    )
+    parser.add_argument(
+        "--token", help="bearer token of the booking endpoints, any if not given"
+    )
+    args = parser.parse_args()
+
+    server = StandInServer(
+        PayloadGenerator(args.centers, args.sessions),
+        latency=args.latency,
+        rate_limit_rate=args.rate_limit_rate,
+        host=args.host,
+        port=args.port,
+        token=args.token,
+    )
+    print("Serving stand-in API at {}".format(server.base_url), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
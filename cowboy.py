@@ -15,20 +15,58 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from argparse import ArgumentParser
+import atexit
 from datetime import date, timedelta
 from json import dumps, load, JSONDecodeError
 import logging
-from os import path
+from os import environ, listdir, makedirs, path
 import sys
 from os.path import isfile
 
-from appdirs import user_config_dir
-from cowin_cowboy.pub_checker import check_available_slots
-from cowin_cowboy.filters import filter_available_centers
-from cowin_cowboy.utils.api_utils import merge_center_dicts
+from appdirs import user_cache_dir, user_config_dir, user_data_dir
+from cowin_cowboy.pub_checker import (
+    DEFAULT_MAX_WORKERS,
+    AdaptivePoller,
+    NetworkPolicy,
+    PersistentResponseCache,
+    QueryPlanner,
+    RateLimiter,
+    ResponseCache,
+    ScanHorizon,
+    TrafficRecorder,
+    check_available_slots_for_weeks,
+    check_available_slots_sharded,
+    iter_location_results,
+    parse_address,
+    pub_api_session,
+    replay_traffic,
+    run_shard_worker,
+    union_locations,
+)
+from cowin_cowboy.booking import Booker
+from cowin_cowboy.notify import Notifier, Subscriber
+from cowin_cowboy.service import DEFAULT_HOST, DEFAULT_PORT, ScanService, make_server
+from cowin_cowboy.utils import json_backend
+from cowin_cowboy.utils.api_utils import date_to_string
+from cowin_cowboy.utils.center_store import CenterStore
+from cowin_cowboy.utils.geo import parse_areas
+from cowin_cowboy.utils.snapshot import ScanCoverage, SnapshotStore
+from cowin_cowboy.utils.stats import metrics
+from cowin_cowboy.filters import (
+    SessionTable,
+    compile_filters,
+    filter_available_centers,
+)
 
 logger = logging.getLogger(__name__)
 
+FORMAT_JSON = "json"
+FORMAT_NDJSON = "ndjson"
+
+# Environment variable holding the secret shared by the shard coordinator
+# and its workers
+SHARD_KEY_VAR = "COWBOY_SHARD_KEY"
+
 
 def read_json_file(json_file):
     """Reads the config file, and returns the object
@@ -52,6 +90,355 @@ def read_json_file(json_file):
     return None
 
 
+def print_centers(
+    available_centers, snapshot=None, output_format=FORMAT_JSON, coverage=None
+):
+    """Prints the available centers, or with a snapshot store, only the
+    deltas since the previous scan (if there are any).
+
+    :param available_centers: A dictionary of center ID -> center details
+    :type available_centers: dict[int, dict]
+    :param snapshot: snapshot of the previous scan, updated to this one
+    :type snapshot: Optional[cowin_cowboy.utils.snapshot.SnapshotStore]
+    :param output_format: `"json"` to print one indented JSON document,
+            or `"ndjson"` to print one compact line per center or delta
+    :type output_format: str
+    :param coverage: the requests of the scan which succeeded, so that
+            the snapshot keeps the sessions of the others
+    :type coverage: Optional[cowin_cowboy.utils.snapshot.ScanCoverage]
+    """
+    if snapshot is None:
+        records = available_centers
+    else:
+        records = snapshot.update(available_centers, coverage)
+
+    if output_format == FORMAT_NDJSON:
+        lines = records.values() if snapshot is None else records
+        for record in lines:
+            print(json_backend.dumps(record))
+        sys.stdout.flush()
+    elif snapshot is None or records:
+        print(dumps(records, sort_keys=True, indent=2), flush=True)
+    logger.info("{} centers are available".format(len(available_centers)))
+
+
+def stream_sessions(
+    date_objs,
+    locations,
+    max_workers,
+    planner,
+    filters=None,
+    horizon=None,
+    on_update=None,
+):
+    """Prints one compact JSON line per available session as soon as its
+    response arrives, with the details of its center (except the other
+    sessions) and the session at key `"session"`.
+
+    The lines are provisional, as a session may be in the responses of
+    several locations: the responses are merged unfiltered, and a session
+    is printed again whenever a later response changes it. If it then no
+    longer passes the filters, it is printed with `"withdrawn": true`, so
+    that applying the lines in order gives the sessions of a full scan.
+
+    :param date_objs: The first days of the weeks to check
+    :type date_objs: list[datetime.date]
+    :param locations: the locations table of the config
+    :type locations: dict
+    :param max_workers: maximum number of concurrent API requests
+    :type max_workers: int
+    :param planner: if given, used to skip redundant requests
+    :type planner: Optional[cowin_cowboy.pub_checker.QueryPlanner]
+    :param filters: filters to apply, if any
+    :type filters: Optional[cowin_cowboy.filters.CompiledFilters]
+    :param horizon: if given, used to skip the weeks which rarely have
+            any session
+    :type horizon: Optional[cowin_cowboy.pub_checker.ScanHorizon]
+    :param on_update: if given, called with the center store and the new
+            or changed sessions after every response, whether or not they
+            pass the filters
+    :type on_update: Optional[Callable[[CenterStore, list], Any]]
+    :return: number of sessions available at the end of the scan
+    :rtype: int
+    """
+    store = CenterStore()
+    printed = set()
+    for _, _, result in iter_location_results(
+        date_objs,
+        locations,
+        max_workers=max_workers,
+        planner=planner,
+        horizon=horizon,
+    ):
+        updated = store.merge(result)
+        if on_update is not None and updated:
+            on_update(store, updated)
+        for center_id, session in updated:
+            center = store[center_id]
+            session_key = (center_id, session.get("session_id"))
+            available = filters is None or (
+                filters.is_valid_center(center) and filters.is_valid_session(session)
+            )
+            if not available and session_key not in printed:
+                continue
+            record = {key: value for key, value in center.items() if key != "sessions"}
+            record["session"] = session
+            if available:
+                printed.add(session_key)
+            else:
+                printed.discard(session_key)
+                record["withdrawn"] = True
+            print(json_backend.dumps(record))
+        sys.stdout.flush()
+    return len(printed)
+
+
+def print_cycle(poller, report, filters, snapshot=None, output_format=FORMAT_JSON):
+    """Prints the available centers after a polling cycle in which some
+    location changed, and the timing of every cycle to stderr.
+
+    :param poller: the poller which ran the cycle
+    :type poller: cowin_cowboy.pub_checker.AdaptivePoller
+    :param report: report of the cycle
+    :type report: cowin_cowboy.pub_checker.CycleReport
+    :param filters: filters to apply, if any
+    :type filters: Optional[cowin_cowboy.filters.CompiledFilters]
+    :param snapshot: if given, only deltas are printed, see `print_centers`
+    :type snapshot: Optional[cowin_cowboy.utils.snapshot.SnapshotStore]
+    :param output_format: `"json"` or `"ndjson"`, see `print_centers`
+    :type output_format: str
+    """
+    if report.changed:
+        available_centers = poller.centers()
+        if filters is not None:
+            available_centers = filter_available_centers(available_centers, filters)
+        print_centers(available_centers, snapshot, output_format)
+    if pub_api_session.cache is not None:
+        print(
+            "{}, cache {}".format(report, pub_api_session.cache.stats()),
+            file=sys.stderr,
+            flush=True,
+        )
+    else:
+        print(report, file=sys.stderr, flush=True)
+
+
+def scan_config_dir(config_dir, output_dir, max_workers, planner=None):
+    """Checks the slots for every config file in a directory, fetching
+    each location of any of them only once per week. The filtered centers
+    of each config are written to a file of the same name in the output
+    directory.
+
+    :param config_dir: directory with the config files, ending in `.json`
+    :type config_dir: os.PathLike
+    :param output_dir: directory to write the results to
+    :type output_dir: os.PathLike
+    :param max_workers: maximum number of concurrent API requests
+    :type max_workers: int
+    :param planner: if given, used to skip redundant requests
+    :type planner: Optional[cowin_cowboy.pub_checker.QueryPlanner]
+    :return: exit status
+    :rtype: int
+    """
+    configs = []
+    for file_name in sorted(listdir(config_dir)):
+        if not file_name.endswith(".json"):
+            continue
+        config = read_json_file(path.join(config_dir, file_name))
+        if config is None or "locations" not in config:
+            logger.error("Skipping config file '{}'".format(file_name))
+            continue
+        locations = config["locations"]
+        if "near" in locations:
+            if planner is None:
+                logger.error(
+                    "\"near\" locations in config '{}' need the query planner".format(
+                        file_name
+                    )
+                )
+                continue
+            try:
+                locations = planner.expand(locations)
+            except ValueError as e:
+                logger.error(
+                    "Invalid locations in config '{}': {}".format(file_name, e)
+                )
+                continue
+        filters = None
+        if "filters" in config:
+            try:
+                filters = compile_filters(config["filters"])
+            except ValueError as e:
+                logger.error("Invalid filters in config '{}': {}".format(file_name, e))
+                continue
+        weeks = max(1, config.get("weeks", 1))
+        configs.append((file_name, locations, weeks, filters))
+    if not configs:
+        logger.error("No valid config file found in '{}'".format(config_dir))
+        return 1
+
+    locations = union_locations(locations for _, locations, _, _ in configs)
+    date_today = date.today()
+    date_objs = [
+        date_today + timedelta(weeks=i)
+        for i in range(max(weeks for _, _, weeks, _ in configs))
+    ]
+    logger.info("Checking API for {} configs...".format(len(configs)))
+    fetched = {}
+    for location, date_str, result in iter_location_results(
+        date_objs, locations, max_workers=max_workers, planner=planner
+    ):
+        fetched.setdefault(date_str, {})[location] = result
+
+    if planner is None:
+        planner = QueryPlanner()
+    makedirs(output_dir, exist_ok=True)
+    for file_name, locations, weeks, filters in configs:
+        store = CenterStore()
+        for date_obj in date_objs[:weeks]:
+            date_results = fetched.get(date_to_string(date_obj), {})
+            for key in ("pincodes", "district_ids", "center_ids"):
+                for location_id in locations.get(key, []):
+                    store.merge(
+                        planner.covered_results((key, location_id), date_results)
+                    )
+        available_centers = store.centers
+        if filters is not None:
+            available_centers = filter_available_centers(available_centers, filters)
+        with open(path.join(output_dir, file_name), "w") as output_fp:
+            output_fp.write(dumps(available_centers, sort_keys=True, indent=2))
+        logger.info(
+            "{} centers are available for '{}'".format(
+                len(available_centers), file_name
+            )
+        )
+    return 0
+
+
+def start_notifier(notify_config, filters=None, planner=None):
+    """Starts alerting the subscribers of the `"notify"` array of the
+    config about new sessions, in the background.
+
+    :param notify_config: the subscribers, see `Subscriber.from_config`
+    :type notify_config: list[dict]
+    :param filters: filters of the subscribers without their own
+    :type filters: Optional[cowin_cowboy.filters.CompiledFilters]
+    :param planner: if given, its districts of the centers are used to
+            alert subscribers limited to districts
+    :type planner: Optional[cowin_cowboy.pub_checker.QueryPlanner]
+    :raises ValueError: if some subscriber is invalid
+    :rtype: cowin_cowboy.notify.Notifier
+    """
+    if not isinstance(notify_config, list):
+        raise ValueError("notify should be an array")
+    subscribers = [
+        Subscriber.from_config(subscriber_config, filters)
+        for subscriber_config in notify_config
+    ]
+    center_districts = None
+    if planner is not None:
+        center_districts = planner.center_districts
+    elif any(
+        subscriber.locations and subscriber.locations.get("district_ids")
+        for subscriber in subscribers
+    ):
+        logger.warning(
+            "Subscribers limited to districts need the query planner, "
+            "they will not be alerted"
+        )
+    notifier = Notifier(subscribers, center_districts=center_districts)
+    notifier.start()
+    return notifier
+
+
+def stop_notifier(notifier):
+    """Delivers the pending alerts of the notifier, if any, and stops it."""
+    if notifier is None:
+        return
+    notifier.stop()
+    logger.info(
+        "Delivered {} alerts, {} failed".format(notifier.delivered, notifier.failed)
+    )
+
+
+def start_booker(booking_config):
+    """Creates a booker from the `"booking"` table of the config, and
+    keeps its connections to the API warm.
+
+    :param booking_config: the booking table of the config
+    :type booking_config: dict
+    :raises ValueError: if some field is invalid
+    :rtype: cowin_cowboy.booking.Booker
+    """
+    booker = Booker.from_config(booking_config, pub_api_session.base_url)
+    if not booker.session.warm():
+        logger.warning("Booking connections could not be warmed")
+    booker.session.keep_warm()
+    return booker
+
+
+def finish_booking(booker, timeout=None):
+    """Waits for the bookings in flight, if any, prints the booked
+    appointment to stderr, and closes the booker.
+    """
+    if booker is None:
+        return
+    result = booker.wait(timeout)
+    if result is not None:
+        print(
+            "{} (confirmation {})".format(result, result.confirmation),
+            file=sys.stderr,
+            flush=True,
+        )
+    else:
+        logger.info("No appointment booked, in {} attempts".format(booker.attempts))
+    booker.close()
+
+
+def run_service(args, planner=None):
+    """Answers queries sent by `cowboy_client.py` until interrupted,
+    keeping the API session and the latest results in memory.
+
+    :param planner: if given, used to skip redundant requests
+    :type planner: Optional[cowin_cowboy.pub_checker.QueryPlanner]
+    """
+    service = ScanService(max_workers=args.jobs, planner=planner)
+    server = make_server(service, args.host, args.port, args.socket)
+    if args.socket is not None:
+        logger.info("Serving queries on '{}'".format(args.socket))
+    else:
+        logger.info("Serving queries on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopped serving")
+    finally:
+        server.server_close()
+
+
+def shard_authkey():
+    """Returns the secret shared by the shard coordinator and its
+    workers, from the environment.
+
+    :raises ValueError: if it is not set
+    :rtype: bytes
+    """
+    authkey = environ.get(SHARD_KEY_VAR)
+    if not authkey:
+        raise ValueError("{} should be set to a shared secret".format(SHARD_KEY_VAR))
+    return authkey.encode()
+
+
+def report_stats(args):
+    """Prints the collected metrics to stderr with `--stats`, and writes
+    them in the Prometheus text format with `--prometheus`.
+    """
+    if args.stats:
+        print(metrics.summary(), file=sys.stderr, flush=True)
+    if args.prometheus is not None:
+        metrics.write_prometheus(args.prometheus)
+
+
 if __name__ == "__main__":
     parser = ArgumentParser(
         prog="cowboy.py",
@@ -64,11 +451,173 @@ if __name__ == "__main__":
         help="set logging verbosity (defaults to ERROR)",
     )
     parser.add_argument("-c", "--config", help="path to custom config file")
+    parser.add_argument(
+        "--config-dir",
+        metavar="DIR",
+        help="check for every config file in DIR, sharing the API requests",
+    )
+    parser.add_argument(
+        "--output-dir",
+        metavar="DIR",
+        help="directory to write the results of --config-dir to",
+    )
     parser.add_argument(
         "--config-path",
         action="store_true",
         help="prints expected path of config file and exits",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help="maximum number of concurrent API requests (defaults to {})".format(
+            DEFAULT_MAX_WORKERS
+        ),
+    )
+
+    parser.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        help="keep polling the API, printing the centers whenever they change",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=30.0,
+        help="shortest polling interval in seconds, with --watch (defaults to 30)",
+    )
+    parser.add_argument(
+        "--max-interval",
+        type=float,
+        default=1800.0,
+        help="longest polling interval in seconds, with --watch (defaults to 1800)",
+    )
+
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="keep running, and answer the queries of cowboy_client.py",
+    )
+    parser.add_argument(
+        "--host",
+        default=DEFAULT_HOST,
+        help="address to serve on, with --serve (defaults to {})".format(DEFAULT_HOST),
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_PORT,
+        help="port to serve on, with --serve (defaults to {})".format(DEFAULT_PORT),
+    )
+    parser.add_argument(
+        "--socket",
+        metavar="PATH",
+        help="serve on a Unix socket at PATH instead, with --serve",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="decode district responses one center at a time, filtering them "
+        "as they arrive",
+    )
+    parser.add_argument(
+        "--columnar",
+        action="store_true",
+        help="store sessions in columns and filter them with vector masks "
+        "(faster with NumPy installed)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=[FORMAT_JSON, FORMAT_NDJSON],
+        default=FORMAT_JSON,
+        help="print one indented JSON document, or one compact JSON line per "
+        "session as soon as it is found (defaults to json)",
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="print only the sessions which are new, changed or removed since "
+        "the previous scan",
+    )
+    parser.add_argument(
+        "--snapshot",
+        metavar="PATH",
+        help="path of the snapshot database used by --delta",
+    )
+    parser.add_argument(
+        "--cache-file",
+        metavar="PATH",
+        help="keep API responses in a database at PATH, so that the next run "
+        "starts with them",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print request latency, decode and stage timings to stderr",
+    )
+    parser.add_argument(
+        "--prometheus",
+        metavar="PATH",
+        help="write the metrics to PATH in the Prometheus text format",
+    )
+    parser.add_argument(
+        "--adaptive-weeks",
+        action="store_true",
+        help="learn which weeks of every location rarely have sessions, and "
+        "only check them once in a while",
+    )
+    parser.add_argument(
+        "--book",
+        action="store_true",
+        help='book the first session which opens up, with the "booking" table '
+        "of the config",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="split the locations into N shards, each scanned by its own "
+        "process (defaults to 1)",
+    )
+    parser.add_argument(
+        "--shard-queue",
+        metavar="HOST:PORT",
+        help="serve the shards on HOST:PORT to --shard-worker processes, "
+        "instead of scanning them locally",
+    )
+    parser.add_argument(
+        "--shard-worker",
+        metavar="HOST:PORT",
+        help="scan the shards served by a --shard-queue at HOST:PORT, until "
+        "it is done",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="PATH",
+        help="record every API response, with its timing, to a compressed "
+        "log at PATH",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="PATH",
+        help="replay the responses recorded at PATH instead of querying the "
+        "API, printing the centers of every recorded scan",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        help="how many times faster than recorded to replay, 0 for as fast as "
+        "possible (defaults to 1)",
+    )
+    parser.add_argument(
+        "--no-plan",
+        action="store_true",
+        help="query every configured location, even if covered by another one",
+    )
 
     args = parser.parse_args()
 
@@ -79,6 +628,61 @@ if __name__ == "__main__":
         sys.exit(1)
     logging.basicConfig(level=numeric_level)
 
+    if args.shard_worker is not None:
+        try:
+            scanned = run_shard_worker(
+                parse_address(args.shard_worker), shard_authkey()
+            )
+        except ValueError as e:
+            logger.error("Invalid --shard-worker: {}".format(e))
+            sys.exit(1)
+        except OSError as e:
+            logger.error("Could not reach the shard coordinator: {}".format(e))
+            sys.exit(1)
+        logger.info("Scanned {} shards".format(scanned))
+        sys.exit(0)
+
+    shard_address = None
+    shard_key = None
+    if args.shard_queue is not None:
+        try:
+            shard_address = parse_address(args.shard_queue)
+            shard_key = shard_authkey()
+        except ValueError as e:
+            logger.error("Invalid --shard-queue: {}".format(e))
+            sys.exit(1)
+    sharded = args.shards > 1 or shard_address is not None
+    if sharded and (args.watch or args.columnar):
+        logger.error(
+            "--shards and --shard-queue cannot be used with --watch or --columnar"
+        )
+        sys.exit(1)
+    if args.replay is not None and (
+        sharded
+        or args.watch
+        or args.columnar
+        or args.serve
+        or args.config_dir is not None
+        or args.book
+        or args.record is not None
+    ):
+        logger.error(
+            "--replay cannot be used with --shards, --watch, --columnar, --serve, "
+            "--config-dir, --book or --record"
+        )
+        sys.exit(1)
+    if sharded and args.record is not None:
+        logger.error("--record cannot be used with --shards or --shard-queue")
+        sys.exit(1)
+
+    if args.record is not None:
+        try:
+            pub_api_session.recorder = TrafficRecorder(args.record)
+        except OSError as e:
+            logger.error("Could not record to '{}': {}".format(args.record, e))
+            sys.exit(1)
+        atexit.register(pub_api_session.recorder.close)
+
     conf_file = args.config
     if conf_file is None:
         conf_dir = user_config_dir("cowin-cowboy", "Colocasian")
@@ -88,40 +692,306 @@ if __name__ == "__main__":
         logger.info("Printing expected path of config file")
         print(conf_file)
         sys.exit(0)
+
+    planner = None
+    planner_file = path.join(
+        user_cache_dir("cowin-cowboy", "Colocasian"), "planner.json"
+    )
+    if not args.no_plan:
+        planner = QueryPlanner.load(planner_file)
+
+    horizon = None
+    horizon_file = path.join(
+        user_cache_dir("cowin-cowboy", "Colocasian"), "horizon.json"
+    )
+    if args.adaptive_weeks:
+        horizon = ScanHorizon.load(horizon_file)
+
+    def save_state():
+        if planner is not None and planner.changed:
+            planner.save(planner_file)
+        if horizon is not None and horizon.changed:
+            horizon.save(horizon_file)
+            logger.info("Skipped {} rarely open weeks".format(horizon.skipped))
+
+    # One-shot scans end soon enough not to need the rate limit, unless the
+    # config sets one
+    if args.watch or args.serve:
+        pub_api_session.limiter = RateLimiter()
+
+    if args.serve:
+        if args.cache_file is not None:
+            pub_api_session.cache = PersistentResponseCache(args.cache_file)
+        else:
+            pub_api_session.cache = ResponseCache()
+        run_service(args, planner)
+        save_state()
+        report_stats(args)
+        sys.exit(0)
+
+    if args.config_dir is not None:
+        if args.output_dir is None:
+            logger.error("--config-dir requires --output-dir")
+            sys.exit(1)
+        if args.cache_file is not None:
+            pub_api_session.cache = PersistentResponseCache(args.cache_file)
+        status = scan_config_dir(args.config_dir, args.output_dir, args.jobs, planner)
+        save_state()
+        report_stats(args)
+        sys.exit(status)
+
     logger.info("Parsing config file '{}'...".format(conf_file))
     config = read_json_file(conf_file)
 
-    if config is not None:
-        available_centers = {}
+    if config is None:
+        logger.error(
+            "Error while trying to find/parse config file at '{}'".format(conf_file)
+        )
+        sys.exit(1)
+
+    if "locations" not in config:
+        logger.error('"locations" key not found in config')
+        sys.exit(1)
+    locations = config["locations"]
+    weeks_to_check = max(1, config.get("weeks", 1))
 
-        if "locations" in config:
-            locations = config["locations"]
-            weeks_to_check = max(1, config.get("weeks", 1))
-            date_today = date.today()
+    if "near" in locations:
+        if planner is None:
+            logger.error('"near" locations need the query planner, drop --no-plan')
+            sys.exit(1)
+        try:
+            parse_areas(locations["near"])
+        except ValueError as e:
+            logger.error("Invalid locations in config: {}".format(e))
+            sys.exit(1)
+
+    filters = None
+    if "filters" in config:
+        try:
+            filters = compile_filters(config.get("filters"))
+        except ValueError as e:
+            logger.error("Invalid filters in config: {}".format(e))
+            sys.exit(1)
+    else:
+        logger.warning('No "filters" field found in config')
 
-            logger.info("Checking API for available centers...")
-            for i in range(0, weeks_to_check):
-                slots_this_week = check_available_slots(
-                    date_today + timedelta(weeks=i), locations
+    if "cache" in config or args.cache_file is not None:
+        try:
+            if args.cache_file is not None:
+                pub_api_session.cache = PersistentResponseCache.from_config(
+                    config.get("cache", {}), file_path=args.cache_file
                 )
-                merge_center_dicts(available_centers, slots_this_week)
+            else:
+                pub_api_session.cache = ResponseCache.from_config(config["cache"])
+        except ValueError as e:
+            logger.error("Invalid cache in config: {}".format(e))
+            sys.exit(1)
+
+    if "network" in config:
+        try:
+            pub_api_session.policy = NetworkPolicy.from_config(config["network"])
+        except ValueError as e:
+            logger.error("Invalid network in config: {}".format(e))
+            sys.exit(1)
+
+    if "rate_limit" in config:
+        try:
+            pub_api_session.limiter = RateLimiter.from_config(config["rate_limit"])
+        except ValueError as e:
+            logger.error("Invalid rate_limit in config: {}".format(e))
+            sys.exit(1)
+
+    booker = None
+    if args.book:
+        if "booking" not in config:
+            logger.error('"booking" key not found in config')
+            sys.exit(1)
+        try:
+            booker = start_booker(config["booking"])
+        except ValueError as e:
+            logger.error("Invalid booking in config: {}".format(e))
+            sys.exit(1)
+
+    notifier = None
+    if "notify" in config:
+        try:
+            notifier = start_notifier(config["notify"], filters, planner)
+        except (ValueError, OSError) as e:
+            logger.error("Invalid notify in config: {}".format(e))
+            sys.exit(1)
+
+    # Booking goes first, as every millisecond counts there
+    update_hooks = [
+        hook.submit_updates for hook in (booker, notifier) if hook is not None
+    ]
+    on_update = None
+    if update_hooks:
+
+        def on_update(store, updated):
+            for hook in update_hooks:
+                hook(store, updated)
+
+    center_filter = None
+    if args.stream and filters is not None:
+        if on_update is None:
+            center_filter = filters.filter_center
         else:
-            logger.error('"locations" key not found in config')
+            # Subscribers and bookings have filters of their own, so the
+            # hooks are given every session, and the output filtered after
+            logger.info("Not filtering responses as they arrive, for the hooks")
+
+    snapshot = None
+    coverage = None
+    if args.delta:
+        snapshot_file = args.snapshot
+        if snapshot_file is None:
+            snapshot_file = path.join(
+                user_data_dir("cowin-cowboy", "Colocasian"), "snapshot.sqlite3"
+            )
+        snapshot = SnapshotStore(snapshot_file)
+        coverage = ScanCoverage()
+
+    if args.replay is not None:
+        logger.info("Replaying '{}'...".format(args.replay))
+        try:
+            for _, available_centers in replay_traffic(
+                args.replay, args.replay_speed, filters, args.jobs, on_update, coverage
+            ):
+                print_centers(available_centers, snapshot, args.format, coverage)
+        except (OSError, ValueError) as e:
+            logger.error("Could not replay '{}': {}".format(args.replay, e))
             sys.exit(1)
+        stop_notifier(notifier)
+        report_stats(args)
+        sys.exit(0)
 
-        if "filters" in config:
-            filters = config.get("filters")
+    if args.watch:
+        poller = AdaptivePoller(
+            locations,
+            weeks_to_check,
+            min_interval=args.interval,
+            max_interval=args.max_interval,
+            max_workers=args.jobs,
+            planner=planner,
+            center_filter=center_filter,
+            horizon=horizon,
+            on_update=on_update,
+        )
+
+        def on_cycle(poller, report):
+            print_cycle(poller, report, filters, snapshot, args.format)
+            save_state()
+            if args.prometheus is not None:
+                metrics.write_prometheus(args.prometheus)
+            # Nothing left to watch for once booked
+            return booker is None or not booker.booked
+
+        logger.info("Watching API for available centers...")
+        try:
+            poller.run(on_cycle)
+        except KeyboardInterrupt:
+            logger.info("Stopped watching")
+        finish_booking(booker)
+        stop_notifier(notifier)
+        report_stats(args)
+        sys.exit(0)
+
+    logger.info("Checking API for available centers...")
+    if (
+        args.format == FORMAT_NDJSON
+        and snapshot is None
+        and not args.columnar
+        and not sharded
+    ):
+        date_today = date.today()
+        printed = stream_sessions(
+            [date_today + timedelta(weeks=i) for i in range(weeks_to_check)],
+            locations,
+            args.jobs,
+            planner,
+            filters,
+            horizon,
+            on_update,
+        )
+        save_state()
+        finish_booking(booker)
+        stop_notifier(notifier)
+        logger.info("{} sessions are available".format(printed))
+        report_stats(args)
+        sys.exit(0)
+
+    if args.columnar:
+        date_today = date.today()
+        table = SessionTable()
+        store = CenterStore()
+        for _, _, result in iter_location_results(
+            [date_today + timedelta(weeks=i) for i in range(weeks_to_check)],
+            locations,
+            max_workers=args.jobs,
+            planner=planner,
+            center_filter=center_filter,
+            horizon=horizon,
+            coverage=coverage,
+        ):
+            table.extend(result)
+            if on_update is not None:
+                updated = store.merge(result)
+                if updated:
+                    on_update(store, updated)
+        save_state()
+        if filters is not None:
             logger.info("Filtering centers according to info")
-            available_centers = filter_available_centers(available_centers, filters)
+            available_centers = table.filter_centers(filters)
         else:
-            logger.warning('No "filters" field found in config')
-
-        print(dumps(available_centers, sort_keys=True, indent=2))
-        logger.info("{} centers are available".format(len(available_centers)))
+            available_centers = table.to_centers()
+    elif sharded:
+        if horizon is not None:
+            logger.warning("--adaptive-weeks is not used with shards")
+        try:
+            available_centers = check_available_slots_sharded(
+                date.today(),
+                weeks_to_check,
+                locations,
+                args.shards,
+                max_workers=args.jobs,
+                filters=filters,
+                rate_limit=config.get("rate_limit"),
+                network=config.get("network"),
+                planner=planner,
+                on_update=on_update,
+                address=shard_address,
+                authkey=shard_key,
+                coverage=coverage,
+            )
+        except TimeoutError as e:
+            logger.error("Could not scan the shards: {}".format(e))
+            sys.exit(1)
+        save_state()
+        if filters is not None:
+            logger.info("Filtering centers according to info")
+            available_centers = filter_available_centers(available_centers, filters)
     else:
-        logger.error(
-            "Error while trying to find/parse config file at '{}'".format(conf_file)
+        available_centers = check_available_slots_for_weeks(
+            date.today(),
+            weeks_to_check,
+            locations,
+            max_workers=args.jobs,
+            planner=planner,
+            center_filter=center_filter,
+            horizon=horizon,
+            on_update=on_update,
+            coverage=coverage,
         )
-        sys.exit(1)
+        save_state()
+        if filters is not None:
+            logger.info("Filtering centers according to info")
+            available_centers = filter_available_centers(available_centers, filters)
+
+    finish_booking(booker)
+    stop_notifier(notifier)
+    print_centers(available_centers, snapshot, args.format, coverage)
+    if pub_api_session.cache is not None:
+        logger.info("Response cache: {}".format(pub_api_session.cache.stats()))
+    report_stats(args)
 
     sys.exit(0)
@@ -0,0 +1,126 @@
+# cowboy_client.py -- queries a running `cowboy.py --serve`
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Only the standard library is imported, so that every query starts fast
+
+from argparse import ArgumentParser
+from http.client import HTTPConnection
+from json import dumps, load, loads, JSONDecodeError
+import socket
+import sys
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8637
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """An HTTP connection over a Unix socket."""
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def send_query(connection, query):
+    """Sends a query to the service.
+
+    :param connection: connection to the service
+    :type connection: http.client.HTTPConnection
+    :param query: the query, with the same fields as the config file
+    :type query: dict
+    :return: HTTP status code, and the decoded response
+    :rtype: tuple[int, dict]
+    """
+    connection.request(
+        "POST",
+        "/query",
+        body=dumps(query).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    response = connection.getresponse()
+    return response.status, loads(response.read().decode())
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        prog="cowboy_client.py",
+        description="Checks for available vaccination slots via a running "
+        "`cowboy.py --serve`",
+    )
+    parser.add_argument(
+        "-c", "--config", required=True, help="path to the config file to query"
+    )
+    parser.add_argument(
+        "--host",
+        default=DEFAULT_HOST,
+        help="address of the service (defaults to {})".format(DEFAULT_HOST),
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_PORT,
+        help="port of the service (defaults to {})".format(DEFAULT_PORT),
+    )
+    parser.add_argument(
+        "--socket", metavar="PATH", help="Unix socket of the service, if any"
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        help="seconds the results may be reused for (defaults to the service's)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60.0,
+        help="seconds to wait for the answer (defaults to 60)",
+    )
+    args = parser.parse_args()
+
+    try:
+        with open(args.config) as conf_fp:
+            query = load(conf_fp)
+    except (IOError, JSONDecodeError) as e:
+        print(
+            "Could not read config file '{}': {}".format(args.config, e),
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    if args.max_age is not None:
+        query["max_age"] = args.max_age
+
+    if args.socket is not None:
+        connection = UnixHTTPConnection(args.socket, timeout=args.timeout)
+    else:
+        connection = HTTPConnection(args.host, args.port, timeout=args.timeout)
+    try:
+        status, answer = send_query(connection, query)
+    except (OSError, ValueError) as e:
+        print("Could not query the service: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        connection.close()
+
+    if status != 200:
+        print("Error: {}".format(answer.get("error", status)), file=sys.stderr)
+        sys.exit(1)
+    print(dumps(answer, sort_keys=True, indent=2), flush=True)
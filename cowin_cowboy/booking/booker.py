@@ -0,0 +1,395 @@
+# booking/booker.py -- books the best session as soon as it opens
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["Booker", "BookingResult"]
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from json import JSONDecodeError
+from logging import getLogger
+from threading import Event, Lock
+from time import perf_counter
+
+from requests import Request
+from requests.exceptions import RequestException
+
+from cowin_cowboy.booking.session import SCHEDULE_ENDPOINT, BookingSession
+from cowin_cowboy.filters import CompiledFilters, compile_filters
+from cowin_cowboy.utils import json_backend
+from cowin_cowboy.utils.stats import metrics
+
+_logger = getLogger(__name__)
+
+# Number of candidate sessions booked at once
+DEFAULT_RACE = 3
+
+
+def _close_response(session_id, future):
+    """Closes the response of a booking which lost the race, warning if
+    it was confirmed too.
+    """
+    if future.cancelled() or future.exception() is not None:
+        return
+    response = future.result()
+    if response.ok:
+        metrics.inc("booking_extra_confirmations_total")
+        _logger.warning(
+            "Booking session {} was confirmed too: {}".format(
+                session_id, response.text[:200]
+            )
+        )
+    response.close()
+
+
+def _date_key(session):
+    # Sessions dates are in DD-MM-YYYY
+    return tuple(reversed(session.get("date", "").split("-")))
+
+
+def _rank(candidates, capacity):
+    """Sorts candidates, tuples starting with the center and the session,
+    the earliest first, then the one with the most capacity.
+    """
+    return sorted(
+        candidates,
+        key=lambda candidate: (_date_key(candidate[1]), -capacity(candidate[1])),
+    )
+
+
+class BookingResult:
+    """The appointment booked by a `Booker`."""
+
+    def __init__(self, center_id, session_id, slot, confirmation, latency):
+        self.center_id = center_id
+        self.session_id = session_id
+        self.slot = slot
+        self.confirmation = confirmation
+        self.latency = latency
+
+    def __str__(self):
+        return "Booked {} at center {}, session {}, in {:.3f}s".format(
+            self.slot, self.center_id, self.session_id, self.latency
+        )
+
+
+class Booker:
+    """Books an appointment for a set of beneficiaries, in the first
+    session which opens up and passes the filters.
+
+    Booking requests are built and serialised as soon as a session
+    which could match is seen, even without capacity, so that nothing
+    but sending them is left once it opens up. When several sessions
+    open up at once, the best `race` of them (the earliest, then the one
+    with the most capacity) are booked concurrently over the warm
+    connections of the `BookingSession`, and the first confirmation wins.
+    The API books each beneficiary only once per dose, so the bookings
+    which lose the race are rejected.
+
+    Sessions which open up while bookings are in flight are kept, and
+    booked next if none of those is confirmed, until one is or none is
+    left. A session is dropped once tried, or once it closes again.
+    """
+
+    def __init__(self, session, beneficiaries, dose=1, filters=None, race=DEFAULT_RACE):
+        """
+        :param session: the session to book through
+        :type session: cowin_cowboy.booking.BookingSession
+        :param beneficiaries: reference IDs of the beneficiaries to book
+        :type beneficiaries: list[str]
+        :param dose: the dose to book, 1 or 2
+        :type dose: int
+        :param filters: the sessions to book, as in the config
+        :type filters: Optional[dict | cowin_cowboy.filters.CompiledFilters]
+        :param race: number of sessions booked at once
+        :type race: int
+        :raises ValueError: if some filter has an invalid value
+        """
+        self.session = session
+        self.beneficiaries = list(beneficiaries)
+        self.dose = dose
+        self.filters = compile_filters({} if filters is None else filters)
+        # The filters without the capacities, to prepare closed sessions
+        self._eligible = CompiledFilters(
+            0,
+            age=self.filters.age,
+            vaccines=self.filters.vaccines,
+            fee_type=self.filters.fee_type,
+            areas=self.filters.areas,
+        )
+        self.race = max(1, race)
+        self.result = None
+        self.attempts = 0
+        self.token_rejected = False
+        self._prepared = {}
+        # Session ID -> center, session and time found of the open sessions
+        # not tried yet
+        self._pending = {}
+        self._lock = Lock()
+        self._in_flight = False
+        self._idle = Event()
+        self._idle.set()
+        self._executor = ThreadPoolExecutor(self.race + 1)
+
+    @classmethod
+    def from_config(cls, booking_config, base_url=None):
+        """Creates a booker from the `"booking"` table of the config,
+        which has the `"token"` of a login and the `"beneficiaries"` to
+        book, and optionally the `"dose"`, the `"race"` and `"filters"`
+        (defaulting to no filter).
+
+        :param booking_config: the booking table of the config
+        :type booking_config: dict
+        :param base_url: base URL of the API, defaults to the Co-WIN API
+        :type base_url: Optional[str]
+        :raises ValueError: if some field has an invalid value
+        :rtype: Booker
+        """
+        if not isinstance(booking_config, dict):
+            raise ValueError("booking should be a table")
+        token = booking_config.get("token")
+        if not isinstance(token, str) or not token:
+            raise ValueError('"token" should be a non-empty string')
+        beneficiaries = booking_config.get("beneficiaries")
+        if (
+            not isinstance(beneficiaries, list)
+            or not beneficiaries
+            or not all(isinstance(b, str) for b in beneficiaries)
+        ):
+            raise ValueError('"beneficiaries" should be a non-empty array of strings')
+        dose = booking_config.get("dose", 1)
+        if dose not in (1, 2):
+            raise ValueError('"dose" should be 1 or 2')
+        race = booking_config.get("race", DEFAULT_RACE)
+        if not isinstance(race, int) or isinstance(race, bool) or race < 1:
+            raise ValueError('"race" should be a positive integer')
+        kwargs = {} if base_url is None else {"base_url": base_url}
+        session = BookingSession(token, pool_size=race, **kwargs)
+        return cls(session, beneficiaries, dose, booking_config.get("filters"), race)
+
+    @property
+    def booked(self):
+        """Whether an appointment was booked."""
+        return self.result is not None
+
+    def capacity(self, session):
+        """Returns the capacity of the session for the dose to book."""
+        capacity = session.get("available_capacity_dose{}".format(self.dose))
+        if capacity is None:
+            capacity = session.get("available_capacity", 0)
+        return capacity
+
+    def is_candidate(self, center, session):
+        """Whether the session could be booked if it had capacity."""
+        return (
+            bool(session.get("slots"))
+            and self._eligible.is_valid_center(center)
+            and self._eligible.is_valid_session(session)
+        )
+
+    def is_open(self, center, session):
+        """Whether the session can be booked now."""
+        return (
+            self.capacity(session) >= len(self.beneficiaries)
+            and self.filters.is_valid_center(center)
+            and self.filters.is_valid_session(session)
+        )
+
+    def prepare(self, center, session):
+        """Builds and serialises the booking request of a session, in the
+        earliest slot, unless done already.
+
+        :param center: details of the center of the session
+        :type center: dict
+        :param session: the session
+        :type session: dict
+        :return: the center ID, session ID, slot and prepared request
+        :rtype: tuple[int, str, str, requests.PreparedRequest]
+        """
+        session_id = session["session_id"]
+        prepared = self._prepared.get(session_id)
+        if prepared is not None:
+            return prepared
+        slot = session["slots"][0]
+        body = json_backend.dumps(
+            {
+                "center_id": center["center_id"],
+                "session_id": session_id,
+                "beneficiaries": self.beneficiaries,
+                "dose": self.dose,
+                "slot": slot,
+            }
+        )
+        request = self.session.prepare_request(
+            Request(
+                "POST",
+                self.session.create_url(SCHEDULE_ENDPOINT),
+                data=body.encode(),
+                headers={"Content-Type": "application/json"},
+            )
+        )
+        prepared = self._prepared[session_id] = (
+            center["center_id"],
+            session_id,
+            slot,
+            request,
+        )
+        return prepared
+
+    def _attempt(self, request):
+        labels = {"status": "error"}
+        try:
+            response = self.session.send(request.copy(), timeout=self.session.timeout)
+        except RequestException:
+            metrics.inc("booking_attempts_total", labels)
+            raise
+        metrics.inc("booking_attempts_total", {"status": response.status_code})
+        return response
+
+    def book(self, candidates, found_at=None):
+        """Books the best sessions of the candidates at once, and returns
+        the first confirmed booking.
+
+        :param candidates: `(center, session)` tuples of open sessions
+        :type candidates: list[tuple[dict, dict]]
+        :param found_at: `time.perf_counter` time the sessions were
+                found, defaults to now
+        :type found_at: Optional[float]
+        :return: the booking, or `None` if none was confirmed
+        :rtype: Optional[BookingResult]
+        """
+        if found_at is None:
+            found_at = perf_counter()
+        ranked = _rank(candidates, self.capacity)[: self.race]
+        prepared = [self.prepare(center, session) for center, session in ranked]
+        futures = {
+            self._executor.submit(self._attempt, request): (center_id, session_id, slot)
+            for center_id, session_id, slot, request in prepared
+        }
+        self.attempts += len(futures)
+
+        for future in as_completed(futures):
+            center_id, session_id, slot = futures[future]
+            try:
+                response = future.result()
+            except RequestException as e:
+                _logger.warning("Could not book session {}: {}".format(session_id, e))
+                continue
+            if not response.ok:
+                _logger.info(
+                    "Booking session {} failed with {}: {}".format(
+                        session_id, response.status_code, response.text[:200]
+                    )
+                )
+                if response.status_code == 401 and not self.token_rejected:
+                    _logger.error("Booking token was rejected, log in again")
+                    self.token_rejected = True
+                response.close()
+                continue
+            try:
+                data = json_backend.loads(response.content)
+            except JSONDecodeError:
+                data = {}
+            confirmation = data.get("appointment_confirmation_no") or data.get(
+                "appointment_id"
+            )
+            latency = perf_counter() - found_at
+            metrics.observe("booking_seconds", latency)
+            for other, (_, other_session_id, _) in futures.items():
+                if other is not future:
+                    other.add_done_callback(partial(_close_response, other_session_id))
+            return BookingResult(center_id, session_id, slot, confirmation, latency)
+        return None
+
+    def _book_in_background(self):
+        result = None
+        while True:
+            with self._lock:
+                if result is not None or self.token_rejected or not self._pending:
+                    self._in_flight = False
+                    if result is not None and self.result is None:
+                        self.result = result
+                        _logger.info(str(result))
+                    self._idle.set()
+                    return
+                ranked = _rank(self._pending.values(), self.capacity)[: self.race]
+                for _, session, _ in ranked:
+                    del self._pending[session["session_id"]]
+            try:
+                result = self.book(
+                    [(center, session) for center, session, _ in ranked],
+                    min(found_at for _, _, found_at in ranked),
+                )
+            except Exception:
+                _logger.exception("Booking failed")
+                result = None
+
+    def submit_updates(self, store, updated):
+        """Prepares the bookings of the new or changed sessions which
+        could be booked, and books the open ones right away, in the
+        background, or once the bookings in flight fail. Takes the
+        arguments of the `on_update` callback of
+        `check_available_slots_for_weeks`.
+
+        :param store: the store the sessions were merged into
+        :type store: cowin_cowboy.utils.center_store.CenterStore
+        :param updated: the new or changed sessions
+        :type updated: list[tuple[int, dict]]
+        """
+        found_at = perf_counter()
+        if self.result is not None or self.token_rejected:
+            return
+        opened = {}
+        closed = []
+        for center_id, session in updated:
+            center = store[center_id]
+            try:
+                if self.is_candidate(center, session):
+                    self.prepare(center, session)
+                    if self.is_open(center, session):
+                        opened[session["session_id"]] = (center, session, found_at)
+                        continue
+                closed.append(session.get("session_id"))
+            except (KeyError, TypeError, IndexError):
+                _logger.debug("Invalid session details, not booking")
+        with self._lock:
+            for session_id in closed:
+                self._pending.pop(session_id, None)
+            for session_id, (center, session, found_at) in opened.items():
+                previous = self._pending.get(session_id)
+                if previous is not None:
+                    # Keeps when the session was first found open
+                    found_at = previous[2]
+                self._pending[session_id] = (center, session, found_at)
+            if not self._pending or self._in_flight or self.result is not None:
+                return
+            self._in_flight = True
+            self._idle.clear()
+        self._executor.submit(self._book_in_background)
+
+    def wait(self, timeout=None):
+        """Waits until the bookings in flight are done.
+
+        :param timeout: seconds to wait at most
+        :type timeout: Optional[float]
+        :return: the booking, if one was confirmed
+        :rtype: Optional[BookingResult]
+        """
+        self._idle.wait(timeout)
+        return self.result
+
+    def close(self):
+        self._executor.shutdown()
+        self.session.close()
@@ -0,0 +1,150 @@
+# booking/session.py -- authenticated session kept warm for booking
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["BookingSession"]
+
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from threading import Event, Thread
+from time import perf_counter
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from requests_toolbelt.sessions import BaseUrlSession
+from requests_toolbelt.cookies.forgetful import ForgetfulCookieJar
+
+from cowin_cowboy.pub_checker.config import (
+    API_URL,
+    CONNECT_TIMEOUT,
+    READ_TIMEOUT,
+    USER_AGENT,
+)
+from cowin_cowboy.utils.stats import metrics
+
+_logger = getLogger(__name__)
+
+BENEFICIARIES_ENDPOINT = "v2/appointment/beneficiaries"
+SCHEDULE_ENDPOINT = "v2/appointment/schedule"
+
+# Connections kept open to the API, one per request which may be raced
+DEFAULT_POOL_SIZE = 4
+# Seconds between two warmings, shorter than the idle timeout of the CDN
+DEFAULT_KEEP_WARM_INTERVAL = 30.0
+
+
+class BookingSession(BaseUrlSession):
+    """A session authenticated with the bearer token of a Co-WIN login,
+    which keeps a pool of connections to the API open (with their TLS
+    handshakes done), so that a booking request does not wait for one.
+
+    The token is not obtained here: logging in needs an OTP sent to the
+    phone of the user, so the token of an existing login has to be
+    given.
+    """
+
+    def __init__(
+        self,
+        token,
+        base_url=API_URL,
+        pool_size=DEFAULT_POOL_SIZE,
+        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+    ):
+        """
+        :param token: bearer token of a Co-WIN login
+        :type token: str
+        :param base_url: base URL of the API
+        :type base_url: str
+        :param pool_size: number of connections kept open
+        :type pool_size: int
+        :param timeout: seconds to wait for a connection and a response
+        :type timeout: tuple[float, float]
+        """
+        super(BookingSession, self).__init__(base_url=base_url)
+        self.pool_size = max(1, pool_size)
+        self.timeout = timeout
+        self.headers = {
+            "Accept": "application/json",
+            "Authorization": "Bearer {}".format(token),
+            "User-Agent": USER_AGENT,
+        }
+        self.cookies = ForgetfulCookieJar()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self._stop_warming = Event()
+        self._warm_thread = None
+
+    def _touch(self):
+        with metrics.timer("booking_warm_seconds"):
+            r = self.get(BENEFICIARIES_ENDPOINT, timeout=self.timeout)
+        r.close()
+        return r.status_code
+
+    def warm(self):
+        """Sends as many concurrent requests as connections in the pool,
+        so that all of them are open and authenticated when a booking is
+        sent. Also checks that the token is still accepted.
+
+        :return: whether every request succeeded with the token
+        :rtype: bool
+        """
+        start = perf_counter()
+        with ThreadPoolExecutor(self.pool_size) as executor:
+            futures = [executor.submit(self._touch) for _ in range(self.pool_size)]
+        ok = True
+        rejected = False
+        for future in futures:
+            try:
+                status_code = future.result()
+            except RequestException as e:
+                _logger.warning("Could not warm booking connection: {}".format(e))
+                ok = False
+                continue
+            if status_code in (401, 403):
+                rejected = True
+                ok = False
+        if rejected:
+            _logger.error("Booking token was rejected, log in again")
+        _logger.debug(
+            "Warmed {} booking connections in {:.3f}s".format(
+                self.pool_size, perf_counter() - start
+            )
+        )
+        return ok
+
+    def keep_warm(self, interval=DEFAULT_KEEP_WARM_INTERVAL):
+        """Warms the connections again every `interval` seconds in a
+        background thread, until the session is closed.
+
+        :param interval: seconds between two warmings
+        :type interval: float
+        """
+        if self._warm_thread is not None:
+            return
+
+        def run():
+            while not self._stop_warming.wait(interval):
+                self.warm()
+
+        self._warm_thread = Thread(target=run, name="booking-warmer", daemon=True)
+        self._warm_thread.start()
+
+    def close(self):
+        self._stop_warming.set()
+        if self._warm_thread is not None:
+            self._warm_thread.join()
+            self._warm_thread = None
+        super(BookingSession, self).close()
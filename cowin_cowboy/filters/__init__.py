@@ -14,12 +14,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-__all__ = ["filter_available_centers"]
+__all__ = [
+    "CompiledFilters",
+    "SessionTable",
+    "SubscriptionIndex",
+    "compile_filters",
+    "filter_available_centers",
+]
 
-from copy import deepcopy
 from logging import getLogger
 
-from cowin_cowboy.filters.checks import is_valid_center
+from cowin_cowboy.filters.compiled import CompiledFilters, compile_filters
+from cowin_cowboy.filters.columnar import SessionTable
+from cowin_cowboy.filters.matching import SubscriptionIndex
+from cowin_cowboy.utils.stats import metrics
 
 _logger = getLogger(__name__)
 
@@ -29,16 +37,17 @@ def filter_available_centers(centers, filters):
     Note: Even if `filters` is an empty dict, this function will remove
     all sessions with no available capacity.
 
+    The returned centers are copies with their own session lists, but
+    the sessions themselves are shared with `centers`.
+
     :param centers: the dictionary of center ID to center details
     :type centers: dict[int, dict]
-    :param filters: a dictionary containing all the required filters
-    :type filters: dict
+    :param filters: a dictionary containing all the required filters,
+            or filters already compiled with `compile_filters`
+    :type filters: dict | CompiledFilters
+    :raises ValueError: if some filter has an invalid value
     :return: dictionary of all centers which satisfy the given filters
     :rtype: dict
     """
-    filtered_centers = {
-        center_id: center
-        for center_id, center in deepcopy(centers).items()
-        if is_valid_center(center, filters)
-    }
-    return filtered_centers
+    with metrics.stage("filter"):
+        return compile_filters(filters).filter_centers(centers)
@@ -49,7 +49,7 @@ def is_valid_session(session, filters):
                 return False
             if (
                 "available_capacity_dose2" in session
-                and session["available_capacity_dose2"] < dose1
+                and session["available_capacity_dose2"] < dose2
             ):
                 return False
 
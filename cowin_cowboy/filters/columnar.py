@@ -0,0 +1,330 @@
+# columnar.py -- columnar table of sessions, filtered with vector masks
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["HAVE_NUMPY", "SessionTable"]
+
+from array import array
+from logging import getLogger
+from math import ceil, floor
+
+from cowin_cowboy.filters.compiled import compile_filters
+from cowin_cowboy.utils.center_store import refresh_capacity
+from cowin_cowboy.utils.stats import metrics
+
+try:
+    import numpy
+
+    HAVE_NUMPY = True
+except ImportError:
+    numpy = None
+    HAVE_NUMPY = False
+
+_logger = getLogger(__name__)
+
+# Marks a missing optional field in an integer column
+_MISSING = -(2**62)
+# Marks a capacity of an invalid type, below any minimum capacity
+_INVALID = _MISSING + 1
+
+
+def _capacity_column(session, key):
+    """Returns the column value of an optional capacity field, which
+    passes any minimum when missing, and fails them all when invalid,
+    like `CompiledFilters.is_valid_session`.
+    """
+    value = session.get(key)
+    if value is None:
+        return _MISSING
+    if not isinstance(value, (int, float)):
+        return _INVALID
+    return floor(value)
+
+
+def _min_age_column(session):
+    """Returns the column value of the minimum age of a session, which
+    fails any age filter when missing or invalid.
+    """
+    value = session.get("min_age_limit")
+    if not isinstance(value, (int, float)):
+        return _MISSING
+    return ceil(value)
+
+
+class SessionTable:
+    """Sessions stored as integer columns, one row per session, with
+    vaccine names, fee types and dates interned to integer codes. Rows
+    are filtered with vectorised masks using NumPy when it is installed,
+    and with a single pass over the columns otherwise.
+
+    The center details and sessions are kept as given, to convert the
+    rows which pass the filters back into a center details dict.
+    """
+
+    def __init__(self):
+        self._center_ids = []
+        self._centers = []
+        self._center_rows = {}
+        self._fee_codes = array("q")
+
+        self._sessions = []
+        self._session_rows = {}
+        self._center_index = array("q")
+        self._valid = array("b")
+        self._capacity = array("q")
+        self._dose1 = array("q")
+        self._dose2 = array("q")
+        self._min_age = array("q")
+        self._vaccine_codes = array("q")
+        self._date_codes = array("q")
+
+        self.vaccines = {}
+        self.fee_types = {}
+        self.dates = {}
+
+    @classmethod
+    def from_centers(cls, centers):
+        """Builds a table out of a center details dict.
+
+        :param centers: the dictionary of center ID to center details
+        :type centers: dict[int, dict]
+        :rtype: SessionTable
+        """
+        table = cls()
+        table.extend(centers)
+        return table
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @staticmethod
+    def _intern(codes, value):
+        if not isinstance(value, str):
+            return _MISSING
+        value = value.upper()
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+        return code
+
+    def _add_center(self, center_id, center):
+        index = self._center_rows.get(center_id)
+        if index is None:
+            index = self._center_rows[center_id] = len(self._centers)
+            self._center_ids.append(center_id)
+            self._centers.append(center)
+            self._fee_codes.append(self._intern(self.fee_types, center.get("fee_type")))
+        return index
+
+    def _session_columns(self, session):
+        """Returns the valid flag and the integer columns of a session.
+        Like `CompiledFilters.is_valid_session`, only a missing or invalid
+        `available_capacity` makes the session fail every filter, other
+        invalid fields only fail the filters using them.
+        """
+        capacity = session.get("available_capacity")
+        if not isinstance(capacity, (int, float)):
+            _logger.debug("Invalid session details, marking it invalid")
+            return 0, 0, _MISSING, _MISSING, _MISSING
+        return (
+            1,
+            floor(capacity),
+            _capacity_column(session, "available_capacity_dose1"),
+            _capacity_column(session, "available_capacity_dose2"),
+            _min_age_column(session),
+        )
+
+    def extend(self, centers):
+        """Adds the centers of an API response to the table. Sessions
+        already in the table get their capacity refreshed, see
+        `cowin_cowboy.utils.center_store.refresh_capacity`.
+
+        :param centers: the dictionary of center ID to center details
+        :type centers: dict[int, dict]
+        """
+        for center_id, center in centers.items():
+            sessions = center.get("sessions")
+            if not isinstance(sessions, list):
+                _logger.warning("Invalid center details")
+                continue
+            center_index = self._add_center(center_id, center)
+            for session in sessions:
+                session_id = session.get("session_id")
+                row = self._session_rows.get(session_id)
+                if row is not None:
+                    refresh_capacity(self._sessions[row], session)
+                    valid, capacity, dose1, dose2, _ = self._session_columns(
+                        self._sessions[row]
+                    )
+                    self._valid[row] = valid
+                    self._capacity[row] = capacity
+                    self._dose1[row] = dose1
+                    self._dose2[row] = dose2
+                    continue
+                valid, capacity, dose1, dose2, min_age = self._session_columns(session)
+                if session_id is not None:
+                    self._session_rows[session_id] = len(self._sessions)
+                self._sessions.append(session)
+                self._center_index.append(center_index)
+                self._valid.append(valid)
+                self._capacity.append(capacity)
+                self._dose1.append(dose1)
+                self._dose2.append(dose2)
+                self._min_age.append(min_age)
+                self._vaccine_codes.append(
+                    self._intern(self.vaccines, session.get("vaccine"))
+                )
+                self._date_codes.append(self._intern(self.dates, session.get("date")))
+
+    def _center_mask(self, compiled):
+        """Returns whether every center passes the center-level filters,
+        or `None` if there are none.
+        """
+        if compiled.fee_type is None and compiled.areas is None:
+            return None
+        center_ok = [True] * len(self._centers)
+        if compiled.fee_type is not None:
+            fee_code = self.fee_types.get(compiled.fee_type, _MISSING)
+            center_ok = [code == fee_code for code in self._fee_codes]
+        if compiled.areas is not None:
+            is_near = compiled.is_near
+            center_ok = [
+                ok and is_near(center) for ok, center in zip(center_ok, self._centers)
+            ]
+        return center_ok
+
+    def _mask_numpy(self, compiled):
+        def column(values):
+            return numpy.frombuffer(values, dtype=numpy.int64)
+
+        mask = numpy.frombuffer(self._valid, dtype=numpy.int8).astype(bool)
+        mask &= column(self._capacity) >= compiled.min_capacity
+        if compiled.min_dose1 is not None:
+            dose1 = column(self._dose1)
+            mask &= (dose1 == _MISSING) | (dose1 >= compiled.min_dose1)
+        if compiled.min_dose2 is not None:
+            dose2 = column(self._dose2)
+            mask &= (dose2 == _MISSING) | (dose2 >= compiled.min_dose2)
+        if compiled.age is not None:
+            min_age = column(self._min_age)
+            mask &= (min_age != _MISSING) & (min_age <= compiled.age)
+        if compiled.vaccines is not None:
+            codes = [
+                code
+                for name, code in self.vaccines.items()
+                if name in compiled.vaccines
+            ]
+            mask &= numpy.isin(column(self._vaccine_codes), codes)
+        center_ok = self._center_mask(compiled)
+        if center_ok is not None:
+            center_ok = numpy.array(center_ok, dtype=bool)
+            mask &= center_ok[column(self._center_index)]
+        return numpy.flatnonzero(mask).tolist()
+
+    def _mask_python(self, compiled):
+        min_capacity = compiled.min_capacity
+        min_dose1 = compiled.min_dose1
+        min_dose2 = compiled.min_dose2
+        age = compiled.age
+        vaccine_codes = None
+        if compiled.vaccines is not None:
+            vaccine_codes = set(
+                code
+                for name, code in self.vaccines.items()
+                if name in compiled.vaccines
+            )
+        center_ok = self._center_mask(compiled)
+
+        rows = []
+        for row, (valid, capacity, dose1, dose2, min_age, vaccine, center) in enumerate(
+            zip(
+                self._valid,
+                self._capacity,
+                self._dose1,
+                self._dose2,
+                self._min_age,
+                self._vaccine_codes,
+                self._center_index,
+            )
+        ):
+            if not valid or capacity < min_capacity:
+                continue
+            if min_dose1 is not None and dose1 != _MISSING and dose1 < min_dose1:
+                continue
+            if min_dose2 is not None and dose2 != _MISSING and dose2 < min_dose2:
+                continue
+            if age is not None and (min_age == _MISSING or age < min_age):
+                continue
+            if vaccine_codes is not None and vaccine not in vaccine_codes:
+                continue
+            if center_ok is not None and not center_ok[center]:
+                continue
+            rows.append(row)
+        return rows
+
+    def matching_rows(self, filters):
+        """Returns the indices of the rows which satisfy the filters.
+
+        :param filters: a dictionary containing all the required filters,
+                or filters already compiled with `compile_filters`
+        :type filters: dict | cowin_cowboy.filters.CompiledFilters
+        :raises ValueError: if some filter has an invalid value
+        :rtype: list[int]
+        """
+        compiled = compile_filters(filters)
+        if not self._sessions:
+            return []
+        if HAVE_NUMPY:
+            return self._mask_numpy(compiled)
+        return self._mask_python(compiled)
+
+    def to_centers(self, rows=None):
+        """Converts the given rows back into a center details dict, with
+        the centers copied along with their session lists.
+
+        :param rows: indices of the rows to convert, in increasing order,
+                defaults to all the rows, along with the centers without
+                any session, like a `CenterStore`
+        :type rows: Optional[Iterable[int]]
+        :return: A dictionary of center ID -> center details
+        :rtype: dict[int, dict]
+        """
+        grouped = {}
+        if rows is None:
+            rows = range(len(self._sessions))
+            grouped = {center_index: [] for center_index in range(len(self._centers))}
+        for row in rows:
+            grouped.setdefault(self._center_index[row], []).append(self._sessions[row])
+        centers = {}
+        for center_index in sorted(grouped):
+            center = dict(self._centers[center_index])
+            center["sessions"] = grouped[center_index]
+            centers[self._center_ids[center_index]] = center
+        return centers
+
+    def filter_centers(self, filters):
+        """Returns a dict of the centers which satisfy the filters, with
+        only their sessions which satisfy the filters, like
+        `filter_available_centers`.
+
+        :param filters: a dictionary containing all the required filters,
+                or filters already compiled with `compile_filters`
+        :type filters: dict | cowin_cowboy.filters.CompiledFilters
+        :raises ValueError: if some filter has an invalid value
+        :return: dictionary of all centers which satisfy the filters
+        :rtype: dict[int, dict]
+        """
+        with metrics.stage("filter"):
+            return self.to_centers(self.matching_rows(filters))
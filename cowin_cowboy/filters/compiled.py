@@ -0,0 +1,252 @@
+# compiled.py -- filters compiled once, to be reused on many centers
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["CompiledFilters", "compile_filters"]
+
+from logging import getLogger
+
+from cowin_cowboy.utils.api_utils import FeeType
+from cowin_cowboy.utils.geo import center_point, parse_areas
+
+_logger = getLogger(__name__)
+
+_FEE_TYPES = frozenset(key.upper() for key in FeeType.__members__.keys())
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class CompiledFilters:
+    """Filters validated and normalised once, so that checking a center
+    or session does not redo any work which depends only on the filters.
+    Use `compile_filters` to create one from the filters in the config.
+    """
+
+    def __init__(
+        self,
+        min_capacity=1,
+        min_dose1=None,
+        min_dose2=None,
+        age=None,
+        vaccines=None,
+        fee_type=None,
+        areas=None,
+    ):
+        """
+        :param min_capacity: minimum total available capacity
+        :type min_capacity: int
+        :param min_dose1: minimum dose 1 capacity, if checked
+        :type min_dose1: Optional[int]
+        :param min_dose2: minimum dose 2 capacity, if checked
+        :type min_dose2: Optional[int]
+        :param age: age of the person, if checked
+        :type age: Optional[int]
+        :param vaccines: upper-cased names of allowed vaccines, if checked
+        :type vaccines: Optional[frozenset[str]]
+        :param fee_type: upper-cased fee type, if checked
+        :type fee_type: Optional[str]
+        :param areas: areas one of which the center should be in, if
+                checked
+        :type areas: Optional[list[cowin_cowboy.utils.geo.GeoArea]]
+        """
+        self.min_capacity = min_capacity
+        self.min_dose1 = min_dose1
+        self.min_dose2 = min_dose2
+        self.age = age
+        self.vaccines = vaccines
+        self.fee_type = fee_type
+        self.areas = areas
+
+    def is_valid_session(self, session):
+        """Checks whether the given session satisfies the filters.
+        Note: It will remove all session with no capacity
+
+        :param session: session details
+        :type session: dict
+        :return: whether the session is valid and satisfies the filters
+        :rtype: bool
+        """
+        try:
+            if session["available_capacity"] < self.min_capacity:
+                return False
+            if self.min_dose1 is not None:
+                dose1 = session.get("available_capacity_dose1")
+                if dose1 is not None and dose1 < self.min_dose1:
+                    return False
+            if self.min_dose2 is not None:
+                dose2 = session.get("available_capacity_dose2")
+                if dose2 is not None and dose2 < self.min_dose2:
+                    return False
+            if self.age is not None and self.age < session["min_age_limit"]:
+                return False
+            if (
+                self.vaccines is not None
+                and session["vaccine"].upper() not in self.vaccines
+            ):
+                return False
+        except KeyError:
+            _logger.debug("Invalid session details, returning false")
+            return False
+        except (TypeError, AttributeError):
+            _logger.debug("Invalid type in some field")
+            return False
+
+        return True
+
+    def is_valid_center(self, center):
+        """Checks whether the center-level fields of the given center
+        satisfy the filters. Its sessions are not checked.
+
+        :param center: center details
+        :type center: dict
+        :return: whether the center satisfies the filters
+        :rtype: bool
+        """
+        if self.areas is not None and not self.is_near(center):
+            return False
+        if self.fee_type is None:
+            return True
+        try:
+            return center["fee_type"].upper() == self.fee_type
+        except KeyError:
+            _logger.warning("Invalid center details")
+        except (TypeError, AttributeError):
+            _logger.warning("Invalid value type")
+        return False
+
+    def is_near(self, center):
+        """Checks whether the given center is within one of the areas of
+        the filters. Centers without coordinates are not.
+
+        :param center: center details
+        :type center: dict
+        :rtype: bool
+        """
+        point = center_point(center)
+        if point is None:
+            return False
+        lat, long = point
+        return any(area.contains(lat, long) for area in self.areas)
+
+    def filter_center(self, center):
+        """Returns a copy of the center with only the sessions which
+        satisfy the filters, or `None` if no session does. Only the
+        center dict and its session list are copied, the sessions
+        themselves are shared with `center`.
+
+        :param center: center details
+        :type center: dict
+        :return: the filtered center details, if any session is left
+        :rtype: Optional[dict]
+        """
+        if not self.is_valid_center(center):
+            return None
+        try:
+            is_valid_session = self.is_valid_session
+            sessions = [
+                session for session in center["sessions"] if is_valid_session(session)
+            ]
+        except KeyError:
+            _logger.warning("Invalid center details")
+            return None
+        except TypeError:
+            _logger.warning("Invalid value type")
+            return None
+        if not sessions:
+            return None
+
+        filtered_center = dict(center)
+        filtered_center["sessions"] = sessions
+        return filtered_center
+
+    def filter_centers(self, centers):
+        """Returns a dict of the centers which satisfy the filters, with
+        only their sessions which satisfy the filters.
+
+        :param centers: the dictionary of center ID to center details
+        :type centers: dict[int, dict]
+        :return: dictionary of all centers which satisfy the filters
+        :rtype: dict[int, dict]
+        """
+        filtered_centers = {}
+        filter_center = self.filter_center
+        for center_id, center in centers.items():
+            filtered_center = filter_center(center)
+            if filtered_center is not None:
+                filtered_centers[center_id] = filtered_center
+        return filtered_centers
+
+
+def compile_filters(filters):
+    """Validates the filters from the config, and compiles them into a
+    reusable `CompiledFilters` object.
+
+    :param filters: a dictionary containing all the required filters
+    :type filters: dict
+    :raises ValueError: if some filter has an invalid value
+    :return: the compiled filters
+    :rtype: CompiledFilters
+    """
+    if isinstance(filters, CompiledFilters):
+        return filters
+    if filters is None:
+        filters = {}
+    if not isinstance(filters, dict):
+        raise ValueError("filters should be a table")
+
+    kwargs = {}
+
+    capacity = filters.get("capacity", 1)
+    if _is_int(capacity):
+        kwargs["min_capacity"] = capacity
+    elif isinstance(capacity, dict):
+        dose1 = capacity.get("dose1", 0)
+        dose2 = capacity.get("dose2", 0)
+        if not (_is_int(dose1) and _is_int(dose2)):
+            raise ValueError('"dose1" and "dose2" capacities should be integers')
+        kwargs["min_capacity"] = dose1 + dose2
+        kwargs["min_dose1"] = dose1
+        kwargs["min_dose2"] = dose2
+    else:
+        raise ValueError('"capacity" should be an integer or a table')
+
+    if "age" in filters:
+        if not _is_int(filters["age"]):
+            raise ValueError('"age" should be an integer')
+        kwargs["age"] = filters["age"]
+
+    if "vaccine" in filters:
+        vaccines = filters["vaccine"]
+        if not isinstance(vaccines, list) or not all(
+            isinstance(vac, str) for vac in vaccines
+        ):
+            raise ValueError('"vaccine" should be an array of strings')
+        kwargs["vaccines"] = frozenset(vac.upper() for vac in vaccines)
+
+    if "feeType" in filters:
+        fee_type = filters["feeType"]
+        if not isinstance(fee_type, str):
+            raise ValueError('"feeType" should be a string')
+        if fee_type.upper() in _FEE_TYPES:
+            kwargs["fee_type"] = fee_type.upper()
+        else:
+            _logger.warning("Unknown fee type '{}', ignoring it".format(fee_type))
+
+    if "near" in filters:
+        kwargs["areas"] = parse_areas(filters["near"])
+
+    return CompiledFilters(**kwargs)
@@ -0,0 +1,279 @@
+# filters/matching.py -- finds the subscriptions matching a session
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["SubscriptionIndex"]
+
+from bisect import bisect_right
+from logging import getLogger
+from threading import Lock
+
+from cowin_cowboy.filters.compiled import compile_filters
+
+_logger = getLogger(__name__)
+
+# Stands for any value of a criterion
+_ANY = None
+# Age limit of the sessions without one, which only subscriptions
+# without an age accept
+_NO_AGE_LIMIT = float("inf")
+
+# Which capacity of a session the capacity threshold of a subscription
+# is compared with
+_TOTAL = "total"
+_DOSE1 = "dose1"
+_DOSE2 = "dose2"
+
+
+def _capacity_threshold(filters):
+    """Returns which capacity a subscription checks, and its threshold.
+    When both doses are checked, the total is indexed, and the doses are
+    checked on the matches.
+    """
+    if filters.min_dose1 is None and filters.min_dose2 is None:
+        return _TOTAL, filters.min_capacity
+    if not filters.min_dose2:
+        return _DOSE1, max(filters.min_dose1 or 0, filters.min_capacity)
+    if not filters.min_dose1:
+        return _DOSE2, max(filters.min_dose2, filters.min_capacity)
+    return _TOTAL, filters.min_capacity
+
+
+def _needs_check(filters):
+    """Whether the index alone cannot tell if a session matches."""
+    return filters.areas is not None or bool(filters.min_dose1 and filters.min_dose2)
+
+
+def _session_capacity(session, kind):
+    capacity = session["available_capacity"]
+    if kind != _TOTAL:
+        # Sessions without the capacity of a dose pass its check
+        dose_capacity = session.get("available_capacity_{}".format(kind))
+        if dose_capacity is not None:
+            capacity = min(dose_capacity, capacity)
+    if not isinstance(capacity, int):
+        raise TypeError("capacity should be an integer")
+    return capacity
+
+
+class _Bucket:
+    """The subscriptions which share a location, vaccine, fee type and
+    kind of capacity threshold, with a list sorted by threshold for
+    every age limit of the sessions checked against them, so that the
+    matching subscriptions are a prefix found by bisection.
+    """
+
+    def __init__(self):
+        # subscription ID -> (age, threshold)
+        self.members = {}
+        # age limit -> (sorted thresholds, subscription IDs in that order)
+        self._by_age_limit = {}
+
+    def add(self, subscription_id, age, threshold):
+        self.members[subscription_id] = (age, threshold)
+        self._by_age_limit.clear()
+
+    def discard(self, subscription_id):
+        if self.members.pop(subscription_id, None) is not None:
+            self._by_age_limit.clear()
+
+    def match(self, age_limit, capacity):
+        sorted_members = self._by_age_limit.get(age_limit)
+        if sorted_members is None:
+            members = sorted(
+                (threshold, subscription_id)
+                for subscription_id, (age, threshold) in self.members.items()
+                if age is None or age >= age_limit
+            )
+            sorted_members = self._by_age_limit[age_limit] = (
+                [threshold for threshold, _ in members],
+                [subscription_id for _, subscription_id in members],
+            )
+        thresholds, subscription_ids = sorted_members
+        return subscription_ids[: bisect_right(thresholds, capacity)]
+
+
+class SubscriptionIndex:
+    """Indexes many subscriptions (filters, and optionally the locations
+    they care about) by their criteria, to find the ones a session
+    matches without checking every subscription.
+
+    Subscriptions are kept in buckets by location, vaccine, fee type and
+    the capacity (total, dose 1 or dose 2) their threshold applies to,
+    with `None` standing for any. A session looks up the few buckets of
+    its center, PIN code, district, vaccine and fee type, where the
+    subscriptions which accept its age limit and capacity are found by
+    bisection. Only the subscriptions with `"near"` areas, or thresholds
+    for both doses, are then checked against their full filters.
+
+    Subscription IDs must be hashable and sortable, such as integers or
+    strings.
+    """
+
+    def __init__(self, center_districts=None):
+        """
+        :param center_districts: district ID of every center ID, such as
+                the `center_districts` of a `QueryPlanner`, used to match
+                the subscriptions to districts
+        :type center_districts: Optional[dict[int, int]]
+        """
+        self.center_districts = {} if center_districts is None else center_districts
+        self.subscriptions = {}
+        self._buckets = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def __contains__(self, subscription_id):
+        return subscription_id in self.subscriptions
+
+    @staticmethod
+    def _scopes(locations):
+        if not locations:
+            return [_ANY]
+        scopes = []
+        for key in ("pincodes", "district_ids", "center_ids"):
+            for location_id in locations.get(key, []):
+                if key == "pincodes":
+                    location_id = str(location_id)
+                scopes.append((key, location_id))
+        return scopes or [_ANY]
+
+    def _bucket_keys(self, filters, locations):
+        kind, _ = _capacity_threshold(filters)
+        vaccines = [_ANY] if filters.vaccines is None else sorted(filters.vaccines)
+        return [
+            (scope, vaccine, filters.fee_type, kind)
+            for scope in self._scopes(locations)
+            for vaccine in vaccines
+        ]
+
+    def add(self, subscription_id, filters, locations=None):
+        """Adds a subscription, or replaces the one with the same ID.
+
+        :param subscription_id: ID of the subscription
+        :param filters: filters of the subscription, as in the config or
+                compiled with `compile_filters`
+        :type filters: dict | cowin_cowboy.filters.CompiledFilters
+        :param locations: the locations the subscription is limited to,
+                with PIN codes at key `pincodes`, district IDs at key
+                `district_ids` and center IDs at key `center_ids`, or
+                `None` for any
+        :type locations: Optional[dict]
+        :raises ValueError: if some filter has an invalid value
+        """
+        filters = compile_filters(filters)
+        _, threshold = _capacity_threshold(filters)
+        keys = self._bucket_keys(filters, locations)
+        with self._lock:
+            self._remove(subscription_id)
+            self.subscriptions[subscription_id] = (filters, keys, _needs_check(filters))
+            for key in keys:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = _Bucket()
+                bucket.add(subscription_id, filters.age, threshold)
+
+    def _remove(self, subscription_id):
+        subscription = self.subscriptions.pop(subscription_id, None)
+        if subscription is None:
+            return
+        for key in subscription[1]:
+            bucket = self._buckets[key]
+            bucket.discard(subscription_id)
+            if not bucket.members:
+                del self._buckets[key]
+
+    def remove(self, subscription_id):
+        """Removes a subscription, if present."""
+        with self._lock:
+            self._remove(subscription_id)
+
+    def match(self, center, session):
+        """Returns the IDs of the subscriptions which the session matches.
+
+        :param center: details of the center of the session
+        :type center: dict
+        :param session: the session
+        :type session: dict
+        :rtype: list
+        """
+        try:
+            center_id = center["center_id"]
+            capacities = {
+                kind: _session_capacity(session, kind)
+                for kind in (_TOTAL, _DOSE1, _DOSE2)
+            }
+        except (KeyError, TypeError, AttributeError):
+            _logger.debug("Invalid session details, matching nothing")
+            return []
+        age_limit = session.get("min_age_limit")
+        if not isinstance(age_limit, int):
+            age_limit = _NO_AGE_LIMIT
+        vaccine_keys = [_ANY]
+        if isinstance(session.get("vaccine"), str):
+            vaccine_keys.append(session["vaccine"].upper())
+        fee_keys = [_ANY]
+        if isinstance(center.get("fee_type"), str):
+            fee_keys.append(center["fee_type"].upper())
+
+        scopes = [_ANY, ("center_ids", center_id)]
+        if center.get("pincode") is not None:
+            scopes.append(("pincodes", str(center["pincode"])))
+        district_id = self.center_districts.get(center_id)
+        if district_id is not None:
+            scopes.append(("district_ids", district_id))
+
+        matched = set()
+        with self._lock:
+            for scope in scopes:
+                for vaccine_key in vaccine_keys:
+                    for fee_key in fee_keys:
+                        for kind, capacity in capacities.items():
+                            bucket = self._buckets.get(
+                                (scope, vaccine_key, fee_key, kind)
+                            )
+                            if bucket is not None:
+                                matched.update(bucket.match(age_limit, capacity))
+            subscriptions = self.subscriptions
+            checked = []
+            for subscription_id in matched:
+                filters, _, needs_check = subscriptions[subscription_id]
+                if not needs_check or (
+                    filters.is_valid_center(center)
+                    and filters.is_valid_session(session)
+                ):
+                    checked.append(subscription_id)
+        return sorted(checked)
+
+    def match_updates(self, store, updated):
+        """Matches the `(center_id, session)` tuples returned by the
+        `merge` of a center store, such as in the `on_update` callback of
+        `check_available_slots_for_weeks`.
+
+        :param store: the store the sessions were merged into
+        :type store: cowin_cowboy.utils.center_store.CenterStore
+        :param updated: the new or changed sessions
+        :type updated: list[tuple[int, dict]]
+        :return: subscription ID -> the `(center_id, session)` tuples it
+                matches
+        :rtype: dict[Any, list[tuple[int, dict]]]
+        """
+        matches = {}
+        for center_id, session in updated:
+            for subscription_id in self.match(store[center_id], session):
+                matches.setdefault(subscription_id, []).append((center_id, session))
+        return matches
@@ -0,0 +1,274 @@
+# notify/notifier.py -- delivers alerts for new sessions in the background
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["Notifier", "Subscriber"]
+
+from logging import getLogger
+from queue import Empty, Queue
+from threading import Thread
+from time import monotonic, time
+
+from requests.exceptions import RequestException
+
+from cowin_cowboy.filters import SubscriptionIndex, compile_filters
+from cowin_cowboy.notify.sinks import make_sink
+from cowin_cowboy.utils.stats import metrics
+
+_logger = getLogger(__name__)
+
+# Seconds alerts are held back, to be delivered together
+DEFAULT_BATCH_DELAY = 0.2
+DEFAULT_MAX_BATCH = 100
+
+_STOP = object()
+
+
+class Subscriber:
+    """Someone to alert about the sessions which pass their filters,
+    through a sink (see `cowin_cowboy.notify.sinks`).
+    """
+
+    def __init__(self, name, sink, filters=None, locations=None):
+        """
+        :param name: name of the subscriber, used in logs and metrics
+        :type name: str
+        :param sink: where the alerts are delivered, with a `deliver`
+                method taking a list of alerts
+        :param filters: the sessions to alert about, defaults to all the
+                sessions with some available capacity
+        :type filters: Optional[dict | cowin_cowboy.filters.CompiledFilters]
+        :param locations: the locations to alert about, with PIN codes at
+                key `pincodes`, district IDs at key `district_ids` and
+                center IDs at key `center_ids`, defaults to all of them
+        :type locations: Optional[dict]
+        :raises ValueError: if some filter has an invalid value
+        """
+        self.name = name
+        self.sink = sink
+        self.filters = compile_filters({} if filters is None else filters)
+        self.locations = locations
+        self.alerted = set()
+
+    @classmethod
+    def from_config(cls, subscriber_config, default_filters=None):
+        """Creates a subscriber from an entry of the `"notify"` array of
+        the config, which has a `"sink"` (`"file"`, `"webhook"` or
+        `"socket"`), a `"target"` (the path, URL or address), and
+        optionally a `"name"`, `"filters"` and `"locations"` (a table of
+        `"pincodes"`, `"district_ids"` and `"center_ids"` arrays).
+
+        :param subscriber_config: the entry of the config
+        :type subscriber_config: dict
+        :param default_filters: filters of subscribers without their own
+        :type default_filters: Optional[cowin_cowboy.filters.CompiledFilters]
+        :raises ValueError: if some field has an invalid value
+        :rtype: Subscriber
+        """
+        if not isinstance(subscriber_config, dict):
+            raise ValueError("subscriber should be a table")
+        sink = make_sink(subscriber_config.get("sink"), subscriber_config.get("target"))
+        filters = default_filters
+        if "filters" in subscriber_config:
+            filters = compile_filters(subscriber_config["filters"])
+        locations = subscriber_config.get("locations")
+        if locations is not None:
+            if not isinstance(locations, dict):
+                raise ValueError('"locations" of subscriber should be a table')
+            for key in ("pincodes", "district_ids", "center_ids"):
+                if not isinstance(locations.get(key, []), list):
+                    raise ValueError(
+                        '"{}" of subscriber should be an array'.format(key)
+                    )
+        name = subscriber_config.get("name", subscriber_config["target"])
+        return cls(str(name), sink, filters, locations)
+
+
+class Notifier:
+    """Alerts the subscribers about new sessions from a background
+    thread, so that the scan goes on while alerts are delivered.
+
+    Sessions are handed over with `submit` as soon as they are merged.
+    The subscribers a session matches are looked up in a
+    `SubscriptionIndex`, so that thousands of them can be alerted without
+    checking each one. Every subscriber is alerted once per session which
+    passes its filters and locations, and again if the session stops
+    passing them and later passes them once more, in batches of the
+    sessions found within `batch_delay` seconds of each other. Every alert
+    records when its session was found (`"found_at"`), when it was sent
+    (`"alerted_at"`) and the latency between the two (`"latency"`), and
+    the time until the sink took it is kept in the `alert_latency_seconds`
+    metric.
+    """
+
+    def __init__(
+        self,
+        subscribers,
+        batch_delay=DEFAULT_BATCH_DELAY,
+        max_batch=DEFAULT_MAX_BATCH,
+        center_districts=None,
+    ):
+        """
+        :param subscribers: the subscribers to alert
+        :type subscribers: list[Subscriber]
+        :param batch_delay: seconds an alert may wait for others to be
+                delivered with it
+        :type batch_delay: float
+        :param max_batch: number of alerts which are delivered right away
+        :type max_batch: int
+        :param center_districts: district ID of every center ID, needed to
+                alert subscribers limited to districts
+        :type center_districts: Optional[dict[int, int]]
+        """
+        self.subscribers = list(subscribers)
+        self._index = SubscriptionIndex(center_districts)
+        for position, subscriber in enumerate(self.subscribers):
+            self._index.add(position, subscriber.filters, subscriber.locations)
+        self.batch_delay = batch_delay
+        self.max_batch = max_batch
+        self.delivered = 0
+        self.failed = 0
+        # Positions of the subscribers alerted about every session
+        self._alerted = {}
+        self._queue = Queue()
+        self._thread = None
+
+    def start(self):
+        """Starts the background thread delivering the alerts."""
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name="notifier", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Delivers the pending alerts, and stops the background thread.
+
+        :param timeout: seconds to wait for the thread
+        :type timeout: Optional[float]
+        """
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            self._thread = None
+        for subscriber in self.subscribers:
+            subscriber.sink.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def submit(self, center, session, found_at=None):
+        """Hands a new or changed session over to the notifier. Returns
+        right away, with copies of the center and the session, so that
+        later merges do not change them while they wait.
+
+        :param center: details of the center of the session
+        :type center: dict
+        :param session: the session
+        :type session: dict
+        :param found_at: UNIX time the session was found, defaults to now
+        :type found_at: Optional[float]
+        """
+        center = {key: value for key, value in center.items() if key != "sessions"}
+        found_at = time() if found_at is None else found_at
+        self._queue.put((center, dict(session), found_at))
+
+    def submit_updates(self, store, updated):
+        """Hands over the `(center_id, session)` tuples returned by the
+        `merge` of a center store, such as in the `on_update` callback of
+        `check_available_slots_for_weeks`.
+
+        :param store: the store the sessions were merged into
+        :type store: cowin_cowboy.utils.center_store.CenterStore
+        :param updated: the new or changed sessions
+        :type updated: list[tuple[int, dict]]
+        """
+        found_at = time()
+        for center_id, session in updated:
+            self.submit(store[center_id], session, found_at)
+
+    def _run(self):
+        # Alerts of every subscriber, by position, as names may be shared
+        pending = [[] for _ in self.subscribers]
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                item = None
+            if item is _STOP:
+                self._flush(pending)
+                return
+            if item is not None:
+                self._add(pending, *item)
+                if deadline is None and any(pending):
+                    deadline = monotonic() + self.batch_delay
+            full = any(len(alerts) >= self.max_batch for alerts in pending)
+            if full or (deadline is not None and monotonic() >= deadline):
+                self._flush(pending)
+                deadline = None
+
+    def _add(self, pending, center, session, found_at):
+        key = (center["center_id"], session.get("session_id"))
+        matched = set(self._index.match(center, session))
+        alerted = self._alerted.get(key, set())
+        # Subscribers are alerted again once the session matches them anew
+        for position in alerted - matched:
+            self.subscribers[position].alerted.discard(key)
+        alerted &= matched
+        alert = None
+        for position in sorted(matched - alerted):
+            subscriber = self.subscribers[position]
+            subscriber.alerted.add(key)
+            alerted.add(position)
+            if alert is None:
+                alert = dict(center, session=session, found_at=found_at)
+            pending[position].append(alert)
+        if alerted:
+            self._alerted[key] = alerted
+        else:
+            self._alerted.pop(key, None)
+
+    def _flush(self, pending):
+        for position, subscriber in enumerate(self.subscribers):
+            alerts = pending[position]
+            if not alerts:
+                continue
+            pending[position] = []
+            labels = {"subscriber": subscriber.name}
+            alerted_at = time()
+            batch = [
+                dict(
+                    alert, alerted_at=alerted_at, latency=alerted_at - alert["found_at"]
+                )
+                for alert in alerts
+            ]
+            try:
+                subscriber.sink.deliver(batch)
+            except (OSError, RequestException) as e:
+                self.failed += len(batch)
+                metrics.inc("alert_errors_total", labels, len(batch))
+                _logger.warning("Could not alert {}: {}".format(subscriber.name, e))
+                continue
+            delivered_at = time()
+            self.delivered += len(batch)
+            metrics.inc("alerts_total", labels, len(batch))
+            for alert in batch:
+                metrics.observe(
+                    "alert_latency_seconds", delivered_at - alert["found_at"], labels
+                )
@@ -0,0 +1,170 @@
+# notify/sinks.py -- destinations alerts are delivered to
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["FileSink", "SocketSink", "WebhookSink", "make_sink"]
+
+from logging import getLogger
+from os import makedirs, path
+import socket
+
+from requests import Session
+
+from cowin_cowboy.utils import json_backend
+
+_logger = getLogger(__name__)
+
+
+class FileSink:
+    """Appends every alert to a file, as one JSON line."""
+
+    kind = "file"
+
+    def __init__(self, file_path):
+        """
+        :param file_path: path of the file, created if missing
+        :type file_path: os.PathLike
+        """
+        directory = path.dirname(file_path)
+        if directory:
+            makedirs(directory, exist_ok=True)
+        self.file_path = file_path
+        self._file = open(file_path, "a")
+
+    def deliver(self, alerts):
+        """Writes the alerts, one per line.
+
+        :param alerts: the alerts to deliver
+        :type alerts: list[dict]
+        """
+        self._file.write("".join(json_backend.dumps(alert) + "\n" for alert in alerts))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class WebhookSink:
+    """POSTs every batch of alerts to a URL, as a JSON object with the
+    alerts at key `"alerts"`. The connection is kept alive between
+    batches.
+    """
+
+    kind = "webhook"
+
+    def __init__(self, url, timeout=5.0):
+        """
+        :param url: URL to POST the alerts to
+        :type url: str
+        :param timeout: seconds to wait for the receiver
+        :type timeout: float
+        """
+        self.url = url
+        self.timeout = timeout
+        self._session = Session()
+
+    def deliver(self, alerts):
+        """POSTs the alerts.
+
+        :param alerts: the alerts to deliver
+        :type alerts: list[dict]
+        :raises requests.RequestException: if the receiver cannot be
+                reached, or answers with an error
+        """
+        r = self._session.post(
+            self.url,
+            data=json_backend.dumps({"alerts": alerts}).encode(),
+            headers={"Content-Type": "application/json"},
+            timeout=self.timeout,
+        )
+        r.raise_for_status()
+
+    def close(self):
+        self._session.close()
+
+
+class SocketSink:
+    """Writes every alert as one JSON line to a stream socket, either a
+    TCP `host:port` address or the path of a Unix socket. The connection
+    is opened on the first batch, and opened again after an error.
+    """
+
+    kind = "socket"
+
+    def __init__(self, address, timeout=5.0):
+        """
+        :param address: `host:port` to connect to, or a Unix socket path
+        :type address: str
+        :param timeout: seconds to wait for the connection and writes
+        :type timeout: float
+        """
+        self.address = address
+        self.timeout = timeout
+        self._sock = None
+
+    def _connect(self):
+        host, sep, port = self.address.rpartition(":")
+        if sep and port.isdigit():
+            return socket.create_connection((host, int(port)), self.timeout)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def deliver(self, alerts):
+        """Sends the alerts, one per line.
+
+        :param alerts: the alerts to deliver
+        :type alerts: list[dict]
+        :raises OSError: if the socket cannot be connected or written to
+        """
+        data = "".join(json_backend.dumps(alert) + "\n" for alert in alerts).encode()
+        if self._sock is None:
+            self._sock = self._connect()
+        try:
+            self._sock.sendall(data)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+_SINKS = {sink.kind: sink for sink in (FileSink, SocketSink, WebhookSink)}
+
+
+def make_sink(kind, target):
+    """Creates a sink from its kind and target, as in the config.
+
+    :param kind: `"file"`, `"webhook"` or `"socket"`
+    :type kind: str
+    :param target: the path, URL or address of the sink
+    :type target: str
+    :raises ValueError: if the kind is unknown
+    """
+    if kind not in _SINKS:
+        raise ValueError(
+            'sink should be one of {}, not "{}"'.format(", ".join(sorted(_SINKS)), kind)
+        )
+    if not isinstance(target, str):
+        raise ValueError("target of the {} sink should be a string".format(kind))
+    return _SINKS[kind](target)
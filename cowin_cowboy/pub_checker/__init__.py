@@ -14,4 +14,27 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from cowin_cowboy.pub_checker.check_slots import check_available_slots
+from cowin_cowboy.pub_checker._api_session import PubApiSession, pub_api_session
+from cowin_cowboy.pub_checker.cache import PersistentResponseCache, ResponseCache
+from cowin_cowboy.pub_checker.check_slots import (
+    DEFAULT_MAX_WORKERS,
+    check_available_slots,
+    check_available_slots_for_weeks,
+    iter_location_results,
+)
+from cowin_cowboy.pub_checker.horizon import ScanHorizon
+from cowin_cowboy.pub_checker.planner import QueryPlanner, union_locations
+from cowin_cowboy.pub_checker.rate_limit import RateLimiter, request_priority
+from cowin_cowboy.pub_checker.poller import AdaptivePoller, CycleReport
+from cowin_cowboy.pub_checker.resilience import CircuitOpenError, NetworkPolicy
+from cowin_cowboy.pub_checker.replay import (
+    ReplaySession,
+    TrafficRecorder,
+    replay_traffic,
+)
+from cowin_cowboy.pub_checker.sharding import (
+    check_available_slots_sharded,
+    parse_address,
+    partition_locations,
+    run_shard_worker,
+)
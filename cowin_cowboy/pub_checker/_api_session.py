@@ -14,12 +14,268 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import perf_counter, sleep
+
+from requests.exceptions import RequestException
 from requests_toolbelt.sessions import BaseUrlSession
 from requests_toolbelt.cookies.forgetful import ForgetfulCookieJar
 
+from cowin_cowboy.pub_checker.cache import CacheEntry, endpoint_name
 from cowin_cowboy.pub_checker.config import *
+from cowin_cowboy.pub_checker.resilience import CircuitOpenError, NetworkPolicy
+from cowin_cowboy.utils.stats import metrics
+
+
+class _HedgedRace:
+    """The attempts of a hedged request, each sent from a thread of its
+    own as soon as it is started, so that none of them waits for a free
+    worker. The first response wins, and the responses which arrive
+    after it are closed.
+    """
+
+    def __init__(self, attempt, kwargs):
+        self._attempt = attempt
+        self._kwargs = kwargs
+        self._outcomes = Queue()
+        self._lock = Lock()
+        self._finished = False
+
+    def start(self, request):
+        Thread(
+            target=self._run, args=(request,), name="hedged-request", daemon=True
+        ).start()
+
+    def _run(self, request):
+        try:
+            outcome = (self._attempt(request, **self._kwargs), None)
+        except RequestException as e:
+            outcome = (None, e)
+        with self._lock:
+            if not self._finished:
+                self._outcomes.put(outcome)
+                return
+        if outcome[0] is not None:
+            outcome[0].close()
+
+    def next_outcome(self, timeout=None):
+        """Returns the `(response, error)` of the next attempt to finish.
+
+        :raises queue.Empty: if none finished within `timeout` seconds
+        """
+        return self._outcomes.get(timeout=timeout)
+
+    def finish(self):
+        """Closes the responses of the attempts which lost the race."""
+        with self._lock:
+            self._finished = True
+        while True:
+            try:
+                response, _ = self._outcomes.get_nowait()
+            except Empty:
+                return
+            if response is not None:
+                response.close()
+
+
+class PubApiSession(BaseUrlSession):
+    """A session with a base URL, which answers GET requests from its
+    `cache` (a `cowin_cowboy.pub_checker.cache.ResponseCache`) when one
+    is set, and sends all other requests through its `limiter` (a
+    `cowin_cowboy.pub_checker.rate_limit.RateLimiter`) when one is set.
+
+    With a `policy` (a `cowin_cowboy.pub_checker.resilience.NetworkPolicy`),
+    requests get its timeouts, failed requests are retried, slow GET
+    requests are hedged with a second one, and the requests to an
+    endpoint which keeps failing are stopped by a circuit breaker, with
+    `cowin_cowboy.pub_checker.resilience.CircuitOpenError`.
+
+    With a `recorder` (a `cowin_cowboy.pub_checker.replay.TrafficRecorder`),
+    every response the caller gets is also recorded, once retried, hedged
+    or answered from the cache.
+    """
+
+    def __init__(
+        self, base_url=None, cache=None, limiter=None, policy=None, recorder=None
+    ):
+        super(PubApiSession, self).__init__(base_url=base_url)
+        self.cache = cache
+        self.limiter = limiter
+        self.policy = policy
+        self.recorder = recorder
+
+    def _attempt(self, request, **kwargs):
+        endpoint = endpoint_name(request.url)
+        labels = {"endpoint": endpoint}
+        start = perf_counter()
+        try:
+            response = super(PubApiSession, self).send(request, **kwargs)
+        except RequestException:
+            metrics.inc("api_errors_total", labels)
+            raise
+        elapsed = perf_counter() - start
+        metrics.observe("api_request_seconds", elapsed, labels)
+        metrics.inc(
+            "api_responses_total",
+            {"endpoint": endpoint, "status": response.status_code},
+        )
+        # Streamed bodies are counted as they are read
+        if not kwargs.get("stream", False):
+            metrics.inc("api_response_bytes_total", labels, len(response.content))
+        if response.ok and self.policy is not None:
+            if self.policy.latencies is not None:
+                self.policy.latencies.observe(endpoint, elapsed)
+
+        if response.status_code == 403:
+            metrics.inc("api_rate_limited_total", labels)
+            if self.limiter is not None and endpoint in RATE_LIMITED_ENDPOINTS:
+                self.limiter.penalize()
+        return response
+
+    def _hedged_attempt(self, request, **kwargs):
+        """Sends the request, and sends it a second time if the first one
+        takes longer than the hedging threshold of its endpoint, and a
+        token of the rate limiter is free. The first response wins.
+        """
+        endpoint = endpoint_name(request.url)
+        latencies = self.policy.latencies
+        delay = None
+        if latencies is not None and request.method == "GET":
+            if not kwargs.get("stream", False):
+                delay = latencies.threshold(endpoint)
+        if delay is None:
+            return self._attempt(request, **kwargs)
+
+        race = _HedgedRace(self._attempt, kwargs)
+        race.start(request)
+        try:
+            response, error = race.next_outcome(timeout=delay)
+        except Empty:
+            if self.limiter is not None and not self.limiter.try_acquire():
+                response, error = race.next_outcome()
+            else:
+                metrics.inc("api_hedged_total", {"endpoint": endpoint})
+                race.start(request.copy())
+                response, error = race.next_outcome()
+                if response is None:
+                    response, error = race.next_outcome()
+        race.finish()
+        if response is None:
+            raise error
+        return response
+
+    def _send(self, request, **kwargs):
+        endpoint = endpoint_name(request.url)
+        labels = {"endpoint": endpoint}
+        policy = self.policy
+        if policy is not None and kwargs.get("timeout") is None:
+            kwargs["timeout"] = policy.timeout
+
+        attempt = 0
+        while True:
+            if policy is not None and not policy.breaker.allow(endpoint):
+                metrics.inc("api_circuit_open_total", labels)
+                raise CircuitOpenError(
+                    "Circuit of {} is open".format(endpoint), request=request
+                )
+            if self.limiter is not None:
+                with metrics.timer("rate_limit_wait_seconds", labels):
+                    self.limiter.acquire()
+            if policy is None:
+                return self._attempt(request, **kwargs)
+
+            try:
+                response = self._hedged_attempt(request, **kwargs)
+            except RequestException:
+                policy.breaker.record(endpoint, False)
+                if not policy.should_retry(attempt):
+                    raise
+            else:
+                # 403s of the rate limited endpoints are the rate limiter's
+                # business, but the other endpoints answer 403 when they are
+                # closed to the public
+                failed = response.status_code >= 500 or (
+                    response.status_code == 403
+                    and endpoint not in RATE_LIMITED_ENDPOINTS
+                )
+                policy.breaker.record(endpoint, not failed)
+                if not failed or not policy.should_retry(attempt, response):
+                    return response
+                response.close()
+            metrics.inc("api_retries_total", labels)
+            sleep(policy.backoff_delay(attempt))
+            attempt += 1
+
+    def send(self, request, **kwargs):
+        recorder = self.recorder
+        if recorder is None:
+            return self._send_cached(request, **kwargs)
+
+        start = perf_counter()
+        try:
+            response = self._send_cached(request, **kwargs)
+        except RequestException as e:
+            recorder.record_error(request, start, perf_counter() - start, e)
+            raise
+        recorder.record(request, response, start, perf_counter() - start)
+        return response
+
+    def _send_cached(self, request, **kwargs):
+        cache = self.cache
+        if cache is None or request.method != "GET":
+            return self._send(request, **kwargs)
+
+        url = request.url
+        entry, fresh = cache.lookup(url)
+        if fresh:
+            return entry.to_response(request)
+        if entry is not None:
+            if entry.etag:
+                request.headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                request.headers["If-Modified-Since"] = entry.last_modified
+
+        response = self._send(request, **kwargs)
+        if entry is not None and response.status_code == 304:
+            response.close()
+            cache.revalidated(url, entry)
+            return entry.to_response(request)
+        if response.ok and kwargs.get("stream", False):
+            _store_when_read(response, cache, url)
+        elif response.ok:
+            cache.store(url, CacheEntry.from_response(response))
+        return response
+
+
+def _store_when_read(response, cache, url):
+    """Stores a streamed response in the cache once the caller has read
+    its body in full with `iter_content`, leaving out bodies which were
+    given up on halfway, such as malformed ones.
+    """
+    iter_content = response.iter_content
+
+    def iter_and_store(chunk_size=1, decode_unicode=False):
+        chunks = []
+        for chunk in iter_content(chunk_size, decode_unicode):
+            chunks.append(chunk)
+            yield chunk
+        if not decode_unicode:
+            cache.store(
+                url,
+                CacheEntry(
+                    response.url,
+                    response.status_code,
+                    response.headers,
+                    b"".join(chunks),
+                    response.encoding,
+                ),
+            )
+
+    response.iter_content = iter_and_store
+
 
 # Initialise a forgetful session with base URL
-pub_api_session = BaseUrlSession(base_url=API_URL)
+pub_api_session = PubApiSession(base_url=API_URL, policy=NetworkPolicy())
 pub_api_session.headers = {"Accept": "application/json", "User-Agent": USER_AGENT}
 pub_api_session.cookies = ForgetfulCookieJar()
@@ -0,0 +1,388 @@
+# pub_checker/cache.py -- cache for public API responses
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = [
+    "CacheEntry",
+    "PersistentResponseCache",
+    "ResponseCache",
+    "endpoint_name",
+]
+
+from collections import OrderedDict
+from datetime import timedelta
+from json import dumps, loads
+from logging import getLogger
+from os import makedirs, path
+import sqlite3
+from threading import Lock
+from time import time
+from urllib.parse import urlsplit
+import zlib
+
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+from cowin_cowboy.pub_checker.config import DEFAULT_CACHE_TTL, DEFAULT_CACHE_TTLS
+
+_logger = getLogger(__name__)
+
+
+def endpoint_name(url):
+    """Returns the last component of the URL path, such as
+    `calendarByDistrict`, which names the API endpoint.
+
+    :param url: the request URL
+    :type url: str
+    :rtype: str
+    """
+    return urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1]
+
+
+class CacheEntry:
+    """A successful response, as stored by `ResponseCache`."""
+
+    def __init__(
+        self, url, status_code, headers, content, encoding=None, stored_at=None
+    ):
+        """
+        :param url: URL the response was received from
+        :type url: str
+        :param status_code: HTTP status code of the response
+        :type status_code: int
+        :param headers: response headers
+        :type headers: Mapping[str, str]
+        :param content: response body
+        :type content: bytes
+        :param encoding: text encoding of the body, if known
+        :type encoding: Optional[str]
+        :param stored_at: UNIX timestamp the entry was last validated at,
+                defaults to now
+        :type stored_at: Optional[float]
+        """
+        self.url = url
+        self.status_code = status_code
+        self.headers = dict(headers)
+        self.content = content
+        self.encoding = encoding
+        self.stored_at = time() if stored_at is None else stored_at
+
+    @classmethod
+    def from_response(cls, response):
+        """Creates an entry from a response whose body has been read."""
+        return cls(
+            response.url,
+            response.status_code,
+            response.headers,
+            response.content,
+            response.encoding,
+        )
+
+    @property
+    def etag(self):
+        return self.headers.get("ETag") or self.headers.get("etag")
+
+    @property
+    def last_modified(self):
+        return self.headers.get("Last-Modified") or self.headers.get("last-modified")
+
+    def to_response(self, request=None):
+        """Builds a new `requests.Response` out of the entry.
+
+        :param request: the request being answered from the cache
+        :type request: Optional[requests.PreparedRequest]
+        :rtype: requests.Response
+        """
+        response = Response()
+        response.url = self.url
+        response.status_code = self.status_code
+        response.headers = CaseInsensitiveDict(self.headers)
+        response._content = self.content
+        response._content_consumed = True
+        response.encoding = self.encoding
+        response.request = request
+        response.elapsed = timedelta(0)
+        response.reason = "OK"
+        return response
+
+
+class ResponseCache:
+    """A thread-safe, size-bounded LRU cache of API responses, keyed by
+    the full request URL (query parameters included). Every endpoint
+    has its own time-to-live; once an entry goes stale, it is kept so
+    the request can be revalidated with `If-None-Match` and
+    `If-Modified-Since`, if the CDN sent an ETag or Last-Modified.
+    """
+
+    def __init__(self, ttls=None, default_ttl=DEFAULT_CACHE_TTL, max_entries=1024):
+        """
+        :param ttls: time-to-live in seconds, per endpoint name, such as
+                `calendarByDistrict`. Missing endpoints fall back to
+                `DEFAULT_CACHE_TTLS`, then `default_ttl`
+        :type ttls: Optional[dict[str, float]]
+        :param default_ttl: time-to-live in seconds of other endpoints
+        :type default_ttl: float
+        :param max_entries: maximum number of responses to keep, the
+                least recently used are evicted first
+        :type max_entries: int
+        """
+        self.ttls = dict(DEFAULT_CACHE_TTLS)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, cache_config, **kwargs):
+        """Creates a cache from the `"cache"` table of the config, which
+        may have a `"ttl"` field (seconds, either for all endpoints or
+        as a table per endpoint name) and a `"max_entries"` field.
+
+        :param cache_config: the cache table of the config
+        :type cache_config: dict
+        :param kwargs: other arguments of the constructor
+        :raises ValueError: if some field has an invalid value
+        :rtype: ResponseCache
+        """
+        if not isinstance(cache_config, dict):
+            raise ValueError("cache should be a table")
+        ttl = cache_config.get("ttl")
+        if isinstance(ttl, (int, float)) and not isinstance(ttl, bool):
+            kwargs["ttls"] = {name: ttl for name in DEFAULT_CACHE_TTLS}
+            kwargs["default_ttl"] = ttl
+        elif isinstance(ttl, dict):
+            if not all(
+                isinstance(value, (int, float)) and not isinstance(value, bool)
+                for value in ttl.values()
+            ):
+                raise ValueError('"ttl" values should be numbers')
+            kwargs["ttls"] = ttl
+        elif ttl is not None:
+            raise ValueError('"ttl" should be a number or a table')
+        max_entries = cache_config.get("max_entries", 1024)
+        if not isinstance(max_entries, int) or max_entries < 1:
+            raise ValueError('"max_entries" should be a positive integer')
+        kwargs["max_entries"] = max_entries
+        return cls(**kwargs)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def ttl_for(self, url):
+        """Returns the time-to-live of responses from the given URL.
+
+        :rtype: float
+        """
+        return self.ttls.get(endpoint_name(url), self.default_ttl)
+
+    def is_fresh(self, entry, now=None):
+        """Whether the entry is still within its time-to-live."""
+        if now is None:
+            now = time()
+        return now - entry.stored_at < self.ttl_for(entry.url)
+
+    def lookup(self, url):
+        """Looks the URL up, and counts it as a hit or a miss.
+
+        :param url: the full request URL
+        :type url: str
+        :return: the entry (or `None`), and whether it is fresh
+        :rtype: tuple[Optional[CacheEntry], bool]
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+                if self.is_fresh(entry):
+                    self.hits += 1
+                    return entry, True
+            self.misses += 1
+            return entry, False
+
+    def store(self, url, entry):
+        """Stores the entry, evicting the least recently used entries if
+        the cache is full.
+
+        :param url: the full request URL
+        :type url: str
+        :param entry: the response to store
+        :type entry: CacheEntry
+        :return: URLs of the evicted entries
+        :rtype: list[str]
+        """
+        evicted = []
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+                self.evictions += 1
+        return evicted
+
+    def revalidated(self, url, entry):
+        """Marks the entry as validated again by a `304 Not Modified`."""
+        with self._lock:
+            entry.stored_at = time()
+            self.revalidations += 1
+            if url in self._entries:
+                self._entries.move_to_end(url)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the hit and miss counters of the cache.
+
+        :rtype: dict[str, int]
+        """
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "evictions": self.evictions,
+        }
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    status_code INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    content BLOB NOT NULL,
+    encoding TEXT,
+    stored_at REAL NOT NULL
+)
+"""
+
+
+class PersistentResponseCache(ResponseCache):
+    """A `ResponseCache` which also writes its entries through to an
+    SQLite database, with the bodies compressed by zlib, so that a new
+    process starts with the responses of the previous one.
+
+    Entries which are still fresh are served right away. Entries which
+    went stale less than `warm_spread` seconds ago are also served, but
+    their expiry is spread evenly over the next `warm_spread` seconds,
+    oldest first, so that they are revalidated a few at a time instead
+    of all in the first scan. Older entries are revalidated as usual.
+    """
+
+    def __init__(self, file_path, warm_spread=None, **kwargs):
+        """
+        :param file_path: path of the database, created if missing
+        :type file_path: os.PathLike
+        :param warm_spread: seconds over which to spread the expiry of
+                recently stale entries, defaults to `default_ttl`
+        :type warm_spread: Optional[float]
+        :param kwargs: arguments of `ResponseCache`
+        """
+        super().__init__(**kwargs)
+        self.warm_spread = self.default_ttl if warm_spread is None else warm_spread
+        directory = path.dirname(file_path)
+        if directory:
+            makedirs(directory, exist_ok=True)
+        self.file_path = file_path
+        self._db_lock = Lock()
+        self._db = sqlite3.connect(file_path, check_same_thread=False)
+        with self._db:
+            self._db.execute(_SCHEMA)
+        self._load()
+
+    def _load(self):
+        rows = self._db.execute(
+            "SELECT url, status_code, headers, content, encoding, stored_at "
+            "FROM responses ORDER BY stored_at DESC LIMIT ?",
+            (self.max_entries,),
+        ).fetchall()
+        now = time()
+        warming = []
+        # Oldest first, so that the most recent end up last in the LRU order
+        for url, status_code, headers, content, encoding, stored_at in reversed(rows):
+            try:
+                content = zlib.decompress(content)
+            except zlib.error:
+                _logger.warning("Dropping corrupt cached response for {}".format(url))
+                continue
+            entry = CacheEntry(
+                url, status_code, loads(headers), content, encoding, stored_at
+            )
+            self._entries[url] = entry
+            if not self.is_fresh(entry, now) and (
+                now - stored_at < self.ttl_for(url) + self.warm_spread
+            ):
+                warming.append(entry)
+        for i, entry in enumerate(warming, 1):
+            expires_at = now + self.warm_spread * i / len(warming)
+            entry.stored_at = expires_at - self.ttl_for(entry.url)
+        _logger.info(
+            "Loaded {} cached responses, {} of them warming up".format(
+                len(self._entries), len(warming)
+            )
+        )
+
+    def _write(self, url, entry):
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses "
+            "(url, status_code, headers, content, encoding, stored_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                url,
+                entry.status_code,
+                dumps(entry.headers),
+                zlib.compress(entry.content),
+                entry.encoding,
+                entry.stored_at,
+            ),
+        )
+
+    def store(self, url, entry):
+        evicted = super().store(url, entry)
+        with self._db_lock, self._db:
+            self._write(url, entry)
+            self._db.executemany(
+                "DELETE FROM responses WHERE url = ?", [(url,) for url in evicted]
+            )
+        return evicted
+
+    def revalidated(self, url, entry):
+        super().revalidated(url, entry)
+        with self._db_lock, self._db:
+            self._db.execute(
+                "UPDATE responses SET stored_at = ? WHERE url = ?",
+                (entry.stored_at, url),
+            )
+
+    def clear(self):
+        super().clear()
+        with self._db_lock, self._db:
+            self._db.execute("DELETE FROM responses")
+
+    def close(self):
+        with self._db_lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
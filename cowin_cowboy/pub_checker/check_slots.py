@@ -14,8 +14,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-__all__ = ["check_available_slots"]
+__all__ = [
+    "DEFAULT_MAX_WORKERS",
+    "iter_location_results",
+    "check_available_slots",
+    "check_available_slots_for_weeks",
+]
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from functools import partial
 from logging import getLogger
 
 from cowin_cowboy.utils.api_utils import (
@@ -23,14 +31,225 @@ from cowin_cowboy.utils.api_utils import (
     check_for_pincode,
     check_for_district,
     check_for_center,
-    merge_center_dicts,
 )
+from cowin_cowboy.utils.center_store import CenterStore
+from cowin_cowboy.utils.stats import metrics
 from cowin_cowboy.pub_checker._api_session import pub_api_session
+from cowin_cowboy.pub_checker.rate_limit import request_priority
 
 _logger = getLogger(__name__)
 
+DEFAULT_MAX_WORKERS = 8
 
-def check_available_slots(date_obj, locations):
+
+def _check_for_center_dict(date_str, center_id, api_session):
+    """Wraps `check_for_center`, so that it returns a center details
+    dict like the other `check_for_*` functions.
+    """
+    center_details = check_for_center(date_str, center_id, api_session)
+    if center_details is None:
+        return None
+    return {center_id: center_details}
+
+
+# Maps the location keys in the config to the function querying them
+_FETCHERS = (
+    ("pincodes", check_for_pincode),
+    ("district_ids", check_for_district),
+    ("center_ids", _check_for_center_dict),
+)
+
+
+# Fields of a center which the planner learns from
+_PLANNER_FIELDS = ("center_id", "pincode", "lat", "long")
+
+
+def _check_for_district_seen(date_str, district_id, api_session, center_filter, seen):
+    """Streams a district response through `center_filter`, keeping the
+    fields the planner learns from of every center in `seen`, including
+    the ones the filter drops, and whether it had any session, for the
+    horizon.
+    """
+
+    def keep_center(center):
+        fields = {field: center[field] for field in _PLANNER_FIELDS if field in center}
+        # Only whether there were sessions, without keeping them
+        fields["sessions"] = bool(center.get("sessions"))
+        seen[center["center_id"]] = fields
+        return center_filter(center)
+
+    return check_for_district(date_str, district_id, api_session, keep_center)
+
+
+def _fetchers(center_filter):
+    """Returns the location keys and fetchers to use, streaming district
+    responses through `center_filter` if given.
+    """
+    if center_filter is None:
+        return _FETCHERS
+    return tuple(
+        (
+            (key, partial(_check_for_district_seen, center_filter=center_filter))
+            if fetcher is check_for_district
+            else (key, fetcher)
+        )
+        for key, fetcher in _FETCHERS
+    )
+
+
+def _location_jobs(date_strs, locations, priority, fetchers=_FETCHERS, horizon=None):
+    """Yields a `(location, date_str, fetcher, priority)` tuple for every
+    unique location and date to query, where `location` is a tuple of
+    the config key and the location ID, in the order of priority. The
+    weeks which the horizon says are not worth fetching are left out.
+    """
+    if locations is None:
+        return []
+    jobs = []
+    for week, date_str in enumerate(date_strs):
+        for key, fetcher in fetchers:
+            seen = set()
+            for location_id in locations.get(key, []):
+                if location_id in seen:
+                    continue
+                seen.add(location_id)
+                location = (key, location_id)
+                if horizon is not None and not horizon.should_fetch(location, week):
+                    metrics.inc("scan_weeks_skipped_total", {"location": key})
+                    continue
+                jobs.append((location, date_str, fetcher, priority(location, week)))
+    jobs.sort(key=lambda job: job[3])
+    return jobs
+
+
+def _week_priority(location, week):
+    return week
+
+
+def _fetch(fetcher, date_str, location_id, api_session, priority):
+    """Returns the result of the fetcher, and the centers the planner and
+    the horizon should learn from, which are all the centers of the
+    response, even the ones dropped while it was streamed.
+    """
+    with request_priority(priority):
+        if isinstance(fetcher, partial) and fetcher.func is _check_for_district_seen:
+            seen = {}
+            return fetcher(date_str, location_id, api_session, seen=seen), seen
+        result = fetcher(date_str, location_id, api_session)
+        return result, result
+
+
+def iter_location_results(
+    date_objs,
+    locations,
+    max_workers=DEFAULT_MAX_WORKERS,
+    api_session=None,
+    priority=None,
+    planner=None,
+    center_filter=None,
+    horizon=None,
+    coverage=None,
+):
+    """Queries every location for every given date, and yields the
+    results in the order the requests finish. When the rate limiter of
+    the session runs out of requests, the requests with a lower
+    priority value are sent first.
+
+    :param date_objs: The first days of the weeks to check
+    :type date_objs: Iterable[datetime.date]
+    :param locations: A dictionary containing the list of PIN codes at
+            key `pincodes`, list of district IDs at key `district_ids`,
+            and list of center IDs at key `center_ids`
+    :type locations: dict
+    :param max_workers: Maximum number of requests in flight at once.
+            If 1, the requests are sent one after the other
+    :type max_workers: int
+    :param api_session: An existing API session, defaults to the public
+            API session
+    :type api_session: requests.Session
+    :param priority: Function taking the location and the index of the
+            week, and returning the priority of the request. Defaults
+            to the index of the week, so nearer weeks go first
+    :type priority: Optional[Callable[[tuple, int], Any]]
+    :param planner: If given, drops the locations already covered by
+            other locations before sending any request, and learns from
+            every response
+    :type planner: Optional[cowin_cowboy.pub_checker.planner.QueryPlanner]
+    :param center_filter: If given, district responses are decoded one
+            center at a time, keeping only the centers this returns, see
+            `check_for_district`
+    :type center_filter: Optional[Callable[[dict], Optional[dict]]]
+    :param horizon: If given, skips the weeks of every location which
+            rarely have any session, and learns from every successful
+            response
+    :type horizon: Optional[cowin_cowboy.pub_checker.horizon.ScanHorizon]
+    :param coverage: If given, records the locations and dates whose
+            request succeeded, and the sessions they returned
+    :type coverage: Optional[cowin_cowboy.utils.snapshot.ScanCoverage]
+
+    :return: Iterator of `(location, date_str, center_dict)` tuples,
+            where `location` is a tuple of the location key and ID, and
+            `center_dict` is empty if the request failed
+    :rtype: Iterator[tuple[tuple[str, int|str], str, dict[int, dict]]]
+    """
+    if api_session is None:
+        api_session = pub_api_session
+    if priority is None:
+        priority = _week_priority
+    if planner is not None and locations is not None:
+        locations = planner.plan(locations)
+    date_strs = [date_to_string(date_obj) for date_obj in date_objs]
+    weeks = {date_str: week for week, date_str in enumerate(date_strs)}
+    jobs = _location_jobs(
+        date_strs, locations, priority, _fetchers(center_filter), horizon
+    )
+
+    for location, date_str, result, seen in _run_jobs(jobs, max_workers, api_session):
+        if result is None:
+            # The request failed, and was logged. It says nothing about
+            # whether the week has sessions, so the horizon does not learn
+            result = seen = {}
+        else:
+            if coverage is not None:
+                coverage.record(location, date_str, result)
+            if horizon is not None:
+                # Unfiltered, as a week whose sessions were all filtered
+                # out still has sessions
+                horizon.record(location, weeks[date_str], seen)
+        if planner is not None:
+            planner.record(location, seen)
+        yield location, date_str, result
+
+
+def _run_jobs(jobs, max_workers, api_session):
+    if max_workers <= 1 or len(jobs) <= 1:
+        for location, date_str, fetcher, job_priority in jobs:
+            yield (location, date_str) + _fetch(
+                fetcher, date_str, location[1], api_session, job_priority
+            )
+        return
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        futures = {
+            executor.submit(
+                _fetch, fetcher, date_str, location[1], api_session, job_priority
+            ): (location, date_str)
+            for location, date_str, fetcher, job_priority in jobs
+        }
+        for future in as_completed(futures):
+            location, date_str = futures[future]
+            yield (location, date_str) + future.result()
+
+
+def check_available_slots(
+    date_obj,
+    locations,
+    max_workers=1,
+    api_session=None,
+    planner=None,
+    center_filter=None,
+    coverage=None,
+):
     """Returns a dict of available vaccination centers for a given week
 
     :param date_obj: The first day of the week to check
@@ -42,33 +261,116 @@ def check_available_slots(date_obj, locations):
             API request will return '401 Forbidden: Unauthorised
             access!'
     :type locations: dict
+    :param max_workers: Maximum number of requests in flight at once
+    :type max_workers: int
+    :param api_session: An existing API session, defaults to the public
+            API session
+    :type api_session: requests.Session
+    :param planner: If given, used to skip redundant requests, see
+            `iter_location_results`
+    :type planner: Optional[cowin_cowboy.pub_checker.planner.QueryPlanner]
+    :param center_filter: If given, used to filter district responses as
+            they arrive, see `iter_location_results`
+    :type center_filter: Optional[Callable[[dict], Optional[dict]]]
+    :param coverage: If given, records which requests succeeded, see
+            `iter_location_results`
+    :type coverage: Optional[cowin_cowboy.utils.snapshot.ScanCoverage]
+
+    :return: A dictionary of center ID -> center details
+    :rtype:  dict[int, dict]
+    """
+    store = CenterStore()
+    _logger.info(
+        "Checking available slots for date {}".format(date_to_string(date_obj))
+    )
+
+    with metrics.stage("scan"):
+        store.merge_many(
+            result
+            for _, _, result in iter_location_results(
+                [date_obj],
+                locations,
+                max_workers,
+                api_session,
+                planner=planner,
+                center_filter=center_filter,
+                coverage=coverage,
+            )
+        )
+
+    return store.centers
+
+
+def check_available_slots_for_weeks(
+    date_obj,
+    weeks,
+    locations,
+    max_workers=DEFAULT_MAX_WORKERS,
+    api_session=None,
+    planner=None,
+    center_filter=None,
+    horizon=None,
+    on_update=None,
+    coverage=None,
+):
+    """Returns a dict of available vaccination centers for the given
+    number of weeks, starting from `date_obj`. All (location, week)
+    requests are sent concurrently, with at most `max_workers` of them
+    in flight at once, and merged as each of them finishes.
+
+    :param date_obj: The first day of the first week to check
+    :type date_obj: datetime.date
+    :param weeks: Number of weeks to check
+    :type weeks: int
+    :param locations: A dictionary of locations to query, see
+            `check_available_slots`
+    :type locations: dict
+    :param max_workers: Maximum number of requests in flight at once
+    :type max_workers: int
+    :param api_session: An existing API session, defaults to the public
+            API session
+    :type api_session: requests.Session
+    :param planner: If given, used to skip redundant requests, see
+            `iter_location_results`
+    :type planner: Optional[cowin_cowboy.pub_checker.planner.QueryPlanner]
+    :param center_filter: If given, used to filter district responses as
+            they arrive, see `iter_location_results`
+    :type center_filter: Optional[Callable[[dict], Optional[dict]]]
+    :param horizon: If given, used to skip the weeks which rarely have
+            any session, see `iter_location_results`
+    :type horizon: Optional[cowin_cowboy.pub_checker.horizon.ScanHorizon]
+    :param on_update: If given, called with the center store and the
+            `(center_id, session)` tuples which were new or changed,
+            right after every response is merged
+    :type on_update: Optional[Callable[[CenterStore, list], Any]]
+    :param coverage: If given, records which requests succeeded, see
+            `iter_location_results`
+    :type coverage: Optional[cowin_cowboy.utils.snapshot.ScanCoverage]
 
     :return: A dictionary of center ID -> center details
     :rtype:  dict[int, dict]
     """
-    center_dict = {}
-    date_str = date_to_string(date_obj)
-    _logger.info("Checking available slots for date {}".format(date_str))
-
-    if locations is not None:
-        pincodes = locations.get("pincodes", [])
-        for pincode in pincodes:
-            pin_dict = check_for_pincode(date_str, pincode, pub_api_session)
-            merge_center_dicts(center_dict, pin_dict)
-
-        district_ids = locations.get("district_ids", [])
-        for district_id in district_ids:
-            district_dict = check_for_district(date_str, district_id, pub_api_session)
-            merge_center_dicts(center_dict, district_dict)
-
-        center_ids = locations.get("center_ids", [])
-        for center_id in center_ids:
-            if center_id not in center_dict:
-                center_details = check_for_center(date_str, center_id, pub_api_session)
-                if center_details is not None:
-                    center_dict[center_id] = center_details
-            center_details = check_for_center(date_str, center_id, pub_api_session)
-            if center_details is not None:
-                merge_center_dicts(center_dict, {center_id: center_details})
-
-    return center_dict
+    store = CenterStore()
+    date_objs = [date_obj + timedelta(weeks=i) for i in range(max(1, weeks))]
+    _logger.info(
+        "Checking available slots for {} week(s) from {}".format(
+            len(date_objs), date_to_string(date_obj)
+        )
+    )
+
+    with metrics.stage("scan"):
+        for _, _, result in iter_location_results(
+            date_objs,
+            locations,
+            max_workers,
+            api_session,
+            planner=planner,
+            center_filter=center_filter,
+            horizon=horizon,
+            coverage=coverage,
+        ):
+            updated = store.merge(result)
+            if on_update is not None and updated:
+                on_update(store, updated)
+
+    return store.centers
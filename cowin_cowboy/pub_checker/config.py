@@ -14,7 +14,73 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-__all__ = ["API_URL", "USER_AGENT"]
+__all__ = [
+    "API_URL",
+    "USER_AGENT",
+    "DEFAULT_CACHE_TTL",
+    "DEFAULT_CACHE_TTLS",
+    "RATE_LIMIT_REQUESTS",
+    "RATE_LIMIT_PERIOD",
+    "RATE_LIMITED_ENDPOINTS",
+    "CONNECT_TIMEOUT",
+    "READ_TIMEOUT",
+    "RETRIES",
+    "RETRY_BACKOFF",
+    "RETRY_BACKOFF_MAX",
+    "RETRY_STATUSES",
+    "HEDGE_PERCENTILE",
+    "HEDGE_MIN_SAMPLES",
+    "BREAKER_FAILURES",
+    "BREAKER_RESET_TIMEOUT",
+    "HORIZON_MIN_HIT_RATE",
+    "HORIZON_MIN_PROBES",
+    "HORIZON_REPROBE_INTERVAL",
+    "HORIZON_DECAY",
+]
 
 API_URL = "https://cdn-api.co-vin.in/api/"
 USER_AGENT = "Mozilla/5.0 (Windows; U; Windows NT 6.1; en-US; rv:1.9.1.5)"
+
+# Time-to-live of cached responses in seconds, per endpoint
+DEFAULT_CACHE_TTL = 60.0
+DEFAULT_CACHE_TTLS = {
+    "calendarByPin": 60.0,
+    "calendarByDistrict": 60.0,
+    "calendarByCenter": 60.0,
+}
+
+# Rate limit of the public API, per IP address
+RATE_LIMIT_REQUESTS = 100
+RATE_LIMIT_PERIOD = 300.0
+# Endpoints which only answer 403 when rate limited. calendarByCenter is
+# left out, as it answers 403 to every request for now.
+RATE_LIMITED_ENDPOINTS = frozenset(["calendarByPin", "calendarByDistrict"])
+
+# Timeouts of API requests in seconds, to connect and to read the response
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10.0
+
+# Failed requests are retried after an exponential backoff with full jitter
+RETRIES = 2
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 8.0
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+# GET requests slower than this percentile of their endpoint's latency are
+# sent again, once enough latencies are known
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+
+# Consecutive failures after which an endpoint is not requested anymore,
+# and the seconds after which it is tried again
+BREAKER_FAILURES = 5
+BREAKER_RESET_TIMEOUT = 300.0
+
+# Weeks ahead of a location which had sessions in less than this fraction
+# of the latest probes (after a few of them) are only probed again every
+# few hours
+HORIZON_MIN_HIT_RATE = 0.05
+HORIZON_MIN_PROBES = 3
+HORIZON_REPROBE_INTERVAL = 6 * 3600.0
+# Weight of the latest probe in the hit rate of a week
+HORIZON_DECAY = 0.2
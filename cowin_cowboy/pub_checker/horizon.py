@@ -0,0 +1,213 @@
+# pub_checker/horizon.py -- learns which weeks ahead are worth fetching
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["ScanHorizon"]
+
+from json import dump, load, JSONDecodeError
+from logging import getLogger
+from os import makedirs, path, replace
+from threading import Lock
+from time import time
+
+from cowin_cowboy.pub_checker.config import (
+    HORIZON_DECAY,
+    HORIZON_MIN_HIT_RATE,
+    HORIZON_MIN_PROBES,
+    HORIZON_REPROBE_INTERVAL,
+)
+
+_logger = getLogger(__name__)
+
+
+class _WeekStats:
+    def __init__(self, hit_rate=0.0, probes=0, last_probed=0.0):
+        self.hit_rate = hit_rate
+        self.probes = probes
+        self.last_probed = last_probed
+
+
+def _has_sessions(result):
+    return any(center.get("sessions") for center in result.values())
+
+
+class ScanHorizon:
+    """Learns how far ahead every location publishes sessions, from the
+    results of every (location, week) it is shown, and tells which of
+    them are worth fetching.
+
+    The first week is always fetched. Other weeks are fetched until they
+    have been probed `min_probes` times, and then as long as their hit
+    rate (a moving average of whether they had any session) stays above
+    `min_hit_rate`. Weeks below it are only probed again once every
+    `reprobe_interval` seconds, so that a change in how far ahead the
+    location publishes is noticed.
+    """
+
+    def __init__(
+        self,
+        min_hit_rate=HORIZON_MIN_HIT_RATE,
+        min_probes=HORIZON_MIN_PROBES,
+        reprobe_interval=HORIZON_REPROBE_INTERVAL,
+        decay=HORIZON_DECAY,
+    ):
+        """
+        :param min_hit_rate: hit rate below which a week is skipped
+        :type min_hit_rate: float
+        :param min_probes: probes of a week before it may be skipped
+        :type min_probes: int
+        :param reprobe_interval: seconds between the probes of a skipped
+                week
+        :type reprobe_interval: float
+        :param decay: weight of the latest probe in the hit rate
+        :type decay: float
+        """
+        self.min_hit_rate = min_hit_rate
+        self.min_probes = min_probes
+        self.reprobe_interval = reprobe_interval
+        self.decay = decay
+        self.weeks = {}
+        self.skipped = 0
+        self.changed = False
+        self._lock = Lock()
+
+    def should_fetch(self, location, week, now=None):
+        """Whether the week of the location is worth fetching now.
+
+        :param location: tuple of the location key and ID
+        :type location: tuple[str, int|str]
+        :param week: index of the week, 0 being the current week
+        :type week: int
+        :param now: UNIX time to check against, defaults to now
+        :type now: Optional[float]
+        :rtype: bool
+        """
+        if week == 0:
+            return True
+        if now is None:
+            now = time()
+        with self._lock:
+            stats = self.weeks.get((location, week))
+            if (
+                stats is None
+                or stats.probes < self.min_probes
+                or stats.hit_rate >= self.min_hit_rate
+                or now - stats.last_probed >= self.reprobe_interval
+            ):
+                return True
+            self.skipped += 1
+            return False
+
+    def record(self, location, week, result, now=None):
+        """Learns from the result of fetching a week of the location.
+
+        :param location: tuple of the location key and ID
+        :type location: tuple[str, int|str]
+        :param week: index of the week, 0 being the current week
+        :type week: int
+        :param result: A dictionary of center ID -> center details
+        :type result: dict[int, dict]
+        :param now: UNIX time of the result, defaults to now
+        :type now: Optional[float]
+        """
+        hit = 1.0 if _has_sessions(result) else 0.0
+        with self._lock:
+            stats = self.weeks.get((location, week))
+            if stats is None:
+                stats = self.weeks[location, week] = _WeekStats(hit)
+            else:
+                stats.hit_rate += self.decay * (hit - stats.hit_rate)
+            stats.probes += 1
+            stats.last_probed = time() if now is None else now
+            self.changed = True
+
+    def horizon(self, location):
+        """Returns the number of weeks ahead of the location which are
+        worth fetching on every scan, counting from the current week.
+
+        :param location: tuple of the location key and ID
+        :type location: tuple[str, int|str]
+        :rtype: int
+        """
+        with self._lock:
+            weeks = [
+                week
+                for (week_location, week), stats in self.weeks.items()
+                if week_location == location
+                and (
+                    stats.probes < self.min_probes
+                    or stats.hit_rate >= self.min_hit_rate
+                )
+            ]
+        return max(weeks, default=0) + 1
+
+    @classmethod
+    def load(cls, file_path, **kwargs):
+        """Loads a horizon saved with `save`. Returns an empty horizon if
+        the file does not exist or cannot be read.
+
+        :param file_path: path of the saved horizon
+        :type file_path: os.PathLike
+        :param kwargs: other arguments of the constructor
+        :rtype: ScanHorizon
+        """
+        horizon = cls(**kwargs)
+        if not path.isfile(file_path):
+            return horizon
+        try:
+            with open(file_path) as horizon_fp:
+                data = load(horizon_fp)
+            for key, location_id, week, hit_rate, probes, last_probed in data.get(
+                "weeks", []
+            ):
+                horizon.weeks[(key, location_id), week] = _WeekStats(
+                    hit_rate, probes, last_probed
+                )
+        except (JSONDecodeError, IOError, AttributeError, TypeError, ValueError):
+            _logger.warning("Could not read horizon file '{}'".format(file_path))
+            return cls(**kwargs)
+        return horizon
+
+    def save(self, file_path):
+        """Saves the horizon, so that it can be loaded in another run.
+
+        :param file_path: path to save the horizon at
+        :type file_path: os.PathLike
+        """
+        with self._lock:
+            data = {
+                "weeks": [
+                    [
+                        key,
+                        location_id,
+                        week,
+                        stats.hit_rate,
+                        stats.probes,
+                        stats.last_probed,
+                    ]
+                    for ((key, location_id), week), stats in self.weeks.items()
+                ]
+            }
+        try:
+            directory = path.dirname(file_path)
+            if directory:
+                makedirs(directory, exist_ok=True)
+            tmp_path = "{}.tmp".format(file_path)
+            with open(tmp_path, "w") as horizon_fp:
+                dump(data, horizon_fp)
+            replace(tmp_path, file_path)
+            self.changed = False
+        except IOError:
+            _logger.warning("Could not save horizon file '{}'".format(file_path))
@@ -0,0 +1,348 @@
+# pub_checker/planner.py -- plans the minimal set of requests to send
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["QueryPlanner", "union_locations"]
+
+from json import dump, load, JSONDecodeError
+from logging import getLogger
+from os import makedirs, path, replace
+from threading import RLock
+
+from cowin_cowboy.utils.geo import GeoIndex, center_point, parse_areas
+
+_logger = getLogger(__name__)
+
+
+def _unique(values):
+    seen = set()
+    unique_values = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            unique_values.append(value)
+    return unique_values
+
+
+def union_locations(locations_list):
+    """Returns the union of several `locations` tables, such as the ones
+    of many configs, keeping the first occurrence of every ID.
+
+    :param locations_list: the tables of locations to join
+    :type locations_list: Iterable[dict]
+    :return: A dictionary of locations, in the same format
+    :rtype: dict
+    """
+    union = {}
+    for locations in locations_list:
+        for key in ("pincodes", "district_ids", "center_ids"):
+            if locations.get(key):
+                union.setdefault(key, []).extend(locations[key])
+    return {key: _unique(location_ids) for key, location_ids in union.items()}
+
+
+class QueryPlanner:
+    """Learns which district each PIN code and center belongs to from
+    the district responses, and uses it to drop the PIN codes and
+    centers whose district is queried anyway.
+
+    It also keeps the coordinates of every center seen in a grid index,
+    to turn the `"near"` areas of the locations into the districts (or
+    PIN codes, for centers of unknown district) of the centers known to
+    be within them.
+    """
+
+    def __init__(self):
+        # PIN code -> IDs of all the districts it was seen in
+        self.pincode_districts = {}
+        # center ID -> ID of its district
+        self.center_districts = {}
+        # center ID -> its PIN code
+        self.center_pincodes = {}
+        # center ID -> its coordinates
+        self.geo = GeoIndex()
+        self.changed = False
+        # Guards all of the above, as planners are shared by the threads of
+        # the scan service
+        self._lock = RLock()
+
+    def record(self, location, centers):
+        """Records the centers returned for a location.
+
+        :param location: tuple of the location key and ID
+        :type location: tuple[str, int|str]
+        :param centers: A dictionary of center ID -> center details
+        :type centers: dict[int, dict]
+        """
+        with self._lock:
+            key, location_id = location
+            for center_id, center in centers.items():
+                point = center_point(center)
+                if point is not None and self.geo.add(center_id, *point):
+                    self.changed = True
+                pincode = center.get("pincode")
+                if pincode is None:
+                    continue
+                pincode = str(pincode)
+                if self.center_pincodes.get(center_id) != pincode:
+                    self.center_pincodes[center_id] = pincode
+                    self.changed = True
+                if key == "district_ids":
+                    districts = self.pincode_districts.setdefault(pincode, set())
+                    if location_id not in districts:
+                        districts.add(location_id)
+                        self.changed = True
+                    if self.center_districts.get(center_id) != location_id:
+                        self.center_districts[center_id] = location_id
+                        self.changed = True
+
+    def expand(self, locations):
+        """Replaces the `"near"` areas of the locations with the districts
+        of the centers known to be within them, or their PIN codes when
+        their district is not known.
+
+        :param locations: A dictionary of locations to query, with a
+                `"near"` table (with the `"lat"`, `"long"` and `"km"` of a
+                circle) or array of tables, see `check_available_slots`
+        :type locations: dict
+        :raises ValueError: if some area is invalid
+        :return: A dictionary of locations, without `"near"`
+        :rtype: dict
+        """
+        with self._lock:
+            if "near" not in locations:
+                return locations
+            expanded = {
+                key: list(locations[key])
+                for key in ("pincodes", "district_ids", "center_ids")
+                if locations.get(key)
+            }
+            for area in parse_areas(locations["near"]):
+                center_ids = self.geo.within(area)
+                if not center_ids:
+                    _logger.warning(
+                        "No known center within {} km of ({}, {}), query a "
+                        "district around it once to learn its centers".format(
+                            area.km, area.lat, area.long
+                        )
+                    )
+                for center_id in center_ids:
+                    if center_id in self.center_districts:
+                        key, location_id = (
+                            "district_ids",
+                            self.center_districts[center_id],
+                        )
+                    elif center_id in self.center_pincodes:
+                        key, location_id = "pincodes", self.center_pincodes[center_id]
+                    else:
+                        key, location_id = "center_ids", center_id
+                    expanded.setdefault(key, []).append(location_id)
+            return {
+                key: _unique(location_ids) for key, location_ids in expanded.items()
+            }
+
+    def plan(self, locations):
+        """Returns the minimal set of locations which covers all the
+        centers of `locations`, as far as the planner knows. `"near"`
+        areas are expanded (see `expand`), duplicate IDs are dropped, then
+        PIN codes whose known centers all belong to one of the districts,
+        and centers whose district or PIN code is queried anyway.
+
+        :param locations: A dictionary of locations to query, see
+                `check_available_slots`
+        :type locations: dict
+        :return: A dictionary of locations, in the same format
+        :rtype: dict
+        """
+        with self._lock:
+            locations = self.expand(locations)
+            district_ids = _unique(locations.get("district_ids", []))
+            districts = set(district_ids)
+
+            requested = _unique(locations.get("pincodes", []))
+            # Known centers of every requested PIN code, including the ones
+            # only seen through the PIN code, whose district is not known
+            pincode_centers = {str(pincode): [] for pincode in requested}
+            for center_id, pincode in self.center_pincodes.items():
+                if pincode in pincode_centers:
+                    pincode_centers[pincode].append(center_id)
+
+            pincodes = []
+            for pincode in requested:
+                center_ids = pincode_centers[str(pincode)]
+                if center_ids and all(
+                    self.center_districts.get(center_id) in districts
+                    for center_id in center_ids
+                ):
+                    _logger.debug(
+                        "PIN code {} is covered by its district".format(pincode)
+                    )
+                else:
+                    pincodes.append(pincode)
+            pincode_set = set(str(pincode) for pincode in pincodes)
+
+            center_ids = []
+            for center_id in _unique(locations.get("center_ids", [])):
+                if (
+                    self.center_districts.get(center_id) in districts
+                    or self.center_pincodes.get(center_id) in pincode_set
+                ):
+                    _logger.debug(
+                        "Center {} is covered by its location".format(center_id)
+                    )
+                else:
+                    center_ids.append(center_id)
+
+            planned = {}
+            if pincodes:
+                planned["pincodes"] = pincodes
+            if district_ids:
+                planned["district_ids"] = district_ids
+            if center_ids:
+                planned["center_ids"] = center_ids
+            return planned
+
+    def covered_results(self, location, fetched):
+        """Returns the centers of a location which was dropped by `plan`,
+        picked out of the results of the locations which cover it.
+
+        :param location: tuple of the location key and ID
+        :type location: tuple[str, int|str]
+        :param fetched: results of the fetched locations for one date, as
+                location -> center details dict
+        :type fetched: dict[tuple[str, int|str], dict[int, dict]]
+        :return: A dictionary of center ID -> center details
+        :rtype: dict[int, dict]
+        """
+        with self._lock:
+            key, location_id = location
+            if location in fetched:
+                return fetched[location]
+
+            if key == "pincodes":
+                pincode = str(location_id)
+                sources = [
+                    ("district_ids", district_id)
+                    for district_id in self.pincode_districts.get(pincode, ())
+                ]
+
+                def belongs(center_id, center):
+                    return str(center.get("pincode")) == pincode
+
+            elif key == "center_ids":
+                sources = [
+                    ("district_ids", self.center_districts.get(location_id)),
+                    ("pincodes", self.center_pincodes.get(location_id)),
+                ]
+
+                def belongs(center_id, center):
+                    return center_id == location_id
+
+            else:
+                return {}
+
+            centers = {}
+            for source in sources:
+                for center_id, center in fetched.get(source, {}).items():
+                    if belongs(center_id, center):
+                        centers[center_id] = center
+            return centers
+
+    def snapshot(self):
+        """Returns everything the planner learned, as plain data which can
+        be saved, or sent to another process and learned with `merge`.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                "pincode_districts": {
+                    pincode: sorted(district_ids)
+                    for pincode, district_ids in self.pincode_districts.items()
+                },
+                "center_districts": dict(self.center_districts),
+                "center_pincodes": dict(self.center_pincodes),
+                "center_points": dict(self.geo.points),
+            }
+
+    def merge(self, snapshot):
+        """Learns everything another planner learned, as returned by its
+        `snapshot`.
+
+        :param snapshot: the snapshot of the other planner, possibly
+                loaded from JSON
+        :type snapshot: dict
+        :raises AttributeError: if the snapshot is not valid
+        :raises TypeError: if the snapshot is not valid
+        :raises ValueError: if the snapshot is not valid
+        """
+        with self._lock:
+            for pincode, district_ids in snapshot.get("pincode_districts", {}).items():
+                districts = self.pincode_districts.setdefault(pincode, set())
+                if not districts.issuperset(district_ids):
+                    districts.update(district_ids)
+                    self.changed = True
+            for center_id, district_id in snapshot.get("center_districts", {}).items():
+                if self.center_districts.get(int(center_id)) != district_id:
+                    self.center_districts[int(center_id)] = district_id
+                    self.changed = True
+            for center_id, pincode in snapshot.get("center_pincodes", {}).items():
+                if self.center_pincodes.get(int(center_id)) != pincode:
+                    self.center_pincodes[int(center_id)] = pincode
+                    self.changed = True
+            for center_id, (lat, long) in snapshot.get("center_points", {}).items():
+                if self.geo.add(int(center_id), lat, long):
+                    self.changed = True
+
+    @classmethod
+    def load(cls, file_path):
+        """Loads a planner saved with `save`. Returns an empty planner if
+        the file does not exist or cannot be read.
+
+        :param file_path: path of the saved planner
+        :type file_path: os.PathLike
+        :rtype: QueryPlanner
+        """
+        planner = cls()
+        if not path.isfile(file_path):
+            return planner
+        try:
+            with open(file_path) as planner_fp:
+                planner.merge(load(planner_fp))
+        except (JSONDecodeError, IOError, AttributeError, TypeError, ValueError):
+            _logger.warning("Could not read planner file '{}'".format(file_path))
+            return cls()
+        planner.changed = False
+        return planner
+
+    def save(self, file_path):
+        """Saves the planner, so that it can be loaded in another run.
+
+        :param file_path: path to save the planner at
+        :type file_path: os.PathLike
+        """
+        with self._lock:
+            data = self.snapshot()
+            try:
+                directory = path.dirname(file_path)
+                if directory:
+                    makedirs(directory, exist_ok=True)
+                tmp_path = "{}.tmp".format(file_path)
+                with open(tmp_path, "w") as planner_fp:
+                    dump(data, planner_fp)
+                replace(tmp_path, file_path)
+                self.changed = False
+            except IOError:
+                _logger.warning("Could not save planner file '{}'".format(file_path))
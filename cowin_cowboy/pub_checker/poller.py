@@ -0,0 +1,308 @@
+# pub_checker/poller.py -- polls locations at adaptive intervals
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["CycleReport", "AdaptivePoller"]
+
+from datetime import date, timedelta
+from logging import getLogger
+from time import monotonic, sleep
+
+from cowin_cowboy.pub_checker.check_slots import (
+    DEFAULT_MAX_WORKERS,
+    iter_location_results,
+)
+from cowin_cowboy.utils.center_store import CAPACITY_PREFIX, CenterStore
+from cowin_cowboy.utils.snapshot import ScanCoverage
+from cowin_cowboy.utils.stats import metrics
+
+_logger = getLogger(__name__)
+
+
+def _fingerprint(results):
+    """Returns a hashable summary of the sessions and their capacities
+    in the results of a location, to detect changes between polls.
+    """
+    return frozenset(
+        (
+            date_str,
+            session.get("session_id"),
+            tuple(
+                sorted(
+                    (key, value)
+                    for key, value in session.items()
+                    if key.startswith(CAPACITY_PREFIX)
+                )
+            ),
+        )
+        for date_str, centers in results.items()
+        for center in centers.values()
+        for session in center.get("sessions", [])
+    )
+
+
+class _LocationState:
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_poll = 0.0
+        self.fingerprint = None
+        self.results = {}
+
+
+class CycleReport:
+    """Summary of one polling cycle of `AdaptivePoller`."""
+
+    def __init__(self, cycle, polled, total, requests, changed, elapsed, next_delay):
+        self.cycle = cycle
+        self.polled = polled
+        self.total = total
+        self.requests = requests
+        self.changed = changed
+        self.elapsed = elapsed
+        self.next_delay = next_delay
+
+    def __str__(self):
+        return (
+            "cycle {}: polled {}/{} locations ({} requests) in {:.2f}s, "
+            "{} changed, next poll in {:.0f}s".format(
+                self.cycle,
+                self.polled,
+                self.total,
+                self.requests,
+                self.elapsed,
+                self.changed,
+                self.next_delay,
+            )
+        )
+
+
+class AdaptivePoller:
+    """Polls the given locations in a loop, reusing the same API session.
+    Every location has its own polling interval: it drops back to
+    `min_interval` whenever the sessions or capacities of the location
+    change, and grows by `backoff` times on every poll where nothing
+    changed, up to `max_interval`.
+    """
+
+    def __init__(
+        self,
+        locations,
+        weeks=1,
+        min_interval=30.0,
+        max_interval=1800.0,
+        backoff=1.5,
+        max_workers=DEFAULT_MAX_WORKERS,
+        api_session=None,
+        planner=None,
+        center_filter=None,
+        horizon=None,
+        on_update=None,
+    ):
+        """
+        :param locations: A dictionary of locations to query, see
+                `check_available_slots`
+        :type locations: dict
+        :param weeks: Number of weeks to check from the current date
+        :type weeks: int
+        :param min_interval: Shortest polling interval, in seconds
+        :type min_interval: float
+        :param max_interval: Longest polling interval, in seconds
+        :type max_interval: float
+        :param backoff: Factor the interval of an unchanged location
+                grows by on every poll
+        :type backoff: float
+        :param max_workers: Maximum number of requests in flight at once
+        :type max_workers: int
+        :param api_session: An existing API session, defaults to the
+                public API session
+        :type api_session: requests.Session
+        :param planner: If given, locations covered by other locations
+                are not polled, see `iter_location_results`
+        :type planner: Optional[cowin_cowboy.pub_checker.planner.QueryPlanner]
+        :param center_filter: If given, used to filter district responses
+                as they arrive, see `iter_location_results`
+        :type center_filter: Optional[Callable[[dict], Optional[dict]]]
+        :param horizon: If given, the weeks of a location which rarely
+                have any session are only polled once in a while, see
+                `iter_location_results`
+        :type horizon: Optional[cowin_cowboy.pub_checker.horizon.ScanHorizon]
+        :param on_update: If given, every response is merged into a
+                center store as soon as it arrives, and this is called
+                with the store and the `(center_id, session)` tuples
+                which were new or changed
+        :type on_update: Optional[Callable[[CenterStore, list], Any]]
+        """
+        self.weeks = max(1, weeks)
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.max_workers = max_workers
+        self.api_session = api_session
+        self.planner = planner
+        self.center_filter = center_filter
+        self.horizon = horizon
+        self.on_update = on_update
+        self.locations = locations
+        self.cycle = 0
+        self._states = {}
+        self._live = CenterStore()
+        self._plan()
+
+    def _plan(self):
+        """Keeps a state for every location which needs to be polled."""
+        locations = self.locations
+        if self.planner is not None:
+            locations = self.planner.plan(locations)
+        states = {}
+        for key in ("pincodes", "district_ids", "center_ids"):
+            for location_id in locations.get(key, []):
+                location = (key, location_id)
+                states[location] = self._states.get(location) or _LocationState(
+                    self.min_interval
+                )
+        self._states = states
+
+    def intervals(self):
+        """Returns the current polling interval of every location.
+
+        :rtype: dict[tuple[str, int|str], float]
+        """
+        return {location: state.interval for location, state in self._states.items()}
+
+    def _priority(self, location, week):
+        # Nearer weeks first, then the locations which change most often
+        return week, self._states[location].interval
+
+    def due_locations(self, now=None):
+        """Returns the locations which are due for polling.
+
+        :param now: monotonic time to check against, defaults to now
+        :type now: Optional[float]
+        :return: A dictionary of locations, in the same format as the
+                `locations` in the config
+        :rtype: dict
+        """
+        if now is None:
+            now = monotonic()
+        due = {}
+        for (key, location_id), state in self._states.items():
+            if state.next_poll <= now:
+                due.setdefault(key, []).append(location_id)
+        return due
+
+    def next_delay(self, now=None):
+        """Returns the number of seconds until the next location is due.
+
+        :rtype: float
+        """
+        if now is None:
+            now = monotonic()
+        if not self._states:
+            return self.max_interval
+        return max(0.0, min(state.next_poll for state in self._states.values()) - now)
+
+    def poll(self):
+        """Polls all the locations which are due, and adapts their
+        polling intervals.
+
+        :return: the report of this cycle
+        :rtype: CycleReport
+        """
+        self.cycle += 1
+        if self.planner is not None:
+            self._plan()
+        started = monotonic()
+        due = self.due_locations(started)
+        date_today = date.today()
+        date_objs = [date_today + timedelta(weeks=i) for i in range(self.weeks)]
+
+        fresh_results = {}
+        requests = 0
+        coverage = ScanCoverage()
+        with metrics.stage("scan"):
+            for location, date_str, result in iter_location_results(
+                date_objs,
+                due,
+                self.max_workers,
+                self.api_session,
+                self._priority,
+                planner=self.planner,
+                center_filter=self.center_filter,
+                horizon=self.horizon,
+                coverage=coverage,
+            ):
+                if not coverage.covers(location, date_str):
+                    # Keeps what the last successful request returned
+                    result = self._states[location].results.get(date_str, {})
+                fresh_results.setdefault(location, {})[date_str] = result
+                requests += 1
+                if self.on_update is not None:
+                    updated = self._live.merge(result)
+                    if updated:
+                        self.on_update(self._live, updated)
+
+        changed = 0
+        finished = monotonic()
+        for location, results in fresh_results.items():
+            state = self._states[location]
+            fingerprint = _fingerprint(results)
+            if fingerprint != state.fingerprint:
+                changed += 1
+                state.interval = self.min_interval
+            else:
+                state.interval = min(self.max_interval, state.interval * self.backoff)
+            _logger.debug(
+                "Next poll of {} {} in {:.0f}s".format(
+                    location[0], location[1], state.interval
+                )
+            )
+            state.fingerprint = fingerprint
+            state.results = results
+            state.next_poll = finished + state.interval
+
+        return CycleReport(
+            self.cycle,
+            len(fresh_results),
+            len(self._states),
+            requests,
+            changed,
+            finished - started,
+            self.next_delay(finished),
+        )
+
+    def centers(self):
+        """Returns the latest results of all the locations, merged into
+        a single center details dict.
+
+        :return: A dictionary of center ID -> center details
+        :rtype: dict[int, dict]
+        """
+        store = CenterStore()
+        for state in self._states.values():
+            store.merge_many(state.results.values())
+        return store.centers
+
+    def run(self, on_cycle=None):
+        """Polls forever, sleeping until the next location is due.
+
+        :param on_cycle: called with the poller and the `CycleReport`
+                after every cycle, polling stops if it returns `False`
+        :type on_cycle: Optional[Callable[[AdaptivePoller, CycleReport], Any]]
+        """
+        while True:
+            report = self.poll()
+            if on_cycle is not None and on_cycle(self, report) is False:
+                return
+            sleep(self.next_delay())
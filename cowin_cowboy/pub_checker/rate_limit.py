@@ -0,0 +1,186 @@
+# pub_checker/rate_limit.py -- keeps requests within the API rate limit
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["RateLimiter", "request_priority", "current_priority"]
+
+from contextlib import contextmanager
+from heapq import heappop, heappush
+from itertools import count
+from logging import getLogger
+from threading import Condition, local
+from time import monotonic
+
+from cowin_cowboy.pub_checker.config import RATE_LIMIT_PERIOD, RATE_LIMIT_REQUESTS
+
+_logger = getLogger(__name__)
+
+_local = local()
+
+
+def current_priority():
+    """Returns the priority of the requests sent by the current thread.
+    Lower values are sent first, defaults to 0.
+    """
+    return getattr(_local, "priority", 0)
+
+
+@contextmanager
+def request_priority(priority):
+    """Context manager, which sets the priority of all the requests sent
+    by the current thread within it.
+
+    :param priority: priority of the requests, lower values are sent
+            first. Any comparable value, such as a tuple, may be used
+    """
+    old_priority = current_priority()
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = old_priority
+
+
+class RateLimiter:
+    """A token bucket, shared by all the threads sending requests. Every
+    request takes a token, and a request which finds the bucket empty
+    waits in a queue, ordered by priority, until a token is added.
+
+    The bucket holds up to `burst` tokens, and the remaining
+    `max_requests - burst` are added evenly over `period`, so that no
+    window of `period` seconds sees more than `max_requests` requests.
+    """
+
+    def __init__(
+        self, max_requests=RATE_LIMIT_REQUESTS, period=RATE_LIMIT_PERIOD, burst=None
+    ):
+        """
+        :param max_requests: number of requests allowed per `period`
+        :type max_requests: int
+        :param period: length of the rate limit window, in seconds
+        :type period: float
+        :param burst: number of requests which can be sent at once,
+                defaults to half of `max_requests`
+        :type burst: Optional[int]
+        """
+        if burst is None:
+            burst = max(1, max_requests // 2)
+        self.max_requests = max_requests
+        self.period = period
+        self.burst = min(burst, max_requests)
+        self.rate = max(1, max_requests - self.burst) / period
+        self.acquired = 0
+        self.waited = 0
+        self._tokens = float(self.burst)
+        self._updated = monotonic()
+        self._waiters = []
+        self._seq = count()
+        self._cond = Condition()
+
+    @classmethod
+    def from_config(cls, rate_limit_config):
+        """Creates a rate limiter from the `"rate_limit"` table of the
+        config, which may have the `"requests"`, `"period"` and
+        `"burst"` fields.
+
+        :param rate_limit_config: the rate limit table of the config
+        :type rate_limit_config: dict
+        :raises ValueError: if some field has an invalid value
+        :rtype: RateLimiter
+        """
+        if not isinstance(rate_limit_config, dict):
+            raise ValueError("rate_limit should be a table")
+        max_requests = rate_limit_config.get("requests", RATE_LIMIT_REQUESTS)
+        period = rate_limit_config.get("period", RATE_LIMIT_PERIOD)
+        burst = rate_limit_config.get("burst")
+        if not isinstance(max_requests, int) or max_requests < 1:
+            raise ValueError('"requests" should be a positive integer')
+        if not isinstance(period, (int, float)) or period <= 0:
+            raise ValueError('"period" should be a positive number')
+        if burst is not None and (not isinstance(burst, int) or burst < 1):
+            raise ValueError('"burst" should be a positive integer')
+        return cls(max_requests, period, burst)
+
+    def _refill(self, now):
+        self._tokens = min(
+            float(self.burst), self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def acquire(self, priority=None):
+        """Takes a token, waiting until one is available, and until all
+        waiting requests with a lower priority value have taken theirs.
+
+        :param priority: priority of the request, defaults to the one
+                set by `request_priority`
+        """
+        if priority is None:
+            priority = current_priority()
+        with self._cond:
+            waiter = (priority, next(self._seq))
+            heappush(self._waiters, waiter)
+            waited = False
+            while True:
+                self._refill(monotonic())
+                if self._waiters[0] == waiter and self._tokens >= 1:
+                    heappop(self._waiters)
+                    self._tokens -= 1
+                    self.acquired += 1
+                    if waited:
+                        self.waited += 1
+                    # Let the next waiter check for a token
+                    self._cond.notify_all()
+                    return
+                waited = True
+                if self._waiters[0] == waiter:
+                    self._cond.wait(max(0.0, (1 - self._tokens) / self.rate))
+                else:
+                    # Woken up once the waiter ahead has taken its token
+                    self._cond.wait()
+
+    def try_acquire(self):
+        """Takes a token only if one is available right away, and no
+        request is waiting for it.
+
+        :return: whether a token was taken
+        :rtype: bool
+        """
+        with self._cond:
+            self._refill(monotonic())
+            if self._waiters or self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self.acquired += 1
+            return True
+
+    def penalize(self):
+        """Empties the bucket, when the API says the rate limit was hit
+        anyway, such as when another process shares the same IP.
+        """
+        with self._cond:
+            self._refill(monotonic())
+            self._tokens = 0.0
+        _logger.warning("Rate limit hit, pausing requests")
+
+    def stats(self):
+        """Returns the counters of the rate limiter.
+
+        :rtype: dict[str, int]
+        """
+        return {
+            "acquired": self.acquired,
+            "waited": self.waited,
+            "queued": len(self._waiters),
+        }
@@ -0,0 +1,357 @@
+# pub_checker/replay.py -- records API traffic, and replays it offline
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["ReplaySession", "TrafficRecorder", "replay_traffic"]
+
+from collections import deque
+from datetime import datetime
+import gzip
+from json import dumps, loads
+from logging import getLogger
+from os import makedirs, path
+from queue import Queue
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from urllib.parse import parse_qsl, urlsplit
+
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests_toolbelt.sessions import BaseUrlSession
+
+from cowin_cowboy.pub_checker.cache import CacheEntry, endpoint_name
+from cowin_cowboy.pub_checker.check_slots import (
+    DEFAULT_MAX_WORKERS,
+    check_available_slots,
+)
+from cowin_cowboy.pub_checker.config import API_URL
+from cowin_cowboy.utils.center_store import CenterStore
+from cowin_cowboy.utils.stats import metrics
+
+_logger = getLogger(__name__)
+
+# Response headers worth keeping, the rest only make the log bigger
+RECORDED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+# Maps every endpoint to the location key of the config, and the query
+# parameter holding the location ID
+_ENDPOINT_LOCATIONS = {
+    "calendarByPin": ("pincodes", "pincode", str),
+    "calendarByDistrict": ("district_ids", "district_id", int),
+    "calendarByCenter": ("center_ids", "center_id", int),
+}
+
+_STOP = object()
+
+
+def _request_key(method, url):
+    """Identifies a request regardless of the base URL and the order of
+    its query parameters.
+    """
+    return method, endpoint_name(url), tuple(sorted(parse_qsl(urlsplit(url).query)))
+
+
+class TrafficRecorder:
+    """Writes every response received by a `PubApiSession` (set as its
+    `recorder`) to a gzip compressed log, one JSON line per response,
+    with the time its request was sent (`"t"`, in seconds since the
+    recorder was created) and how long it took (`"elapsed"`). Requests
+    which failed without a response are recorded with their `"error"`.
+
+    Bodies are kept as they were received, malformed ones included, and
+    are compressed by a background thread, so that recording does not
+    slow the scan down. Streamed bodies are read in full when recorded.
+    """
+
+    def __init__(self, file_path, compresslevel=6):
+        """
+        :param file_path: path of the log, replaced if it exists
+        :type file_path: os.PathLike
+        :param compresslevel: gzip compression level, from 1 to 9
+        :type compresslevel: int
+        :raises OSError: if the log cannot be created
+        """
+        directory = path.dirname(file_path)
+        if directory:
+            makedirs(directory, exist_ok=True)
+        self.file_path = file_path
+        self.recorded = 0
+        self._file = gzip.open(file_path, "wt", compresslevel, encoding="utf-8")
+        self._origin = perf_counter()
+        self._queue = Queue()
+        self._thread = Thread(target=self._run, name="traffic-recorder", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is _STOP:
+                return
+            content = record.pop("content", None)
+            if content is not None:
+                # Keeps bytes which are not valid UTF-8 as lone surrogates
+                record["body"] = content.decode("utf-8", "surrogateescape")
+            try:
+                self._file.write(dumps(record) + "\n")
+                # After every burst, so that a killed process keeps its log
+                if self._queue.empty():
+                    self._file.flush()
+            except OSError as e:
+                _logger.warning("Could not record response: {}".format(e))
+                continue
+            self.recorded += 1
+
+    def record(self, request, response, start, elapsed):
+        """Records a response.
+
+        :param request: the request which was sent
+        :type request: requests.PreparedRequest
+        :param response: the response, whose body is read if it was not
+        :type response: requests.Response
+        :param start: `time.perf_counter()` when the request was sent
+        :type start: float
+        :param elapsed: seconds until the response arrived
+        :type elapsed: float
+        """
+        self._queue.put(
+            {
+                "t": start - self._origin,
+                "elapsed": elapsed,
+                "method": request.method,
+                "url": request.url,
+                "status": response.status_code,
+                "headers": {
+                    name: response.headers[name]
+                    for name in RECORDED_HEADERS
+                    if name in response.headers
+                },
+                "encoding": response.encoding,
+                "content": response.content,
+            }
+        )
+
+    def record_error(self, request, start, elapsed, error):
+        """Records a request which failed without a response."""
+        self._queue.put(
+            {
+                "t": start - self._origin,
+                "elapsed": elapsed,
+                "method": request.method,
+                "url": request.url,
+                "error": str(error),
+            }
+        )
+
+    def close(self):
+        """Writes the pending records, and closes the log."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        _logger.info(
+            "Recorded {} responses to '{}'".format(self.recorded, self.file_path)
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ReplaySession(BaseUrlSession):
+    """A session answering requests from a log written by
+    `TrafficRecorder`, without any network. Every request gets the next
+    recorded response to the same endpoint and query parameters, whatever
+    the base URL, and requests which are not in the log fail with a
+    `requests.exceptions.ConnectionError`.
+
+    Responses arrive when they did while recording, relative to the first
+    request, divided by `speed`: 2 replays twice as fast, and 0 as fast as
+    possible.
+    """
+
+    def __init__(self, file_path, speed=1.0, base_url=API_URL):
+        """
+        :param file_path: path of the log
+        :type file_path: os.PathLike
+        :param speed: how many times faster than recorded to replay, or 0
+                to not wait at all
+        :type speed: float
+        :param base_url: base URL of the requests, which does not need to
+                be the recorded one
+        :type base_url: str
+        :raises OSError: if the log cannot be read
+        :raises ValueError: if the log is not valid
+        """
+        super(ReplaySession, self).__init__(base_url=base_url)
+        if speed < 0:
+            raise ValueError("speed should not be negative")
+        self.speed = speed
+        self.records = []
+        with gzip.open(file_path, "rt", encoding="utf-8") as log_fp:
+            try:
+                for line_number, line in enumerate(log_fp, 1):
+                    try:
+                        record = loads(line)
+                        record["key"] = _request_key(record["method"], record["url"])
+                    except (ValueError, KeyError, TypeError):
+                        raise ValueError(
+                            "invalid record at line {} of '{}'".format(
+                                line_number, file_path
+                            )
+                        )
+                    self.records.append(record)
+            except EOFError:
+                # The recording process was killed before closing the log
+                _logger.warning("Log '{}' is cut short".format(file_path))
+        self.records.sort(key=lambda record: record["t"])
+        self.misses = 0
+        self._pending = {}
+        for record in self.records:
+            self._pending.setdefault(record["key"], deque()).append(record)
+        self._origin = None
+        self._lock = Lock()
+        _logger.info(
+            "Loaded {} recorded responses from '{}'".format(
+                len(self.records), file_path
+            )
+        )
+
+    def cycles(self):
+        """Splits the log into scans, a new one starting whenever a
+        request is sent again, and returns the locations of every scan.
+
+        :return: for every scan, a dict of the `datetime.date` of every
+                week to a `locations` table of what was requested for it
+        :rtype: list[dict[datetime.date, dict]]
+        """
+        cycles = []
+        seen = None
+        for record in self.records:
+            location = _ENDPOINT_LOCATIONS.get(record["key"][1])
+            params = dict(record["key"][2])
+            if location is None or "date" not in params:
+                continue
+            if seen is None or record["key"] in seen:
+                seen = set()
+                cycles.append({})
+            seen.add(record["key"])
+            location_key, param, convert = location
+            try:
+                date_obj = datetime.strptime(params["date"], "%d-%m-%Y").date()
+                location_id = convert(params[param])
+            except (KeyError, ValueError):
+                continue
+            locations = cycles[-1].setdefault(date_obj, {})
+            locations.setdefault(location_key, []).append(location_id)
+        return cycles
+
+    def send(self, request, **kwargs):
+        key = _request_key(request.method, request.url)
+        with self._lock:
+            now = perf_counter()
+            if self._origin is None and self.records:
+                self._origin = now - self.records[0]["t"] / (self.speed or 1)
+            pending = self._pending.get(key)
+            record = pending.popleft() if pending else None
+        if record is None:
+            self.misses += 1
+            metrics.inc("replay_misses_total", {"endpoint": key[1]})
+            raise RequestsConnectionError(
+                "{} is not in the replay log".format(request.url), request=request
+            )
+
+        if self.speed:
+            due = self._origin + (record["t"] + record["elapsed"]) / self.speed
+            delay = due - perf_counter()
+            if delay > 0:
+                sleep(delay)
+        metrics.inc("replay_responses_total", {"endpoint": key[1]})
+        if "error" in record:
+            raise RequestsConnectionError(record["error"], request=request)
+        body = record.get("body")
+        entry = CacheEntry(
+            request.url,
+            record["status"],
+            record.get("headers", {}),
+            b"" if body is None else body.encode("utf-8", "surrogateescape"),
+            record.get("encoding"),
+        )
+        return entry.to_response(request)
+
+
+def replay_traffic(
+    file_path,
+    speed=1.0,
+    filters=None,
+    max_workers=DEFAULT_MAX_WORKERS,
+    on_update=None,
+    coverage=None,
+):
+    """Replays a log written by `TrafficRecorder` through
+    `check_available_slots`, scan by scan (see `ReplaySession.cycles`),
+    merging and filtering the responses like a scan of the API would,
+    without any network.
+
+    :param file_path: path of the log
+    :type file_path: os.PathLike
+    :param speed: how many times faster than recorded to replay, or 0 to
+            replay as fast as possible
+    :type speed: float
+    :param filters: If given, only the sessions passing them are kept
+    :type filters: Optional[cowin_cowboy.filters.CompiledFilters]
+    :param max_workers: Maximum number of requests in flight at once
+    :type max_workers: int
+    :param on_update: If given, called with the center store and the new
+            or changed sessions, see `check_available_slots_for_weeks`
+    :type on_update: Optional[Callable[[CenterStore, list], Any]]
+    :param coverage: If given, cleared before every scan, and filled in
+            with the requests of the scan which succeeded
+    :type coverage: Optional[cowin_cowboy.utils.snapshot.ScanCoverage]
+    :raises OSError: if the log cannot be read
+    :raises ValueError: if the log is not valid
+    :return: Iterator of the number of every scan, and a dictionary of
+            center ID -> center details available in it
+    :rtype: Iterator[tuple[int, dict[int, dict]]]
+    """
+    session = ReplaySession(file_path, speed)
+    for cycle, weeks in enumerate(session.cycles(), 1):
+        store = CenterStore()
+        start = perf_counter()
+        if coverage is not None:
+            coverage.clear()
+        for date_obj in sorted(weeks):
+            centers = check_available_slots(
+                date_obj,
+                weeks[date_obj],
+                max_workers,
+                api_session=session,
+                coverage=coverage,
+            )
+            updated = store.merge(centers)
+            if on_update is not None and updated:
+                on_update(store, updated)
+        centers = store.centers
+        if filters is not None:
+            with metrics.stage("filter"):
+                centers = filters.filter_centers(centers)
+        _logger.info(
+            "Replayed scan {} in {:.3f}s".format(cycle, perf_counter() - start)
+        )
+        yield cycle, centers
+    if session.misses:
+        _logger.warning("{} requests were not in the replay log".format(session.misses))
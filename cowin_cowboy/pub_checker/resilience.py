@@ -0,0 +1,297 @@
+# pub_checker/resilience.py -- timeouts, retries, hedging and circuit breaking
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = [
+    "CircuitBreaker",
+    "CircuitOpenError",
+    "LatencyTracker",
+    "NetworkPolicy",
+]
+
+from collections import deque
+from logging import getLogger
+from random import uniform
+from threading import Lock
+from time import monotonic
+
+from requests.exceptions import RequestException
+
+from cowin_cowboy.pub_checker.config import (
+    BREAKER_FAILURES,
+    BREAKER_RESET_TIMEOUT,
+    CONNECT_TIMEOUT,
+    HEDGE_MIN_SAMPLES,
+    HEDGE_PERCENTILE,
+    READ_TIMEOUT,
+    RETRIES,
+    RETRY_BACKOFF,
+    RETRY_BACKOFF_MAX,
+    RETRY_STATUSES,
+)
+
+_logger = getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(RequestException):
+    """Raised instead of sending a request to an endpoint whose circuit
+    is open.
+    """
+
+
+class CircuitBreaker:
+    """Keeps count of the consecutive failures of every endpoint. After
+    `failure_threshold` of them, the circuit of the endpoint opens, and
+    its requests fail right away. After `reset_timeout` seconds, a single
+    request is let through as a probe: the circuit closes again if it
+    succeeds, and stays open for another `reset_timeout` if it fails.
+    """
+
+    def __init__(
+        self, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_TIMEOUT
+    ):
+        """
+        :param failure_threshold: consecutive failures which open the circuit
+        :type failure_threshold: int
+        :param reset_timeout: seconds until an open circuit is probed
+        :type reset_timeout: float
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = {}
+        self._opened_at = {}
+        self._probing = set()
+        self._lock = Lock()
+
+    def state(self, endpoint):
+        """Returns `"closed"`, `"open"` or `"half-open"`.
+
+        :param endpoint: name of the endpoint, such as `calendarByCenter`
+        :type endpoint: str
+        :rtype: str
+        """
+        with self._lock:
+            opened_at = self._opened_at.get(endpoint)
+            if opened_at is None:
+                return STATE_CLOSED
+            if endpoint in self._probing or (
+                monotonic() - opened_at < self.reset_timeout
+            ):
+                return STATE_OPEN
+            return STATE_HALF_OPEN
+
+    def allow(self, endpoint):
+        """Whether a request may be sent to the endpoint. A request let
+        through a half-open circuit must be followed by `record`.
+
+        :param endpoint: name of the endpoint
+        :type endpoint: str
+        :rtype: bool
+        """
+        with self._lock:
+            opened_at = self._opened_at.get(endpoint)
+            if opened_at is None:
+                return True
+            if endpoint in self._probing or (
+                monotonic() - opened_at < self.reset_timeout
+            ):
+                return False
+            self._probing.add(endpoint)
+            return True
+
+    def record(self, endpoint, success):
+        """Records the outcome of a request to the endpoint.
+
+        :param endpoint: name of the endpoint
+        :type endpoint: str
+        :param success: whether the endpoint answered properly
+        :type success: bool
+        """
+        with self._lock:
+            self._probing.discard(endpoint)
+            if success:
+                self._failures.pop(endpoint, None)
+                if self._opened_at.pop(endpoint, None) is not None:
+                    _logger.info("Closing circuit of {}".format(endpoint))
+                return
+            failures = self._failures.get(endpoint, 0) + 1
+            self._failures[endpoint] = failures
+            if endpoint in self._opened_at or failures >= self.failure_threshold:
+                if endpoint not in self._opened_at:
+                    _logger.warning(
+                        "{} failed {} times in a row, not requesting it for "
+                        "{} seconds".format(endpoint, failures, self.reset_timeout)
+                    )
+                self._opened_at[endpoint] = monotonic()
+
+
+class LatencyTracker:
+    """Keeps the latest latencies of every endpoint, to tell when a
+    request is slow enough to be worth hedging.
+    """
+
+    def __init__(
+        self, percentile=HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES, window=200
+    ):
+        """
+        :param percentile: fraction of the latencies below the threshold
+        :type percentile: float
+        :param min_samples: latencies needed before there is a threshold
+        :type min_samples: int
+        :param window: number of latest latencies kept per endpoint
+        :type window: int
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self._latencies = {}
+        self._lock = Lock()
+
+    def observe(self, endpoint, seconds):
+        with self._lock:
+            latencies = self._latencies.get(endpoint)
+            if latencies is None:
+                latencies = self._latencies[endpoint] = deque(maxlen=self.window)
+            latencies.append(seconds)
+
+    def threshold(self, endpoint):
+        """Returns the latency percentile of the endpoint in seconds, or
+        `None` while too few latencies are known.
+
+        :rtype: Optional[float]
+        """
+        with self._lock:
+            latencies = self._latencies.get(endpoint)
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+
+
+class NetworkPolicy:
+    """How `PubApiSession` deals with a slow or failing API: the timeouts
+    of every request, the retries of failed requests, the hedging of slow
+    GET requests, and the circuit breaker of every endpoint.
+    """
+
+    def __init__(
+        self,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        retries=RETRIES,
+        backoff=RETRY_BACKOFF,
+        max_backoff=RETRY_BACKOFF_MAX,
+        hedge_percentile=HEDGE_PERCENTILE,
+        breaker_failures=BREAKER_FAILURES,
+        breaker_reset_timeout=BREAKER_RESET_TIMEOUT,
+    ):
+        """
+        :param connect_timeout: seconds to wait for a connection
+        :type connect_timeout: float
+        :param read_timeout: seconds to wait for the response to arrive
+        :type read_timeout: float
+        :param retries: number of times a failed request is sent again
+        :type retries: int
+        :param backoff: base of the exponential backoff, in seconds
+        :type backoff: float
+        :param max_backoff: longest backoff, in seconds
+        :type max_backoff: float
+        :param hedge_percentile: latency percentile after which a GET
+                request is sent again, or `None` to never hedge requests
+        :type hedge_percentile: Optional[float]
+        :param breaker_failures: consecutive failures which open the
+                circuit of an endpoint
+        :type breaker_failures: int
+        :param breaker_reset_timeout: seconds until an open circuit is
+                probed again
+        :type breaker_reset_timeout: float
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.latencies = None
+        if hedge_percentile is not None:
+            self.latencies = LatencyTracker(hedge_percentile)
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset_timeout)
+
+    @classmethod
+    def from_config(cls, network_config):
+        """Creates a policy from the `"network"` table of the config,
+        which may have the `"connect_timeout"`, `"read_timeout"`,
+        `"retries"`, `"backoff"`, `"max_backoff"`, `"hedge_percentile"`
+        (`null` to never hedge requests), `"breaker_failures"` and
+        `"breaker_reset_timeout"` fields.
+
+        :param network_config: the network table of the config
+        :type network_config: dict
+        :raises ValueError: if some field has an invalid value
+        :rtype: NetworkPolicy
+        """
+        if not isinstance(network_config, dict):
+            raise ValueError("network should be a table")
+        kwargs = {}
+        for name in (
+            "connect_timeout",
+            "read_timeout",
+            "backoff",
+            "max_backoff",
+            "breaker_reset_timeout",
+        ):
+            if name in network_config:
+                value = network_config[name]
+                if not isinstance(value, (int, float)) or value <= 0:
+                    raise ValueError('"{}" should be a positive number'.format(name))
+                kwargs[name] = value
+        for name, minimum in (("retries", 0), ("breaker_failures", 1)):
+            if name in network_config:
+                value = network_config[name]
+                if not isinstance(value, int) or value < minimum:
+                    raise ValueError(
+                        '"{}" should be an integer, at least {}'.format(name, minimum)
+                    )
+                kwargs[name] = value
+        if "hedge_percentile" in network_config:
+            value = network_config["hedge_percentile"]
+            if value is not None and (
+                not isinstance(value, (int, float)) or not 0 < value < 1
+            ):
+                raise ValueError('"hedge_percentile" should be between 0 and 1')
+            kwargs["hedge_percentile"] = value
+        return cls(**kwargs)
+
+    def should_retry(self, attempt, response=None):
+        """Whether to send the request again, after its `attempt`-th
+        failure (counting from 0), either an exception or a response with
+        a retryable status code.
+
+        :rtype: bool
+        """
+        if attempt >= self.retries:
+            return False
+        return response is None or response.status_code in RETRY_STATUSES
+
+    def backoff_delay(self, attempt):
+        """Returns the seconds to wait after the `attempt`-th failure,
+        drawn uniformly up to the exponential backoff ("full jitter"), so
+        that the retries of concurrent requests are spread out.
+
+        :rtype: float
+        """
+        return uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
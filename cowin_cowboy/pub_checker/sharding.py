@@ -0,0 +1,506 @@
+# pub_checker/sharding.py -- splits a scan across processes and hosts
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = [
+    "check_available_slots_sharded",
+    "parse_address",
+    "partition_locations",
+    "run_shard_worker",
+]
+
+import json
+from datetime import timedelta
+from logging import getLogger
+from multiprocessing import get_context
+from multiprocessing.managers import BaseManager
+from queue import Empty, Queue
+from threading import Event, Thread
+from time import monotonic, perf_counter, sleep
+
+from requests_toolbelt.cookies.forgetful import ForgetfulCookieJar
+
+from cowin_cowboy.pub_checker._api_session import PubApiSession, pub_api_session
+from cowin_cowboy.pub_checker.check_slots import (
+    DEFAULT_MAX_WORKERS,
+    iter_location_results,
+)
+from cowin_cowboy.pub_checker.config import RATE_LIMIT_REQUESTS, USER_AGENT
+from cowin_cowboy.pub_checker.planner import QueryPlanner
+from cowin_cowboy.pub_checker.rate_limit import RateLimiter
+from cowin_cowboy.pub_checker.resilience import NetworkPolicy
+from cowin_cowboy.utils.api_utils import date_to_string
+from cowin_cowboy.utils.center_store import CenterStore
+from cowin_cowboy.utils.snapshot import ScanCoverage
+from cowin_cowboy.utils.stats import metrics
+
+_logger = getLogger(__name__)
+
+# Seconds a worker waits for a job before asking again, and for the
+# coordinator to come up
+WORKER_POLL_INTERVAL = 1.0
+WORKER_CONNECT_TIMEOUT = 30.0
+
+# Seconds between the heartbeats of a worker scanning a shard, and
+# without any after which the coordinator hands the shard out again, at
+# most until it was handed out `SHARD_ATTEMPTS` times
+WORKER_HEARTBEAT_INTERVAL = 10.0
+SHARD_TIMEOUT = 60.0
+SHARD_ATTEMPTS = 3
+
+# Heaviest locations first, so that they are spread the most evenly
+_LOCATION_KEYS = ("district_ids", "pincodes", "center_ids")
+
+
+def partition_locations(locations, shards):
+    """Splits a `locations` table into at most `shards` tables with no
+    location in common, dealing the district IDs, then the PIN codes,
+    then the center IDs in turn, so that every shard gets about as many
+    requests.
+
+    :param locations: A dictionary of locations to query, see
+            `check_available_slots`
+    :type locations: dict
+    :param shards: number of tables to split into
+    :type shards: int
+    :return: the non-empty tables, in the same format
+    :rtype: list[dict]
+    """
+    partitions = [{} for _ in range(max(1, shards))]
+    turn = 0
+    for key in _LOCATION_KEYS:
+        seen = set()
+        for location_id in locations.get(key, []):
+            if location_id in seen:
+                continue
+            seen.add(location_id)
+            partitions[turn % len(partitions)].setdefault(key, []).append(location_id)
+            turn += 1
+    return [partition for partition in partitions if partition]
+
+
+def parse_address(address):
+    """Parses a `host:port` address.
+
+    :param address: the address
+    :type address: str
+    :raises ValueError: if it is not a `host:port` address
+    :rtype: tuple[str, int]
+    """
+    host, sep, port = address.rpartition(":")
+    if not sep or not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError("'{}' should be a host:port address".format(address))
+    return host or "127.0.0.1", int(port)
+
+
+def _limiter_config(limiter):
+    """Returns the rate limit table of a `RateLimiter`, or `None`."""
+    if limiter is None:
+        return None
+    return {
+        "requests": limiter.max_requests,
+        "period": limiter.period,
+        "burst": limiter.burst,
+    }
+
+
+def _split_rate_limit(rate_limit_config, shares):
+    """Returns the rate limit table giving every one of `shares` processes
+    sharing an IP address an equal part of its requests.
+    """
+    if rate_limit_config is None or shares <= 1:
+        return rate_limit_config
+    split = dict(rate_limit_config)
+    split["requests"] = max(1, split.get("requests", RATE_LIMIT_REQUESTS) // shares)
+    if split.get("burst") is not None:
+        split["burst"] = max(1, split["burst"] // shares)
+    return split
+
+
+# Session of the worker process, kept across its jobs so that its rate
+# limit holds for all of them, with the settings it was made with
+_worker_session = None
+_worker_settings = None
+
+
+def _session_for(job):
+    global _worker_session, _worker_settings
+    settings = json.dumps(
+        [job["base_url"], job["rate_limit"], job["network"]], sort_keys=True
+    )
+    if _worker_session is None or settings != _worker_settings:
+        if _worker_session is not None:
+            _worker_session.close()
+        # Made like the public API session of the coordinator
+        _worker_session = PubApiSession(
+            base_url=job["base_url"],
+            policy=NetworkPolicy.from_config(job["network"] or {}),
+        )
+        _worker_session.headers = {
+            "Accept": "application/json",
+            "User-Agent": USER_AGENT,
+        }
+        _worker_session.cookies = ForgetfulCookieJar()
+        if job["rate_limit"] is not None:
+            _worker_session.limiter = RateLimiter.from_config(job["rate_limit"])
+        _worker_settings = settings
+    return _worker_session
+
+
+def _scan_shard(job):
+    """Scans the locations of a shard, in a worker process. Only the
+    sessions which pass the filters are sent back, along with the metrics
+    recorded while scanning, and what a planner learned from all of them.
+    """
+    metrics.reset()
+    start = perf_counter()
+    filters = job["filters"]
+    center_filter = None if filters is None else filters.filter_center
+    planner = QueryPlanner() if job["learn"] else None
+    coverage = ScanCoverage() if job["cover"] else None
+    results = []
+    for location, date_str, result in iter_location_results(
+        job["date_objs"],
+        job["locations"],
+        job["max_workers"],
+        _session_for(job),
+        planner=planner,
+        center_filter=center_filter,
+        coverage=coverage,
+    ):
+        # District responses were filtered while being decoded
+        if filters is not None and location[0] != "district_ids":
+            result = filters.filter_centers(result)
+        results.append((location, date_str, result))
+    metrics.observe("shard_seconds", perf_counter() - start)
+    return {
+        "shard": job["shard"],
+        "results": results,
+        "metrics": metrics.snapshot(),
+        "planner": None if planner is None else planner.snapshot(),
+        "coverage": coverage,
+    }
+
+
+class _ShardManager(BaseManager):
+    """Serves the queue of jobs and the queue of their results of a
+    coordinator to the workers, over TCP.
+    """
+
+
+_jobs = Queue()
+_results = Queue()
+
+
+def _get_jobs():
+    return _jobs
+
+
+def _get_results():
+    return _results
+
+
+_ShardManager.register("jobs", callable=_get_jobs)
+_ShardManager.register("results", callable=_get_results)
+
+
+def _run_pool(jobs):
+    # Spawned, so that the workers do not inherit the threads (and held
+    # locks) of the coordinator
+    with get_context("spawn").Pool(len(jobs)) as pool:
+        for shard_result in pool.imap_unordered(_scan_shard, jobs):
+            yield shard_result
+
+
+def _run_queue(jobs, address, authkey, timeout=SHARD_TIMEOUT, attempts=SHARD_ATTEMPTS):
+    manager = _ShardManager(address=address, authkey=authkey)
+    manager.start()
+    try:
+        job_queue, result_queue = manager.jobs(), manager.results()
+        for job in jobs:
+            job_queue.put(job)
+        _logger.info(
+            "Serving {} shards on {}:{}, waiting for workers".format(
+                len(jobs), *address
+            )
+        )
+        pending = {job["shard"]: job for job in jobs}
+        handed = {shard: 1 for shard in pending}
+        # Shard -> when a worker scanning it last sent a heartbeat
+        heartbeats = {}
+        # Shard -> since when it may have been taken without a heartbeat
+        unstarted = {shard: monotonic() for shard in pending}
+        while pending:
+            try:
+                message = result_queue.get(timeout=WORKER_HEARTBEAT_INTERVAL)
+            except Empty:
+                message = None
+            now = monotonic()
+            # A shard handed out again may be sent back twice
+            if message is not None and message["shard"] in pending:
+                shard = message["shard"]
+                unstarted.pop(shard, None)
+                if message.get("heartbeat"):
+                    heartbeats[shard] = now
+                else:
+                    del pending[shard]
+                    heartbeats.pop(shard, None)
+                    yield message
+
+            # Shards still queued wait for a worker however long it takes
+            if unstarted and not job_queue.empty():
+                for shard in unstarted:
+                    unstarted[shard] = now
+            lost = [
+                shard
+                for since_by_shard in (heartbeats, unstarted)
+                for shard, since in since_by_shard.items()
+                if now - since >= timeout
+            ]
+            for shard in lost:
+                if handed[shard] >= attempts:
+                    raise TimeoutError(
+                        "shard {} was lost by {} workers".format(shard, attempts)
+                    )
+                handed[shard] += 1
+                heartbeats.pop(shard, None)
+                unstarted[shard] = now
+                _logger.warning(
+                    "No heartbeat for shard {} in {}s, handing it out again".format(
+                        shard, timeout
+                    )
+                )
+                job_queue.put(pending[shard])
+    finally:
+        manager.shutdown()
+
+
+def _send_heartbeats(result_queue, shard, stop):
+    """Tells the coordinator that the shard is being scanned, until `stop`
+    is set.
+    """
+    while True:
+        try:
+            result_queue.put({"shard": shard, "heartbeat": True})
+        except (EOFError, OSError):
+            return
+        if stop.wait(WORKER_HEARTBEAT_INTERVAL):
+            return
+
+
+def run_shard_worker(
+    address,
+    authkey,
+    poll_interval=WORKER_POLL_INTERVAL,
+    connect_timeout=WORKER_CONNECT_TIMEOUT,
+):
+    """Connects to a coordinator serving shards at `address` (see
+    `check_available_slots_sharded`), and scans the shards it hands out
+    until it goes away. Workers can be run on any host which reaches
+    the coordinator, and as many of them as needed.
+
+    :param address: `(host, port)` of the coordinator
+    :type address: tuple[str, int]
+    :param authkey: the secret shared with the coordinator
+    :type authkey: bytes
+    :param poll_interval: seconds to wait for a job before asking again
+    :type poll_interval: float
+    :param connect_timeout: seconds to wait for the coordinator to come up
+    :type connect_timeout: float
+    :raises OSError: if the coordinator could not be reached
+    :return: number of shards scanned
+    :rtype: int
+    """
+    manager = _ShardManager(address=address, authkey=authkey)
+    deadline = monotonic() + connect_timeout
+    while True:
+        try:
+            manager.connect()
+            break
+        except ConnectionRefusedError:
+            if monotonic() >= deadline:
+                raise
+            sleep(poll_interval)
+    job_queue, result_queue = manager.jobs(), manager.results()
+    _logger.info("Connected to coordinator at {}:{}".format(*address))
+
+    scanned = 0
+    while True:
+        try:
+            job = job_queue.get(timeout=poll_interval)
+        except Empty:
+            continue
+        except (EOFError, OSError):
+            # The coordinator has got all its results, and shut down
+            break
+        _logger.info("Scanning shard {}".format(job["shard"]))
+        stop = Event()
+        heartbeat = Thread(
+            target=_send_heartbeats,
+            args=(result_queue, job["shard"], stop),
+            name="shard-heartbeat",
+            daemon=True,
+        )
+        heartbeat.start()
+        try:
+            shard_result = _scan_shard(job)
+        finally:
+            stop.set()
+            heartbeat.join()
+        try:
+            result_queue.put(shard_result)
+        except (EOFError, OSError):
+            # The coordinator got the shard from another worker, and shut down
+            break
+        scanned += 1
+    return scanned
+
+
+def check_available_slots_sharded(
+    date_obj,
+    weeks,
+    locations,
+    shards,
+    max_workers=DEFAULT_MAX_WORKERS,
+    api_session=None,
+    filters=None,
+    rate_limit=None,
+    network=None,
+    planner=None,
+    on_update=None,
+    address=None,
+    authkey=None,
+    coverage=None,
+):
+    """Like `check_available_slots_for_weeks`, but splits the locations
+    into `shards` (see `partition_locations`), which are scanned by
+    separate processes, each with its own session and rate limit, so
+    that decoding and filtering the responses is not bound to one core.
+    Every process sends back the sessions which pass the filters, and
+    the shards are merged here as they finish.
+
+    Without an `address`, the shards are scanned by a pool of local
+    processes, which share the rate limit of this IP address. With one,
+    they are served over TCP to workers started with `run_shard_worker`,
+    possibly on other hosts, each of them with the full rate limit. The
+    workers send a heartbeat every `WORKER_HEARTBEAT_INTERVAL` seconds
+    while they scan a shard, and a shard taken by a worker which sends
+    none for `SHARD_TIMEOUT` seconds is handed out again, so that a slow,
+    rate limited shard is waited for but the shard of a worker which died
+    is not. The scan fails once a shard was handed out `SHARD_ATTEMPTS`
+    times.
+
+    The sessions of the workers are made like the public API session,
+    with the `network` policy (the default one if not given) and the
+    `rate_limit`, which defaults to the one of `api_session`.
+
+    :param date_obj: The first day of the first week to check
+    :type date_obj: datetime.date
+    :param weeks: Number of weeks to check
+    :type weeks: int
+    :param locations: A dictionary of locations to query, see
+            `check_available_slots`
+    :type locations: dict
+    :param shards: Number of shards, and of local processes
+    :type shards: int
+    :param max_workers: Maximum number of requests in flight at once, in
+            every shard
+    :type max_workers: int
+    :param api_session: The session whose base URL (and rate limit, if
+            `rate_limit` is not given) the workers use, defaults to the
+            public API session
+    :type api_session: Optional[PubApiSession]
+    :param filters: If given, only the sessions passing them are sent
+            back by the workers
+    :type filters: Optional[cowin_cowboy.filters.CompiledFilters]
+    :param rate_limit: the `"rate_limit"` table of the config, if any
+    :type rate_limit: Optional[dict]
+    :param network: the `"network"` table of the config, if any
+    :type network: Optional[dict]
+    :param planner: If given, used to skip redundant requests, and learns
+            what the planners of the shards learned from all the centers
+            they got, filtered out or not
+    :type planner: Optional[cowin_cowboy.pub_checker.planner.QueryPlanner]
+    :param on_update: If given, called with the center store and the new
+            or changed sessions, see `check_available_slots_for_weeks`
+    :type on_update: Optional[Callable[[CenterStore, list], Any]]
+    :param address: `(host, port)` to serve the shards on, to workers
+    :type address: Optional[tuple[str, int]]
+    :param authkey: the secret shared with the workers, needed with an
+            `address`
+    :type authkey: Optional[bytes]
+    :param coverage: If given, records which requests of every shard
+            succeeded, see `iter_location_results`
+    :type coverage: Optional[cowin_cowboy.utils.snapshot.ScanCoverage]
+    :raises TimeoutError: if the workers stopped sending heartbeats for
+            some shard every one of the `SHARD_ATTEMPTS` times it was
+            handed out
+
+    :return: A dictionary of center ID -> center details
+    :rtype:  dict[int, dict]
+    """
+    if api_session is None:
+        api_session = pub_api_session
+    if planner is not None:
+        locations = planner.plan(locations)
+    date_objs = [date_obj + timedelta(weeks=i) for i in range(max(1, weeks))]
+    partitions = partition_locations(locations, shards)
+    store = CenterStore()
+    if not partitions:
+        return store.centers
+    _logger.info(
+        "Checking available slots for {} week(s) from {} in {} shards".format(
+            len(date_objs), date_to_string(date_obj), len(partitions)
+        )
+    )
+
+    if rate_limit is None:
+        rate_limit = _limiter_config(api_session.limiter)
+    if address is None:
+        rate_limit = _split_rate_limit(rate_limit, len(partitions))
+    jobs = [
+        {
+            "shard": shard,
+            "date_objs": date_objs,
+            "locations": partition,
+            "max_workers": max_workers,
+            "base_url": api_session.base_url,
+            "rate_limit": rate_limit,
+            "network": network,
+            "filters": filters,
+            "learn": planner is not None,
+            "cover": coverage is not None,
+        }
+        for shard, partition in enumerate(partitions)
+    ]
+    if address is None:
+        shard_results = _run_pool(jobs)
+    else:
+        shard_results = _run_queue(jobs, address, authkey)
+
+    with metrics.stage("scan"):
+        for shard_result in shard_results:
+            metrics.merge(shard_result["metrics"])
+            _logger.debug("Got results of shard {}".format(shard_result["shard"]))
+            if planner is not None:
+                planner.merge(shard_result["planner"])
+            if coverage is not None:
+                coverage.merge(shard_result["coverage"])
+            for _, _, result in shard_result["results"]:
+                updated = store.merge(result)
+                if on_update is not None and updated:
+                    on_update(store, updated)
+
+    return store.centers
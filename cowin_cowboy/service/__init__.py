@@ -0,0 +1,26 @@
+# service/__init__.py -- resident slot checking service
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = [
+    "DEFAULT_HOST",
+    "DEFAULT_MAX_AGE",
+    "DEFAULT_PORT",
+    "ScanService",
+    "make_server",
+]
+
+from cowin_cowboy.service.scan_service import DEFAULT_MAX_AGE, ScanService
+from cowin_cowboy.service.server import DEFAULT_HOST, DEFAULT_PORT, make_server
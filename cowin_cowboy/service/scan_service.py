@@ -0,0 +1,260 @@
+# service/scan_service.py -- answers slot queries from results kept in memory
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["ScanService", "DEFAULT_MAX_AGE"]
+
+from datetime import date, datetime, timedelta
+from logging import getLogger
+from threading import Event, Lock
+from time import time
+
+from cowin_cowboy.filters import compile_filters, filter_available_centers
+from cowin_cowboy.pub_checker import (
+    DEFAULT_MAX_WORKERS,
+    QueryPlanner,
+    iter_location_results,
+    pub_api_session,
+)
+from cowin_cowboy.pub_checker.config import DEFAULT_CACHE_TTL
+from cowin_cowboy.utils.api_utils import date_to_string
+from cowin_cowboy.utils.center_store import CenterStore
+from cowin_cowboy.utils.snapshot import ScanCoverage
+from cowin_cowboy.utils.stats import metrics
+
+_logger = getLogger(__name__)
+
+# Seconds the results of a location are reused for, by default
+DEFAULT_MAX_AGE = DEFAULT_CACHE_TTL
+
+_LOCATION_KEYS = ("pincodes", "district_ids", "center_ids")
+
+
+class ScanService:
+    """Answers queries with the same fields as the config file, keeping
+    the decoded results of every (location, date) in memory, so that a
+    query only sends the requests whose results are older than
+    `max_age` seconds. Safe to use from many threads at once, and a
+    location which many queries find stale at once is only fetched by the
+    first of them, which the others wait for.
+
+    A failed request leaves the previous results of its location in
+    place, and the results of the days before the current week are
+    dropped.
+    """
+
+    def __init__(
+        self,
+        api_session=None,
+        max_workers=DEFAULT_MAX_WORKERS,
+        planner=None,
+        max_age=DEFAULT_MAX_AGE,
+    ):
+        """
+        :param api_session: An existing API session, defaults to the
+                public API session
+        :type api_session: requests.Session
+        :param max_workers: Maximum number of requests in flight at once
+        :type max_workers: int
+        :param planner: if given, used to skip redundant requests
+        :type planner: Optional[cowin_cowboy.pub_checker.QueryPlanner]
+        :param max_age: seconds the results of a location are reused for
+        :type max_age: float
+        """
+        self.api_session = pub_api_session if api_session is None else api_session
+        self.max_workers = max_workers
+        self.planner = planner
+        self.max_age = max_age
+        self.queries = 0
+        self._results = {}
+        # (key, location ID, date) -> event set once its refresh is done
+        self._refreshing = {}
+        # First day of the weeks the results were last pruned for
+        self._pruned_for = None
+        self._lock = Lock()
+
+    def _claim_stale(self, date_strs, locations, max_age, now):
+        """Returns the stale locations which this query should refresh,
+        the event set once they are refreshed, and the events of the ones
+        which other queries are already refreshing.
+        """
+        stale = {}
+        waits = set()
+        with self._lock:
+            for key in _LOCATION_KEYS:
+                for location_id in locations.get(key, []):
+                    stale_dates = [
+                        date_str
+                        for date_str in date_strs
+                        if self._is_stale((key, location_id, date_str), max_age, now)
+                    ]
+                    if not stale_dates:
+                        continue
+                    events = [
+                        self._refreshing.get((key, location_id, date_str))
+                        for date_str in stale_dates
+                    ]
+                    if all(events):
+                        waits.update(events)
+                        continue
+                    stale.setdefault(key, []).append(location_id)
+            event = Event()
+            for result_key in self._result_keys(date_strs, stale):
+                self._refreshing.setdefault(result_key, event)
+        return stale, event, waits
+
+    def _is_stale(self, result_key, max_age, now):
+        result = self._results.get(result_key)
+        return result is None or now - result[0] >= max_age
+
+    @staticmethod
+    def _result_keys(date_strs, locations):
+        for key, location_ids in locations.items():
+            for location_id in location_ids:
+                for date_str in date_strs:
+                    yield key, location_id, date_str
+
+    def _refresh(self, date_objs, locations):
+        """Fetches the locations, and keeps their results, including the
+        ones of locations which were planned away. The results of the
+        requests which failed are not kept, and neither are the ones of
+        the locations planned away on a date some request failed for.
+        """
+        fetched = {}
+        failed_dates = set()
+        coverage = ScanCoverage()
+        for location, date_str, result in iter_location_results(
+            date_objs,
+            locations,
+            max_workers=self.max_workers,
+            api_session=self.api_session,
+            planner=self.planner,
+            coverage=coverage,
+        ):
+            if coverage.covers(location, date_str):
+                fetched.setdefault(date_str, {})[location] = result
+            else:
+                failed_dates.add(date_str)
+
+        planner = self.planner if self.planner is not None else QueryPlanner()
+        now = time()
+        with self._lock:
+            self._prune(date_objs[0])
+            for date_obj in date_objs:
+                date_str = date_to_string(date_obj)
+                date_results = fetched.get(date_str, {})
+                for key in _LOCATION_KEYS:
+                    for location_id in locations.get(key, []):
+                        location = (key, location_id)
+                        if location not in date_results and date_str in failed_dates:
+                            # Keeps the previous results until they can be
+                            # fetched again
+                            continue
+                        self._results[key, location_id, date_str] = (
+                            now,
+                            planner.covered_results(location, date_results),
+                        )
+
+    def _prune(self, first_date):
+        """Drops the results of the days before `first_date`."""
+        if first_date == self._pruned_for:
+            return
+        self._pruned_for = first_date
+        for result_key in list(self._results):
+            try:
+                result_date = datetime.strptime(result_key[2], "%d-%m-%Y").date()
+            except ValueError:
+                continue
+            if result_date < first_date:
+                del self._results[result_key]
+
+    def _release(self, date_strs, locations, event):
+        with self._lock:
+            for result_key in self._result_keys(date_strs, locations):
+                if self._refreshing.get(result_key) is event:
+                    del self._refreshing[result_key]
+        event.set()
+
+    def query(self, query):
+        """Returns the available centers for a query, which has the same
+        fields as the config file: `"locations"` (whose `"near"` areas are
+        expanded by the planner), and optionally `"weeks"` and `"filters"`.
+        It may also have a `"max_age"` field, overriding how old the results
+        it is answered from may be.
+
+        :param query: the query
+        :type query: dict
+        :raises ValueError: if the query is invalid
+        :return: A dictionary of center ID -> center details
+        :rtype: dict[int, dict]
+        """
+        if not isinstance(query, dict):
+            raise ValueError("query should be a table")
+        locations = query.get("locations")
+        if isinstance(locations, dict) and "near" in locations:
+            if self.planner is None:
+                raise ValueError('"near" locations need the query planner')
+            locations = self.planner.expand(locations)
+        if not isinstance(locations, dict) or not any(
+            locations.get(key) for key in _LOCATION_KEYS
+        ):
+            raise ValueError('"locations" should have atleast one location')
+        weeks = query.get("weeks", 1)
+        if not isinstance(weeks, int):
+            raise ValueError('"weeks" should be an integer')
+        max_age = query.get("max_age", self.max_age)
+        if not isinstance(max_age, (int, float)) or max_age < 0:
+            raise ValueError('"max_age" should be a non-negative number')
+        filters = None
+        if "filters" in query:
+            filters = compile_filters(query["filters"])
+
+        with metrics.stage("query"):
+            date_today = date.today()
+            date_objs = [date_today + timedelta(weeks=i) for i in range(max(1, weeks))]
+            date_strs = [date_to_string(date_obj) for date_obj in date_objs]
+            stale, event, waits = self._claim_stale(
+                date_strs, locations, max_age, time()
+            )
+            if stale:
+                try:
+                    self._refresh(date_objs, stale)
+                finally:
+                    self._release(date_strs, stale, event)
+            # Answers from the refreshes of other queries, once they are done
+            for event in waits:
+                event.wait()
+
+            store = CenterStore()
+            with self._lock:
+                self.queries += 1
+                for date_str in date_strs:
+                    for key in _LOCATION_KEYS:
+                        for location_id in locations.get(key, []):
+                            result = self._results.get((key, location_id, date_str))
+                            if result is not None:
+                                store.merge(result[1])
+            available_centers = store.centers
+            if filters is not None:
+                available_centers = filter_available_centers(available_centers, filters)
+        return available_centers
+
+    def stats(self):
+        """Returns the counters of the service.
+
+        :rtype: dict[str, int]
+        """
+        with self._lock:
+            return {"queries": self.queries, "results": len(self._results)}
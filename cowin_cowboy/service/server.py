@@ -0,0 +1,137 @@
+# service/server.py -- serves slot queries over HTTP
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["make_server", "DEFAULT_HOST", "DEFAULT_PORT"]
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from json import JSONDecodeError
+from logging import getLogger
+from os import path, unlink
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+from cowin_cowboy.utils import json_backend
+
+_logger = getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8637
+
+# Largest query body accepted, in bytes
+MAX_QUERY_SIZE = 1024 * 1024
+
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    """Answers `POST /query` with the centers available for the JSON
+    query in the body, and `GET /status` with the counters of the
+    service and of the response cache.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are written separately
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        _logger.debug(format % args)
+
+    def _reply(self, status, obj):
+        body = json_backend.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/status":
+            self._reply(404, {"error": "not found"})
+            return
+        service = self.server.service
+        status = {"service": service.stats()}
+        cache = service.api_session.cache
+        if cache is not None:
+            status["cache"] = cache.stats()
+        self._reply(200, status)
+
+    def do_POST(self):
+        if self.path != "/query":
+            self._reply(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError
+        except ValueError:
+            self._reply(400, {"error": "invalid Content-Length"})
+            return
+        if length > MAX_QUERY_SIZE:
+            self._reply(413, {"error": "query too large"})
+            return
+        try:
+            query = json_backend.loads(self.rfile.read(length))
+            centers = self.server.service.query(query)
+        except (JSONDecodeError, UnicodeDecodeError) as e:
+            self._reply(400, {"error": "invalid JSON: {}".format(e)})
+        except ValueError as e:
+            self._reply(400, {"error": str(e)})
+        except Exception:
+            _logger.exception("Could not answer query")
+            self._reply(500, {"error": "internal error"})
+        else:
+            self._reply(200, centers)
+
+
+class _UnixServiceHandler(_ServiceHandler):
+    # Unix sockets have no Nagle algorithm to disable
+    disable_nagle_algorithm = False
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self):
+        super().server_close()
+        if path.exists(self.server_address):
+            unlink(self.server_address)
+
+
+def make_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+    """Creates an HTTP server answering queries with the service, on a
+    Unix socket if `socket_path` is given, else on `host` and `port`.
+    Call `serve_forever` on it to start serving.
+
+    :param service: the service answering the queries
+    :type service: cowin_cowboy.service.ScanService
+    :param host: address to listen on, defaults to localhost only
+    :type host: str
+    :param port: TCP port to listen on
+    :type port: int
+    :param socket_path: path of the Unix socket to listen on instead,
+            replacing any stale socket file
+    :type socket_path: Optional[os.PathLike]
+    :rtype: socketserver.BaseServer
+    """
+    if socket_path is not None:
+        if path.exists(socket_path):
+            unlink(socket_path)
+        server = _UnixHTTPServer(socket_path, _UnixServiceHandler)
+    else:
+        server = _HTTPServer((host, port), _ServiceHandler)
+    server.service = service
+    return server
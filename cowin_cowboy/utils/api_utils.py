@@ -27,8 +27,18 @@ from enum import Enum, unique
 from json import JSONDecodeError
 from logging import getLogger
 
+from requests.exceptions import RequestException
+
+from cowin_cowboy.utils import json_backend
+from cowin_cowboy.utils.center_store import refresh_capacity
+from cowin_cowboy.utils.json_stream import iter_array_items
+from cowin_cowboy.utils.stats import metrics
+
 _logger = getLogger(__name__)
 
+# Size of the chunks streamed responses are read in, in bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+
 
 @unique
 class FeeType(Enum):
@@ -48,6 +58,10 @@ def date_to_string(date_obj):
     return date_obj.strftime("%d-%m-%Y")
 
 
+def _log_request_error(error, location):
+    _logger.warning("Request failed for {}: {}".format(location, error))
+
+
 def check_for_pincode(date_str, pincode, api_session):
     """Returns a list of available centers based on the PIN code.
 
@@ -58,16 +72,23 @@ def check_for_pincode(date_str, pincode, api_session):
     :param api_session: An existing API session
     :type api_session: requests_toolbelt.sessions.BaseUrlSession
 
-    :return: A dictionary of center ID -> center details
-    :rtype: dict[int, dict]
+    :return: A dictionary of center ID -> center details, or `None` if
+            the request failed
+    :rtype: Optional[dict[int, dict]]
     """
     endpoint = "v2/appointment/sessions/public/calendarByPin"
+    endpoint_name = "calendarByPin"
 
     params = {"pincode": pincode, "date": date_str}
-    r = api_session.get(endpoint, params=params)
+    try:
+        r = api_session.get(endpoint, params=params)
+    except RequestException as e:
+        _log_request_error(e, "PIN code '{}'".format(pincode))
+        return None
     if r.ok:
         try:
-            center_list = r.json().get("centers", [])
+            with metrics.timer("api_decode_seconds", {"endpoint": endpoint_name}):
+                center_list = json_backend.loads(r.content).get("centers", [])
             return {center["center_id"]: center for center in center_list}
         except JSONDecodeError:
             _logger.warning(
@@ -82,10 +103,48 @@ def check_for_pincode(date_str, pincode, api_session):
         )
         _logger.debug("Response:\n".format(r.content))
 
-    return {}
+    return None
+
+
+def _counted_chunks(r, endpoint_name):
+    """Yields the chunks of a streamed response body, counting the bytes
+    received over the network.
+    """
+    received = 0
+    try:
+        for chunk in r.iter_content(STREAM_CHUNK_SIZE):
+            received += len(chunk)
+            yield chunk
+    finally:
+        if r.raw is not None:
+            metrics.inc(
+                "api_response_bytes_total", {"endpoint": endpoint_name}, received
+            )
 
 
-def check_for_district(date_str, district_id, api_session):
+def _stream_centers(r, center_filter, endpoint_name):
+    """Decodes the centers of the response one at a time as the body
+    arrives, keeping only the ones returned by `center_filter`.
+    """
+    centers = {}
+    chunks = _counted_chunks(r, endpoint_name)
+    try:
+        for center in iter_array_items(chunks, "centers"):
+            try:
+                filtered_center = center_filter(center)
+                if filtered_center is not None:
+                    centers[filtered_center["center_id"]] = filtered_center
+            except (KeyError, TypeError):
+                _logger.debug("Invalid center details, skipping it")
+        # Reads to the end of the body, so that it can be cached
+        for _ in chunks:
+            pass
+    finally:
+        r.close()
+    return centers
+
+
+def check_for_district(date_str, district_id, api_session, center_filter=None):
     """Returns a list of available centers based on the district ID.
 
     :param date_str: The date as string, in DD-MM-YYYY
@@ -94,17 +153,39 @@ def check_for_district(date_str, district_id, api_session):
     :type district_id: int
     :param api_session: An existing API session
     :type api_session: requests.Session
-
-    :return: A dictionary of center ID -> center details
-    :rtype: dict[int, dict]
+    :param center_filter: If given, the response is decoded one center at
+            a time as it arrives, and only the centers this returns
+            (possibly modified) are kept, such as the `filter_center`
+            method of compiled filters
+    :type center_filter: Optional[Callable[[dict], Optional[dict]]]
+
+    :return: A dictionary of center ID -> center details, or `None` if
+            the request failed
+    :rtype: Optional[dict[int, dict]]
     """
     endpoint = "v2/appointment/sessions/public/calendarByDistrict"
+    endpoint_name = "calendarByDistrict"
 
     params = {"district_id": district_id, "date": date_str}
-    r = api_session.get(endpoint, params=params)
-    if r.ok:
+    try:
+        r = api_session.get(endpoint, params=params, stream=center_filter is not None)
+    except RequestException as e:
+        _log_request_error(e, "district ID {}".format(district_id))
+        return None
+    if r.ok and center_filter is not None:
         try:
-            center_list = r.json().get("centers", [])
+            with metrics.timer("api_decode_seconds", {"endpoint": endpoint_name}):
+                return _stream_centers(r, center_filter, endpoint_name)
+        except JSONDecodeError:
+            _logger.warning(
+                "Error while decoding JSON for district ID {}".format(district_id)
+            )
+        except RequestException as e:
+            _log_request_error(e, "district ID {}".format(district_id))
+    elif r.ok:
+        try:
+            with metrics.timer("api_decode_seconds", {"endpoint": endpoint_name}):
+                center_list = json_backend.loads(r.content).get("centers", [])
             return {center["center_id"]: center for center in center_list}
         except JSONDecodeError:
             _logger.warning(
@@ -119,7 +200,7 @@ def check_for_district(date_str, district_id, api_session):
         )
         _logger.debug("Response:\n".format(r.content))
 
-    return {}
+    return None
 
 
 def check_for_center(date_str, center_id, api_session):
@@ -136,12 +217,18 @@ def check_for_center(date_str, center_id, api_session):
     :rtype: Optional[dict]
     """
     endpoint = "v2/appointment/sessions/public/calendarByCenter"
+    endpoint_name = "calendarByCenter"
 
     params = {"center_id": center_id, "date": date_str}
-    r = api_session.get(endpoint, params=params)
+    try:
+        r = api_session.get(endpoint, params=params)
+    except RequestException as e:
+        _log_request_error(e, "center ID {}".format(center_id))
+        return None
     if r.ok:
         try:
-            return r.json()
+            with metrics.timer("api_decode_seconds", {"endpoint": endpoint_name}):
+                return json_backend.loads(r.content)
         except JSONDecodeError:
             _logger.warning(
                 "Error while decoding JSON for center ID {}".format(center_id)
@@ -162,7 +249,10 @@ def merge_center_dicts(cdict1, cdict2):
     """Merges two center details dictionary into a single center details
     dictionary. Like a set union for the dicts, but if a center is
     present in both dicts, then merges their sessions, similar to a set
-    union.
+    union. Sessions present in both refresh their capacity from `cdict2`.
+
+    Note: To merge many dicts into one, prefer `CenterStore`, which
+    keeps its session index between merges.
 
     :param cdict1: a center details dict
     :type cdict1: dict[int, dict]
@@ -171,17 +261,25 @@ def merge_center_dicts(cdict1, cdict2):
     :return: `cdict1`, with all members of `cdict2` merged into it
     :rtype: dict[int, dict]
     """
+    with metrics.stage("merge"):
+        return _merge_center_dicts(cdict1, cdict2)
+
+
+def _merge_center_dicts(cdict1, cdict2):
     for center_id, center_details in cdict2.items():
         try:
             if center_id not in cdict1:
                 cdict1[center_id] = center_details
             else:
+                sessions = cdict1[center_id]["sessions"]
+                index = {sess1["session_id"]: sess1 for sess1 in sessions}
                 for sess2 in center_details["sessions"]:
-                    for sess1 in cdict1[center_id]["sessions"]:
-                        if sess2["session_id"] == sess1["session_id"]:
-                            break
+                    sess1 = index.get(sess2["session_id"])
+                    if sess1 is None:
+                        index[sess2["session_id"]] = sess2
+                        sessions.append(sess2)
                     else:
-                        cdict1[center_id]["sessions"].append(sess2)
+                        refresh_capacity(sess1, sess2)
         except KeyError:
             _logger.error("some required field not found")
     return cdict1
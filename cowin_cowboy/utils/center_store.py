@@ -0,0 +1,168 @@
+# center_store.py -- indexed store of center details
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["CAPACITY_PREFIX", "CenterStore", "refresh_capacity"]
+
+from logging import getLogger
+
+from cowin_cowboy.utils.stats import metrics
+
+_logger = getLogger(__name__)
+
+# Every session field starting with this prefix is refreshed on upsert
+CAPACITY_PREFIX = "available_capacity"
+
+
+def refresh_capacity(old_session, new_session):
+    """Copies the capacity fields of `new_session` into `old_session`.
+
+    :return: whether any of the capacity fields changed
+    :rtype: bool
+    """
+    changed = False
+    for key, value in new_session.items():
+        if key.startswith(CAPACITY_PREFIX) and old_session.get(key) != value:
+            old_session[key] = value
+            changed = True
+    return changed
+
+
+class CenterStore:
+    """A center ID -> center details mapping, which keeps an index of
+    session ID -> session for every center, so that sessions can be
+    inserted or updated in constant time.
+
+    The center details are stored in the same shape as returned by the
+    `check_for_*` functions, and `centers` can be used wherever a
+    center details dict is expected. Merged centers are copied along
+    with their session lists, so merging never modifies the center
+    details passed in, but sessions are shared with them.
+    """
+
+    def __init__(self, centers=None):
+        """
+        :param centers: center details dict to initialise the store with
+        :type centers: Optional[dict[int, dict]]
+        """
+        self.centers = {}
+        self._sessions = {}
+        if centers is not None:
+            self.merge(centers)
+
+    def __len__(self):
+        return len(self.centers)
+
+    def __contains__(self, center_id):
+        return center_id in self.centers
+
+    def __getitem__(self, center_id):
+        return self.centers[center_id]
+
+    def __iter__(self):
+        return iter(self.centers)
+
+    def items(self):
+        return self.centers.items()
+
+    def upsert_center(self, center_id, center):
+        """Inserts the center, or merges its sessions into the already
+        stored center with the same ID.
+
+        :param center_id: ID of the center
+        :type center_id: int
+        :param center: center details, as returned by the API
+        :type center: dict
+        :return: list of sessions which were either new, or whose
+                capacity changed
+        :rtype: list[dict]
+        """
+        if center_id not in self.centers:
+            index = {}
+            sessions = center["sessions"]
+            unique_sessions = []
+            for session in sessions:
+                if session["session_id"] not in index:
+                    index[session["session_id"]] = session
+                    unique_sessions.append(session)
+            center = dict(center)
+            center["sessions"] = unique_sessions
+            self.centers[center_id] = center
+            self._sessions[center_id] = index
+            return unique_sessions
+
+        return [
+            session
+            for session in center["sessions"]
+            if self.upsert_session(center_id, session)
+        ]
+
+    def upsert_session(self, center_id, session):
+        """Inserts the session into an already stored center, or
+        refreshes the `available_capacity*` fields of the stored session
+        with the same ID.
+
+        :param center_id: ID of the center the session belongs to
+        :type center_id: int
+        :param session: session details, as returned by the API
+        :type session: dict
+        :return: whether the session was new, or its capacity changed
+        :rtype: bool
+        """
+        index = self._sessions[center_id]
+        old_session = index.get(session["session_id"])
+        if old_session is None:
+            index[session["session_id"]] = session
+            self.centers[center_id]["sessions"].append(session)
+            return True
+        return refresh_capacity(old_session, session)
+
+    def merge(self, cdict):
+        """Merges a center details dict into the store. Like a set union
+        for the dicts, but if a center is already present, then merges
+        their sessions by session ID.
+
+        :param cdict: a center details dict
+        :type cdict: dict[int, dict]
+        :return: list of `(center_id, session)` tuples, for all the
+                sessions which were either new, or whose capacity changed
+        :rtype: list[tuple[int, dict]]
+        """
+        updated = []
+        with metrics.stage("merge"):
+            for center_id, center_details in cdict.items():
+                try:
+                    updated.extend(
+                        (center_id, session)
+                        for session in self.upsert_center(center_id, center_details)
+                    )
+                except KeyError:
+                    _logger.error("some required field not found")
+        return updated
+
+    def merge_many(self, cdicts):
+        """Merges every center details dict of the iterable into the
+        store, in order.
+
+        :param cdicts: center details dicts
+        :type cdicts: Iterable[dict[int, dict]]
+        :return: list of `(center_id, session)` tuples, for all the
+                sessions which were either new, or whose capacity changed
+        :rtype: list[tuple[int, dict]]
+        """
+        updated = []
+        for cdict in cdicts:
+            updated.extend(self.merge(cdict))
+        return updated
@@ -0,0 +1,189 @@
+# geo.py -- distances and a grid index of the centers' coordinates
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["GeoArea", "GeoIndex", "center_point", "haversine_km", "parse_areas"]
+
+from logging import getLogger
+from math import asin, cos, floor, radians, sin, sqrt
+
+_logger = getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+# Kilometres per degree of latitude
+KM_PER_DEGREE = 111.32
+# Side of the cells of the grid index, in degrees (about 11 km)
+DEFAULT_CELL_DEGREES = 0.1
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def haversine_km(lat1, long1, lat2, long2):
+    """Returns the great-circle distance between two points, in km.
+
+    :param lat1: latitude of the first point, in degrees
+    :type lat1: float
+    :param long1: longitude of the first point, in degrees
+    :type long1: float
+    :param lat2: latitude of the second point, in degrees
+    :type lat2: float
+    :param long2: longitude of the second point, in degrees
+    :type long2: float
+    :rtype: float
+    """
+    phi1, phi2 = radians(lat1), radians(lat2)
+    half_dphi = (phi2 - phi1) / 2
+    half_dlambda = radians(long2 - long1) / 2
+    a = sin(half_dphi) ** 2 + cos(phi1) * cos(phi2) * sin(half_dlambda) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(a)))
+
+
+def center_point(center):
+    """Returns the coordinates of a center, or `None` if it has none.
+    The API sends `0` for centers without coordinates.
+
+    :param center: center details
+    :type center: dict
+    :rtype: Optional[tuple[float, float]]
+    """
+    lat, long = center.get("lat"), center.get("long")
+    if not (_is_number(lat) and _is_number(long)) or (lat == 0 and long == 0):
+        return None
+    return lat, long
+
+
+class GeoArea:
+    """A circle around a point, with its bounding box computed once, so
+    that most points outside of it are ruled out without trigonometry.
+    """
+
+    def __init__(self, lat, long, km):
+        """
+        :param lat: latitude of the center of the circle, in degrees
+        :type lat: float
+        :param long: longitude of the center of the circle, in degrees
+        :type long: float
+        :param km: radius of the circle, in km
+        :type km: float
+        """
+        self.lat = lat
+        self.long = long
+        self.km = km
+        dlat = km / KM_PER_DEGREE
+        # Longitudes are furthest apart for a distance at the edge farther
+        # from the equator, so the box is sized there to hold the circle
+        cos_lat = cos(radians(min(89.0, abs(lat) + dlat)))
+        dlong = min(180.0, km / (KM_PER_DEGREE * cos_lat))
+        self.min_lat, self.max_lat = lat - dlat, lat + dlat
+        self.min_long, self.max_long = long - dlong, long + dlong
+
+    def contains(self, lat, long):
+        """Whether a point is within the circle.
+
+        :rtype: bool
+        """
+        if not (
+            self.min_lat <= lat <= self.max_lat
+            and self.min_long <= long <= self.max_long
+        ):
+            return False
+        return haversine_km(self.lat, self.long, lat, long) <= self.km
+
+    def __repr__(self):
+        return "GeoArea({}, {}, {})".format(self.lat, self.long, self.km)
+
+
+def parse_areas(near):
+    """Validates a `"near"` field of the config, either a table with the
+    `"lat"`, `"long"` and `"km"` of a circle, or an array of them.
+
+    :param near: the `"near"` field
+    :type near: dict | list[dict]
+    :raises ValueError: if some field has an invalid value
+    :rtype: list[GeoArea]
+    """
+    tables = near if isinstance(near, list) else [near]
+    areas = []
+    for table in tables:
+        if not isinstance(table, dict):
+            raise ValueError('"near" should be a table, or an array of tables')
+        lat, long, km = table.get("lat"), table.get("long"), table.get("km")
+        if not (_is_number(lat) and _is_number(long) and _is_number(km)):
+            raise ValueError('"lat", "long" and "km" of "near" should be numbers')
+        if not (-90 <= lat <= 90 and -180 <= long <= 180) or km <= 0:
+            raise ValueError('"near" should be a valid point, with a positive "km"')
+        areas.append(GeoArea(lat, long, km))
+    return areas
+
+
+class GeoIndex:
+    """A grid index of points, such as the coordinates of the centers
+    seen in API responses, answering which of them are within an area by
+    only looking at the cells which overlap its bounding box.
+    """
+
+    def __init__(self, cell_degrees=DEFAULT_CELL_DEGREES):
+        """
+        :param cell_degrees: side of the cells, in degrees
+        :type cell_degrees: float
+        """
+        self.cell_degrees = cell_degrees
+        # ID -> (lat, long)
+        self.points = {}
+        # (row, column) -> IDs of the points in the cell
+        self.cells = {}
+
+    def _cell(self, lat, long):
+        return floor(lat / self.cell_degrees), floor(long / self.cell_degrees)
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, point_id, lat, long):
+        """Adds a point to the index, or moves it.
+
+        :param point_id: ID of the point, such as a center ID
+        :type point_id: int
+        :return: whether the point was new or moved
+        :rtype: bool
+        """
+        old = self.points.get(point_id)
+        if old == (lat, long):
+            return False
+        if old is not None:
+            cell = self.cells[self._cell(*old)]
+            cell.discard(point_id)
+        self.points[point_id] = (lat, long)
+        self.cells.setdefault(self._cell(lat, long), set()).add(point_id)
+        return True
+
+    def within(self, area):
+        """Returns the IDs of the points within an area.
+
+        :param area: the area to search
+        :type area: GeoArea
+        :rtype: list[int]
+        """
+        min_row, min_column = self._cell(area.min_lat, area.min_long)
+        max_row, max_column = self._cell(area.max_lat, area.max_long)
+        found = []
+        for row in range(min_row, max_row + 1):
+            for column in range(min_column, max_column + 1):
+                for point_id in self.cells.get((row, column), ()):
+                    if area.contains(*self.points[point_id]):
+                        found.append(point_id)
+        return found
@@ -0,0 +1,69 @@
+# json_backend.py -- fastest available JSON encoder and decoder
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["BACKEND", "dumps", "loads"]
+
+import json
+from json import JSONDecodeError
+
+try:
+    import orjson
+
+    BACKEND = "orjson"
+except ImportError:
+    orjson = None
+    try:
+        import ujson
+
+        BACKEND = "ujson"
+    except ImportError:
+        ujson = None
+        BACKEND = "json"
+
+
+def loads(data):
+    """Decodes a JSON document with the fastest available backend
+    (`orjson`, then `ujson`, then the standard library).
+
+    :param data: the JSON document
+    :type data: bytes|str
+    :raises json.JSONDecodeError: if the document is invalid
+    :rtype: Any
+    """
+    if orjson is not None:
+        # orjson.JSONDecodeError is a subclass of json.JSONDecodeError
+        return orjson.loads(data)
+    if ujson is not None:
+        try:
+            return ujson.loads(data)
+        except ValueError as e:
+            raise JSONDecodeError(str(e), "", 0)
+    return json.loads(data)
+
+
+def dumps(obj):
+    """Encodes an object as compact JSON on a single line, with the
+    fastest available backend. Integer keys are encoded as strings, like
+    the standard library does.
+
+    :param obj: the object to encode
+    :rtype: str
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    if ujson is not None:
+        return ujson.dumps(obj, ensure_ascii=False)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
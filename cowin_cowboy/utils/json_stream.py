@@ -0,0 +1,128 @@
+# json_stream.py -- incremental decoding of large JSON responses
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["iter_array_items"]
+
+from codecs import getincrementaldecoder
+from json import JSONDecoder, JSONDecodeError
+import re
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class _StreamReader:
+    """Keeps a text buffer of the not yet decoded part of the stream,
+    reading more chunks only when a value does not fit in it.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._text_decoder = getincrementaldecoder("utf-8")()
+        self._json_decoder = JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Reads the next chunk into the buffer, dropping the already
+        decoded part. Returns false at the end of the stream.
+        """
+        if self.eof:
+            return False
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            chunk = self._text_decoder.decode(b"", final=True)
+            self.eof = True
+        else:
+            if isinstance(chunk, bytes):
+                chunk = self._text_decoder.decode(chunk)
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return not self.eof or bool(chunk)
+
+    def peek(self):
+        """Skips whitespace, and returns the next character without
+        consuming it, or `None` at the end of the stream.
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return None
+
+    def expect(self, chars):
+        """Consumes the next character, which should be one of `chars`."""
+        char = self.peek()
+        if char is None or char not in chars:
+            raise JSONDecodeError(
+                "Expecting one of {!r}".format(chars), self.buf, self.pos
+            )
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decodes and consumes the next complete JSON value."""
+        if self.peek() is None:
+            raise JSONDecodeError("Expecting value", self.buf, self.pos)
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self.buf, self.pos)
+            except JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_array_items(chunks, key):
+    """Yields the items of the array at `key` of a JSON object, decoding
+    them one at a time as the chunks of the document arrive. Only the
+    item being decoded is kept in memory, along with the current chunk.
+
+    :param chunks: the JSON document, in UTF-8 encoded or text chunks
+    :type chunks: Iterable[bytes|str]
+    :param key: key of the array in the top-level object
+    :type key: str
+    :raises json.JSONDecodeError: if the document is not valid JSON
+    :return: iterator over the items of the array
+    :rtype: Iterator
+    """
+    reader = _StreamReader(chunks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        name = reader.value()
+        reader.expect(":")
+        if name == key and reader.peek() == "[":
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.expect("]")
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.expect(",]") == "]":
+                        break
+        else:
+            reader.value()
+        if reader.expect(",}") == "}":
+            return
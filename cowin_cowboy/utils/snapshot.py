@@ -0,0 +1,320 @@
+# snapshot.py -- on-disk snapshot of centers, to output deltas between scans
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = [
+    "ScanCoverage",
+    "SnapshotStore",
+    "DELTA_NEW",
+    "DELTA_CHANGED",
+    "DELTA_REMOVED",
+]
+
+from datetime import datetime, timedelta
+from json import dumps, loads
+from logging import getLogger
+from os import makedirs, path
+import sqlite3
+
+from cowin_cowboy.utils.center_store import CAPACITY_PREFIX
+
+_logger = getLogger(__name__)
+
+DELTA_NEW = "new"
+DELTA_CHANGED = "changed"
+DELTA_REMOVED = "removed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    center_id INTEGER NOT NULL,
+    session_id TEXT NOT NULL,
+    date TEXT,
+    capacity TEXT NOT NULL,
+    source TEXT,
+    PRIMARY KEY (center_id, session_id)
+)
+"""
+
+
+def _capacity(session):
+    return {
+        key: value for key, value in session.items() if key.startswith(CAPACITY_PREFIX)
+    }
+
+
+def _center_summary(center):
+    return {key: value for key, value in center.items() if key != "sessions"}
+
+
+def _parse_date(date_str):
+    try:
+        return datetime.strptime(date_str, "%d-%m-%Y").date()
+    except (TypeError, ValueError):
+        return None
+
+
+class ScanCoverage:
+    """Records which requests of a scan succeeded, as the dates requested
+    for every `"key:id"` location source, and the source every session
+    was returned by, so that a snapshot leaves alone the sessions of the
+    requests which failed.
+    """
+
+    def __init__(self):
+        # Source -> dates of its requests which succeeded
+        self.covered = {}
+        # (center ID, session ID) -> source which returned it
+        self.sources = {}
+        # Earliest date requested
+        self.first_date = None
+
+    @staticmethod
+    def _source(location):
+        return "{}:{}".format(location[0], location[1])
+
+    def covers(self, location, date_str):
+        """Whether the request of the location and date succeeded."""
+        return date_str in self.covered.get(self._source(location), ())
+
+    def covers_session(self, source, date_str):
+        """Whether the scan would have returned a session of the source
+        on a date, had it still been there: the request of the week of
+        that date succeeded, or that date is before every date the scan
+        requested, so that the session has expired.
+
+        :param source: the source which returned the session
+        :type source: str
+        :param date_str: date of the session, in DD-MM-YYYY
+        :type date_str: Optional[str]
+        :rtype: bool
+        """
+        # Snapshots from before sources were kept per location had the
+        # requested date at the end
+        source = ":".join(source.split(":")[:2])
+        session_date = _parse_date(date_str)
+        if session_date is None:
+            return source in self.covered
+        for week_str in self.covered.get(source, ()):
+            week_date = _parse_date(week_str)
+            if week_date is not None and 0 <= (session_date - week_date).days < 7:
+                return True
+        return self.first_date is not None and session_date < self.first_date
+
+    def record(self, location, date_str, centers):
+        """Records a successful request.
+
+        :param location: tuple of the location key and ID
+        :type location: tuple[str, int|str]
+        :param date_str: the requested date, in DD-MM-YYYY
+        :type date_str: str
+        :param centers: A dictionary of center ID -> center details
+        :type centers: dict[int, dict]
+        """
+        source = self._source(location)
+        self.covered.setdefault(source, set()).add(date_str)
+        self._add_date(_parse_date(date_str))
+        for center_id, center in centers.items():
+            sessions = center.get("sessions")
+            if not isinstance(sessions, list):
+                continue
+            for session in sessions:
+                session_id = session.get("session_id")
+                if session_id is not None:
+                    self.sources[center_id, session_id] = source
+
+    def merge(self, other):
+        """Records everything another coverage recorded, such as the one
+        of a shard.
+
+        :param other: the other coverage
+        :type other: ScanCoverage
+        """
+        for source, dates in other.covered.items():
+            self.covered.setdefault(source, set()).update(dates)
+        self.sources.update(other.sources)
+        self._add_date(other.first_date)
+
+    def _add_date(self, date_obj):
+        if date_obj is not None and (
+            self.first_date is None or date_obj < self.first_date
+        ):
+            self.first_date = date_obj
+
+    def clear(self):
+        self.covered.clear()
+        self.sources.clear()
+        self.first_date = None
+
+
+class SnapshotStore:
+    """Keeps the sessions of the last scan in an SQLite database, keyed by
+    center ID and session ID, to compute what changed in the next scan.
+    Only the capacity of the sessions is stored, as that is all which is
+    compared.
+
+    Deltas are dicts with a `"type"` of `"new"`, `"changed"` or
+    `"removed"`, and the `"center_id"` and `"session_id"`. New sessions
+    also have the `"center"` (without its sessions) and the `"session"`,
+    changed sessions have the `"session"` and the `"previous"` capacity
+    fields, and removed sessions have their `"date"`.
+
+    With a `ScanCoverage` of the scan, the location every session came
+    from is stored too, and a session missing from the scan is only
+    removed if the request of its location and week succeeded this time,
+    or if its date is before the first week of the scan.
+    """
+
+    def __init__(self, file_path):
+        """
+        :param file_path: path of the database, created if missing
+        :type file_path: os.PathLike
+        """
+        directory = path.dirname(file_path)
+        if directory:
+            makedirs(directory, exist_ok=True)
+        self.file_path = file_path
+        self._db = sqlite3.connect(file_path)
+        with self._db:
+            self._db.execute(_SCHEMA)
+            columns = [
+                row[1] for row in self._db.execute("PRAGMA table_info(sessions)")
+            ]
+            # Snapshots from before sources were stored
+            if "source" not in columns:
+                self._db.execute("ALTER TABLE sessions ADD COLUMN source TEXT")
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _load(self):
+        return {
+            (center_id, session_id): (date, capacity, source)
+            for center_id, session_id, date, capacity, source in self._db.execute(
+                "SELECT center_id, session_id, date, capacity, source FROM sessions"
+            )
+        }
+
+    def diff(self, centers, coverage=None):
+        """Returns the deltas from the snapshot to `centers`, without
+        updating the snapshot.
+
+        :param centers: A dictionary of center ID -> center details
+        :type centers: dict[int, dict]
+        :param coverage: the requests of the scan which succeeded, by
+                default all of them
+        :type coverage: Optional[ScanCoverage]
+        :return: list of deltas, ordered by type, then as in `centers`
+        :rtype: list[dict]
+        """
+        return self._diff(centers, self._load(), coverage)[0]
+
+    def _diff(self, centers, previous, coverage):
+        new, changed, upserts = [], [], []
+        seen = set()
+        for center_id, center in centers.items():
+            for session in center.get("sessions", []):
+                session_id = session.get("session_id")
+                if session_id is None:
+                    continue
+                key = (center_id, session_id)
+                seen.add(key)
+                capacity = _capacity(session)
+                capacity_json = dumps(capacity, sort_keys=True)
+                old = previous.get(key)
+                source = None if coverage is None else coverage.sources.get(key)
+                if old is None:
+                    new.append(
+                        {
+                            "type": DELTA_NEW,
+                            "center_id": center_id,
+                            "session_id": session_id,
+                            "center": _center_summary(center),
+                            "session": session,
+                        }
+                    )
+                elif old[1] != capacity_json:
+                    changed.append(
+                        {
+                            "type": DELTA_CHANGED,
+                            "center_id": center_id,
+                            "session_id": session_id,
+                            "session": session,
+                            "previous": loads(old[1]),
+                        }
+                    )
+                elif source is None or old[2] == source:
+                    continue
+                upserts.append(
+                    (center_id, session_id, session.get("date"), capacity_json, source)
+                )
+
+        removed = [
+            {
+                "type": DELTA_REMOVED,
+                "center_id": center_id,
+                "session_id": session_id,
+                "date": date,
+            }
+            for (center_id, session_id), (date, _, source) in previous.items()
+            if (center_id, session_id) not in seen
+            and (
+                coverage is None
+                or source is None
+                or coverage.covers_session(source, date)
+            )
+        ]
+        return new + changed + removed, upserts
+
+    def update(self, centers, coverage=None):
+        """Replaces the snapshot with `centers`, except for the sessions
+        of the requests which failed, and returns the deltas from the
+        previous snapshot.
+
+        :param centers: A dictionary of center ID -> center details
+        :type centers: dict[int, dict]
+        :param coverage: the requests of the scan which succeeded, by
+                default all of them
+        :type coverage: Optional[ScanCoverage]
+        :return: list of deltas, see `diff`
+        :rtype: list[dict]
+        """
+        deltas, upserts = self._diff(centers, self._load(), coverage)
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)", upserts
+            )
+            self._db.executemany(
+                "DELETE FROM sessions WHERE center_id = ? AND session_id = ?",
+                (
+                    (delta["center_id"], delta["session_id"])
+                    for delta in deltas
+                    if delta["type"] == DELTA_REMOVED
+                ),
+            )
+        _logger.info(
+            "{} new, {} changed and {} removed sessions since the last scan".format(
+                *(
+                    sum(1 for delta in deltas if delta["type"] == delta_type)
+                    for delta_type in (DELTA_NEW, DELTA_CHANGED, DELTA_REMOVED)
+                )
+            )
+        )
+        return deltas
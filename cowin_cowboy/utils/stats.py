@@ -0,0 +1,304 @@
+# stats.py -- counters and latency histograms of the API and each stage
+# Copyright (C) 2021  Rishvic Pushpakaran
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = ["DEFAULT_BUCKETS", "Histogram", "Metrics", "metrics"]
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from copy import deepcopy
+from logging import getLogger
+from os import makedirs, path, replace
+from threading import Lock
+from time import perf_counter
+
+_logger = getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+_PREFIX = "cowin_cowboy_"
+
+_HELP = {
+    "api_request_seconds": "Time taken by API requests sent over the network",
+    "api_decode_seconds": "Time taken to decode API responses",
+    "api_response_bytes_total": "Bytes received in API response bodies",
+    "api_responses_total": "API responses, by HTTP status code",
+    "api_rate_limited_total": "API responses which were 403 (rate limited)",
+    "api_errors_total": "API requests which failed without a response",
+    "rate_limit_wait_seconds": "Time requests waited for the rate limiter",
+    "stage_seconds": "Time taken by each stage of a scan",
+    "alert_latency_seconds": "Time from finding a session to delivering its alert",
+    "alerts_total": "Alerts delivered, by subscriber",
+    "alert_errors_total": "Alerts which could not be delivered, by subscriber",
+    "booking_seconds": "Time from finding a session to confirming its booking",
+    "booking_attempts_total": "Booking requests sent, by HTTP status code",
+    "booking_warm_seconds": "Time taken by requests warming booking connections",
+    "shard_seconds": "Time taken to scan each shard of the locations",
+}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for name, value in labels
+        )
+    )
+
+
+class Histogram:
+    """Counts observed values into buckets, like a Prometheus histogram."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Adds the values observed by another histogram with the same
+        buckets, such as one recorded by another process.
+        """
+        if other.buckets != self.buckets:
+            raise ValueError("histograms should have the same buckets")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the `q` quantile
+        (or the largest observed value, if it is above every bucket).
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """A thread-safe registry of counters and histograms, each identified
+    by a name and a tuple of `(label, value)` pairs.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name, labels=None, value=1):
+        """Increments a counter.
+
+        :param name: name of the counter
+        :type name: str
+        :param labels: labels of the counter
+        :type labels: Optional[dict[str, str]]
+        :param value: amount to increment by
+        :type value: int|float
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        """Adds a value (usually in seconds) to a histogram.
+
+        :param name: name of the histogram
+        :type name: str
+        :param value: the observed value
+        :type value: float
+        :param labels: labels of the histogram
+        :type labels: Optional[dict[str, str]]
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        """Context manager, which adds the time spent within it to a
+        histogram.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, labels)
+
+    def stage(self, stage):
+        """Times a stage of a scan, such as `merge` or `filter`."""
+        return self.timer("stage_seconds", {"stage": stage})
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        """Returns a copy of the counters and histograms, which can be
+        pickled and merged into the metrics of another process.
+
+        :rtype: tuple[dict, dict]
+        """
+        with self._lock:
+            return dict(self.counters), {
+                key: deepcopy(histogram) for key, histogram in self.histograms.items()
+            }
+
+    def merge(self, snapshot):
+        """Adds the metrics of a snapshot, see `snapshot`."""
+        counters, histograms = snapshot
+        with self._lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, histogram in histograms.items():
+                if key in self.histograms:
+                    self.histograms[key].merge(histogram)
+                else:
+                    self.histograms[key] = deepcopy(histogram)
+
+    def summary(self):
+        """Returns a human readable summary of all the metrics.
+
+        :rtype: str
+        """
+        lines = []
+        with self._lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                lines.append(
+                    "{}{}: count={} total={:.3f}s mean={:.4f}s p50<={:.4f}s "
+                    "p95<={:.4f}s max={:.4f}s".format(
+                        name,
+                        _format_labels(labels),
+                        histogram.count,
+                        histogram.sum,
+                        histogram.sum / histogram.count,
+                        histogram.quantile(0.5),
+                        histogram.quantile(0.95),
+                        histogram.max,
+                    )
+                )
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("{}{}: {}".format(name, _format_labels(labels), value))
+        return "\n".join(lines)
+
+    def to_prometheus(self):
+        """Returns all the metrics in the Prometheus text format.
+
+        :rtype: str
+        """
+        lines = []
+        described = set()
+
+        def describe(name, metric_type):
+            if name not in described:
+                described.add(name)
+                if name in _HELP:
+                    lines.append("# HELP {}{} {}".format(_PREFIX, name, _HELP[name]))
+                lines.append("# TYPE {}{} {}".format(_PREFIX, name, metric_type))
+
+        with self._lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                describe(name, "histogram")
+                cumulative = 0
+                for bound, bucket_count in zip(
+                    histogram.buckets + (float("inf"),), histogram.counts
+                ):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(
+                        "{}{}_bucket{} {}".format(
+                            _PREFIX,
+                            name,
+                            _format_labels(labels + (("le", le),)),
+                            cumulative,
+                        )
+                    )
+                lines.append(
+                    "{}{}_sum{} {!r}".format(
+                        _PREFIX, name, _format_labels(labels), histogram.sum
+                    )
+                )
+                lines.append(
+                    "{}{}_count{} {}".format(
+                        _PREFIX, name, _format_labels(labels), histogram.count
+                    )
+                )
+            for (name, labels), value in sorted(self.counters.items()):
+                describe(name, "counter")
+                lines.append(
+                    "{}{}{} {}".format(_PREFIX, name, _format_labels(labels), value)
+                )
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, file_path):
+        """Writes all the metrics in the Prometheus text format, replacing
+        the file at once so that a scraper never reads half of it.
+
+        :param file_path: path of the file, such as one read by the
+                node exporter's textfile collector
+        :type file_path: os.PathLike
+        """
+        try:
+            directory = path.dirname(file_path)
+            if directory:
+                makedirs(directory, exist_ok=True)
+            tmp_path = "{}.tmp".format(file_path)
+            with open(tmp_path, "w") as metrics_fp:
+                metrics_fp.write(self.to_prometheus())
+            replace(tmp_path, file_path)
+        except IOError:
+            _logger.warning("Could not write metrics to '{}'".format(file_path))
+
+
+# Metrics recorded by the whole `cowin_cowboy` module
+metrics = Metrics()